@@ -42,6 +42,11 @@ INPUT FILE REQUIREMENTS
 		Any additional columns after first two are ignored.
 		MUST CONTAIN THE SAME NUMBER OF COLUMNS IN EACH LINE (unless commented)
 		Can use '#' at the start of any line to remove comment
+		Large spectra can be converted to a binary (.lfs) file that is
+		memory-mapped rather than read (much faster to load):
+			tb_linefinder.py --convert <INPUT_SPECTRUM_FILENAME>
+	-OR a 1D FITS spectrum (image with CRVAL1/CDELT1 dispersion, or binary
+		table with wavelength and flux columns). See READFITSSPEC.
 
 	-ASCII file containing a line list for identification.
 		Each line in the file must contain information on each spectral line
@@ -111,13 +116,27 @@ KNOWN ISSUES:
 
 #Import necessary Matplotlib packages
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 #Import Tkinter for GUI interface
 import Tkinter, tkFileDialog, tkMessageBox
 #import other basic pacakages
 import numpy as np
 import math
-import os,sys
+import os,sys,re,struct,json,time,tempfile,shutil,hashlib,threading,multiprocessing
+import sqlite3
+import gzip,bz2
+from collections import OrderedDict
+#LZMA (for .xz compressed spectra) is only in the standard library for Python 3.
+#For Python 2.7, the backports.lzma package is needed.
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma=None
 
 
 #Default input/output files necessary for running
@@ -127,8 +146,9 @@ initlog='linefinder.log'
 
 
 #Command line inputs (Can be changed or set within GUI)
+#(Command line options starting with '--' run without the GUI; see the Main program below)
 inputs=sys.argv
-if len(sys.argv)==4:
+if len(sys.argv)==4 and not sys.argv[1].startswith('--'):
 	initinspec=sys.argv[1]
 	initllist=sys.argv[2]
 	initlog=sys.argv[3]
@@ -145,6 +165,48 @@ debug=False
 #usetutorial=True
 usetutorial=False
 
+#USEVELGRID is a boolean to control whether the velocity profiles are cut from the
+#spectrum resampled onto a constant-velocity (log-wavelength) grid (see VELGRID).
+#The original wavelength grid is exact, so it is used by default.
+#This can be turned on/off using the menu in the main Linefinder window.
+usevelgrid=False
+
+#USEJOURNAL is a boolean to control how the log is saved while finding lines. If TRUE,
+#only the changed entries are appended to a journal (<LOGFILE>.journal, see LOGJOURNAL),
+#and the logfile itself is rewritten (compacted) on quitting or on demand. If FALSE,
+#the whole logfile is rewritten every time it is saved.
+#This can be turned on/off using the menu in the main Linefinder window.
+usejournal=True
+
+#LOGSUMMARY is a boolean to control whether a short summary (number of entries/systems)
+#is printed to the terminal every time the log is saved.
+#This can be turned on/off using the menu in the main Linefinder window.
+logsummary=True
+
+#AUTOSAVE is a boolean to control whether the log is saved in the background (see AUTOSAVER),
+#a short time after it was last changed, rather than every time a window is closed.
+#AUTOSAVEIDLE is how long (in seconds) the log has to be unchanged before it is saved,
+#and AUTOSAVEMAX is the longest (in seconds) a change can wait to be saved.
+#This can be turned on/off using the menu in the main Linefinder window.
+autosave=True
+autosaveidle=2.0
+autosavemax=5.0
+
+#PAGEVELPLOTS is a boolean to control whether the velocity profiles (and the Checkbuttons
+#to select them, see LINEADDER) are shown PANELSPERPAGE at a time (one page), rather than
+#all at once. Only the page shown is plotted, so large linelists stay readable and fast.
+#This can be turned on/off using the menu in the main Linefinder window.
+pagevelplots=True
+panelsperpage=18
+
+#CLIGHT is the speed of light (km/s), used for every velocity (so the velocity
+#profiles from VELSPEC, VELSPECS and VELGRID are the same)
+clight=2.998E5
+
+#SPECCACHEMB is the memory cap (in megabytes) of the parsed spectra held by SPECCACHE.
+#The least recently used spectrum is dropped when the cap is exceeded.
+speccachemb=1024
+
 def velspec(line, wvlngth, vmin,vmax, spectrum):
 	""" 
 	VELSPEC takes a spectrum and converts the wavelength scale
@@ -155,6 +217,7 @@ def velspec(line, wvlngth, vmin,vmax, spectrum):
 	INPUT VARIABLES:
 		LINE - The wavelength to zero the velocity scale to (float)
 		WVLGNTH - A NUMPY array with the wavelength information of the spectrum
+			(in increasing order, as returned by SPECFITS)
 		VMIN - The minimum velocity of the returned velocity scale (float)
 		VMAX - The maximum velocity of the returned velocity scale (float)
 		SPECTRUM - A NUMPY array with the flux information of the spectrum
@@ -169,20 +232,1047 @@ def velspec(line, wvlngth, vmin,vmax, spectrum):
 		TMPSPEC will contain an array of zeros. If this occurs, a warning will
 		be printed to the screen.
 
+		The VMIN/VMAX window is found by a binary search of WVLNGTH, and only
+		the pixels in the window are converted to velocity. TMPSPEC is a view
+		of SPECTRUM (not a copy).
+
 	"""
-	c=3.0E5# speed of light (km/s)
-	vel=np.array((wvlngth-line)/line*c)#Convert to a velocity
-	#Check to see that VEL is within the specified VMIN/VMAX  range
-	if min(vel)<vmin and max(vel)>vmax:
-		ind1=(min(np.where(vel>vmin)[0]))#Find the index closest to vmin
-		ind2=(max(np.where(vel<vmax)[0]))#Find the index closest to vmax
-		tmpvel=vel[ind1:ind2]#Generate the velocity (x) array of intere$
+	c=clight# speed of light (km/s)
+	#Wavelengths corresponding to VMIN and VMAX
+	wmin=line*(1.0+vmin/c)
+	wmax=line*(1.0+vmax/c)
+	#Check to see that the spectrum covers the specified VMIN/VMAX  range
+	if len(wvlngth)>0 and wvlngth[0]<wmin and wvlngth[-1]>wmax:
+		ind1=wvlngth.searchsorted(wmin,side='right')#Find the first index above vmin
+		ind2=wvlngth.searchsorted(wmax,side='left')-1#Find the last index below vmax
+		tmpvel=(wvlngth[ind1:ind2]-line)/line*c#Generate the velocity (x) array of interest
 		tmpspec=spectrum[ind1:ind2]#Do the Same for the relative flux(y)
 		return tmpvel, tmpspec#Return slice of spectrum
 	#If not, return zero arrays and print warning
 	else:
 		print 'VELSPEC: Line not in velocity range'
+		vel=(np.asarray(wvlngth)-line)/line*c#Convert to a velocity
 		return vel, np.zeros(len(vel))
+def velspecs(lines, wvlngth, vmin,vmax, spectrum):
+	""" 
+	VELSPECS is the batched version of VELSPEC. It gets the velocity profiles
+	(between VMIN and VMAX) of many lines in a spectrum at once.
+
+	call - TMPVELS,TMPSPECS,NPIX=velspecs(LINES,WVLNGTH,VMIN,VMAX,SPECTRUM)
+
+	INPUT VARIABLES:
+		LINES - A list/NUMPY array of the (observed) wavelengths to zero each
+			velocity scale to
+		WVLNGTH - A NUMPY array with the wavelength information of the spectrum
+			(in increasing order, as returned by SPECFITS)
+		VMIN - The minimum velocity of the returned velocity scales (float)
+		VMAX - The maximum velocity of the returned velocity scales (float)
+		SPECTRUM - A NUMPY array with the flux information of the spectrum
+
+	RETURNS:
+		TMPVELS - A 2D NUMPY array of the velocity scales. Row II is the velocity
+			profile of LINES[II]. Rows are padded with NaN after NPIX[II] pixels
+		TMPSPECS - A 2D NUMPY array with the flux corresponding to TMPVELS (also padded
+			with NaN)
+		NPIX - A NUMPY array with the number of valid pixels in each row
+			(i.e. the profile of LINES[II] is TMPVELS[II,:NPIX[II]], TMPSPECS[II,:NPIX[II]])
+
+	NOTES:
+		All windows are found with one binary search of WVLNGTH. If the spectrum
+		only covers part of the VMIN/VMAX window of a line, the row only contains
+		the covered pixels (NPIX is 0 if none are covered). No warning is printed.
+
+	"""
+	c=clight# speed of light (km/s)
+	lines=np.atleast_1d(np.asarray(lines,dtype=float))
+	#Pixel range of each VMIN/VMAX window (same as VELSPEC)
+	ind1=np.asarray(wvlngth.searchsorted(lines*(1.0+vmin/c),side='right'))
+	ind2=np.asarray(wvlngth.searchsorted(lines*(1.0+vmax/c),side='left'))-1
+	npix=np.maximum(ind2-ind1,0)
+	width=0
+	if len(lines)>0: width=int(npix.max())
+	#Pixel indices of every window (padded with pixel 0)
+	offsets=np.arange(width)
+	valid=offsets[np.newaxis,:]<npix[:,np.newaxis]
+	inds=np.where(valid,ind1[:,np.newaxis]+offsets[np.newaxis,:],0)
+	if len(wvlngth)==0: inds=np.zeros((len(lines),0),dtype=int)
+	tmpvels=(wvlngth[inds]-lines[:,np.newaxis])/lines[:,np.newaxis]*c
+	tmpspecs=np.asarray(spectrum,dtype=float)[inds]
+	tmpvels[~valid]=np.nan
+	tmpspecs[~valid]=np.nan
+	return tmpvels,tmpspecs,npix
+class VelGrid:
+	""" 
+	CLASS VELGRID - A spectrum on a constant-velocity (i.e. log-linear wavelength) grid.
+		On such a grid, the velocity window of any line is a fixed number of pixels
+		from the pixel of the line centre, so the velocity profiles of many lines are
+		cut out by integer arithmetic alone.
+
+	Call - VG=VelGrid(WVLNGTH,SPECTRUM,DV=None,TOL=1.0E-3)
+
+	INPUTS:
+		WVLNGTH - The wavelength array of the spectrum (increasing order, as from SPECFITS)
+		SPECTRUM - The flux array of the spectrum
+		DV - The velocity width (km/s) of a pixel on the new grid. If None, the median
+			velocity width of the pixels in the spectrum is used.
+		TOL - If the velocity width of every pixel in the spectrum is within a fraction
+			TOL of the median (and DV is None), the spectrum is all ready on a
+			constant-velocity grid and is used as is.
+
+	ATTRIBUTES:
+		VG.LNW0 - The natural log of the wavelength of the first pixel
+		VG.DLNW - The step in natural log wavelength between pixels
+		VG.DV - The velocity width (km/s) of each pixel
+		VG.NPIX - The number of pixels
+		VG.WVLNGTH - The wavelengths of the grid (a WAVESOLUTION)
+		VG.SPECTRUM - The flux on the grid
+		VG.RESAMPLED - Boolean, TRUE if the spectrum had to be resampled onto the grid
+		VG.WINDOWS(LINES,VMIN,VMAX) - The velocity profiles of LINES (same call/returns as VELSPECS)
+
+	NOTES:
+		The resampling is flux conserving (the mean flux density within each new pixel
+		is the integral of the original piecewise-constant spectrum over that pixel).
+		The original grid (VELSPEC/VELSPECS) is exact, and should be used for display
+		unless speed is more important (see USEVELGRID).
+
+	"""
+	def __init__(self,wvlngth,spectrum,dv=None,tol=1.0E-3):
+		c=clight# speed of light (km/s)
+		self.resampled=False
+		#Spectra with a log-linear WAVESOLUTION are all ready on the grid
+		if isinstance(wvlngth,WaveSolution) and wvlngth.mode in ['ln','log10'] and dv is None:
+			self.lnw0=math.log(wvlngth[0])
+			if wvlngth.mode=='ln': self.dlnw=wvlngth.cdelt/wvlngth.crval
+			else: self.dlnw=wvlngth.cdelt*math.log(10.0)
+			self.spectrum=spectrum
+		else:
+			lnw=np.log(np.asarray(wvlngth,dtype=float))
+			dlnw=np.diff(lnw)
+			meddlnw=np.median(dlnw)
+			if dv is None and np.all(np.abs(dlnw-meddlnw)<=tol*meddlnw):
+				#Detected a constant-velocity grid
+				self.lnw0=lnw[0]
+				self.dlnw=(lnw[-1]-lnw[0])/(len(lnw)-1)
+				self.spectrum=spectrum
+			else:
+				if dv is None: dv=meddlnw*c
+				self.lnw0=lnw[0]
+				self.dlnw=dv/c
+				nnew=int(math.floor((lnw[-1]-lnw[0])/self.dlnw))+1
+				self.spectrum=self._rebin(lnw,np.asarray(spectrum,dtype=float),nnew)
+				self.resampled=True
+		self.npix=len(self.spectrum)
+		self.dv=self.dlnw*c
+		w0=math.exp(self.lnw0)
+		self.wvlngth=WaveSolution(self.npix,w0,w0*self.dlnw,1.0,'ln')
+	#Flux conserving rebinning of the spectrum (LNW, FLUX) onto NNEW pixels of the grid
+	def _rebin(self,lnw,flux,nnew):
+		wvl=np.exp(lnw)
+		#Pixel edges of the original spectrum (half way between pixel centres)
+		edges=np.empty(len(wvl)+1)
+		edges[1:-1]=0.5*(wvl[1:]+wvl[:-1])
+		edges[0]=wvl[0]-0.5*(wvl[1]-wvl[0])
+		edges[-1]=wvl[-1]+0.5*(wvl[-1]-wvl[-2])
+		#Integral of the flux up to each edge
+		cumflux=np.zeros(len(edges))
+		np.cumsum(flux*np.diff(edges),out=cumflux[1:])
+		#Pixel edges of the new grid
+		newedges=np.exp(self.lnw0+self.dlnw*(np.arange(nnew+1)-0.5))
+		newcum=np.interp(newedges,edges,cumflux)
+		return np.diff(newcum)/np.diff(newedges)
+	def windows(self,lines,vmin,vmax):
+		c=clight# speed of light (km/s)
+		lines=np.atleast_1d(np.asarray(lines,dtype=float))
+		#(Fractional) pixel of each line centre, and the nearest pixel
+		pcen=(np.log(lines)-self.lnw0)/self.dlnw
+		pnear=np.round(pcen).astype(int)
+		#Pixel offsets that cover VMIN to VMAX (the same for every line)
+		offsets=np.arange(int(math.floor(vmin/self.dv)),int(math.ceil(vmax/self.dv))+1)
+		width=len(offsets)
+		starts=pnear+offsets[0]
+		#Every WIDTH-pixel window of the spectrum as a 2D view (no copy)
+		spec=np.asarray(self.spectrum,dtype=float)
+		nwin=max(self.npix-width+1,0)
+		allwindows=np.lib.stride_tricks.as_strided(spec,shape=(nwin,width),strides=(spec.strides[0],spec.strides[0]))
+		inside=(starts>=0)&(starts<nwin)
+		tmpspecs=np.empty((len(lines),width))
+		tmpspecs[inside]=allwindows[starts[inside]]
+		#Velocity of each pixel relative to the line (same definition as VELSPEC)
+		tmpvels=(np.exp(self.dlnw*(offsets[np.newaxis,:]+(pnear-pcen)[:,np.newaxis]))-1.0)*c
+		npix=np.zeros(len(lines),dtype=int)+width
+		#Windows running off either end of the spectrum are filled pixel by pixel,
+		#with the covered pixels moved to the start of the row (as VELSPECS)
+		for ii in np.nonzero(~inside)[0]:
+			inds=starts[ii]+np.arange(width)
+			ok=(inds>=0)&(inds<self.npix)
+			npix[ii]=ok.sum()
+			tmpvels[ii,:npix[ii]]=tmpvels[ii,ok]
+			tmpspecs[ii,:npix[ii]]=spec[inds[ok]]
+			tmpvels[ii,npix[ii]:]=np.nan
+			tmpspecs[ii,npix[ii]:]=np.nan
+		return tmpvels,tmpspecs,npix
+def GetVelGrid(fits):
+	""" 
+	GETVELGRID returns the constant-velocity grid (see VELGRID) of a spectrum file.
+	The grid is built once, and kept with the spectrum in SPECCACHE.
+
+	Call - VG=GetVelGrid(FITS)
+
+	"""
+	iwvlngth,ispectrum=specfits(fits)
+	derived=speccache.derived(fits)
+	if 'velgrid' not in derived:
+		derived['velgrid']=VelGrid(iwvlngth,ispectrum)
+		if debug: print "GetVelGrid: resampled=%s, dv=%.3f km/s"%(derived['velgrid'].resampled,derived['velgrid'].dv)
+	return derived['velgrid']
+class SpecPyramid:
+	""" 
+	CLASS SPECPYRAMID - A multi-resolution min/max pyramid of a spectrum, for drawing
+		very large spectra quickly. Each level of the pyramid holds the minimum and
+		maximum flux in blocks of pixels (the block size doubles with each level),
+		so any range of the spectrum can be drawn with a fixed number of points that
+		still shows every feature (the min/max envelope of each block).
+
+	Call - SP=SpecPyramid(WVLNGTH,SPECTRUM,MINBLOCK=4)
+
+	INPUTS:
+		WVLNGTH - The wavelength array of the spectrum (increasing order, as from SPECFITS)
+		SPECTRUM - The flux array of the spectrum
+		MINBLOCK - The block size (in pixels) of the first level of the pyramid
+
+	ATTRIBUTES:
+		SP.LEVELS - A list of the levels, each a tuple (BLOCKSIZE,MINS,MAXS)
+		SP.YLIMITS - The default flux limits of the plot (about the 2.5 and 97.5
+			percentiles of the flux), found from the pyramid when it is built
+		SP.DECIMATE(XMIN,XMAX,NPTS) - Returns (X,Y,RAW) to draw the spectrum between
+			wavelengths XMIN and XMAX with at most ~NPTS points. If RAW is TRUE, X and Y
+			are the original pixels (draw with steps), otherwise they are the min/max
+			envelope of the blocks.
+
+	NOTES:
+		Building the pyramid is linear in the number of pixels, and needs at most
+		~1/MINBLOCK of the memory of the spectrum.
+		SP.YLIMITS are the 2.5 percentile of the block minima and 97.5 percentile of
+		the block maxima of (at most MAXSTATBLOCKS evenly spaced blocks of) the first
+		level, so they cost the same for any size of spectrum. They are a little wider
+		than the percentiles of the flux itself.
+
+	"""
+	#Most blocks used for YLIMITS
+	maxstatblocks=2**16
+	def __init__(self,wvlngth,spectrum,minblock=4):
+		self.wvlngth=wvlngth
+		self.spectrum=spectrum
+		self.npix=len(spectrum)
+		self.levels=[]
+		flux=np.asarray(spectrum,dtype=float)
+		#First level, straight from the spectrum (NaN pixels are ignored)
+		nfull=self.npix/minblock*minblock
+		mins=np.fmin.reduce(flux[:nfull].reshape(-1,minblock),axis=1)
+		maxs=np.fmax.reduce(flux[:nfull].reshape(-1,minblock),axis=1)
+		if nfull<self.npix:
+			mins=np.append(mins,np.nanmin(flux[nfull:]))
+			maxs=np.append(maxs,np.nanmax(flux[nfull:]))
+		block=minblock
+		self.levels.append((block,mins,maxs))
+		#Each subsequent level combines pairs of blocks of the previous level
+		while len(mins)>1:
+			if len(mins)%2==1:
+				mins=np.append(mins,mins[-1])
+				maxs=np.append(maxs,maxs[-1])
+			mins=np.fmin(mins[0::2],mins[1::2])
+			maxs=np.fmax(maxs[0::2],maxs[1::2])
+			block*=2
+			self.levels.append((block,mins,maxs))
+		#The default scaling removes the +/- 2.5 percentile outliers.
+		#This number was set arbitrarily for practice spectrum, and might not be appropriate
+		#(Found from the block minima/maxima, rather than every pixel)
+		if self.npix>0:
+			block,mins,maxs=self.levels[0]
+			step=max(len(mins)/self.maxstatblocks,1)
+			mins,maxs=mins[::step],maxs[::step]
+			self.ylimits=(np.nanpercentile(mins,2.5),np.nanpercentile(maxs,97.5))
+		else: self.ylimits=(0.0,1.0)
+	def decimate(self,xmin,xmax,npts):
+		#Pixel range of XMIN to XMAX (plus a pixel either side)
+		i0=max(int(self.wvlngth.searchsorted(xmin))-1,0)
+		i1=min(int(self.wvlngth.searchsorted(xmax))+1,self.npix)
+		if i1-i0<=npts: return self.wvlngth[i0:i1],self.spectrum[i0:i1],True
+		#Use the smallest blocks that give at most NPTS points (2 per block)
+		for block,mins,maxs in self.levels:
+			if 2*(i1-i0)/block<=npts: break
+		b0=i0/block
+		b1=(i1+block-1)/block
+		#Each block is drawn from its minimum to maximum at the central wavelength
+		cen=np.minimum(np.arange(b0,b1)*block+block/2,self.npix-1)
+		x=np.repeat(self.wvlngth[cen],2)
+		y=np.empty(2*(b1-b0))
+		y[0::2]=mins[b0:b1]
+		y[1::2]=maxs[b0:b1]
+		return x,y,False
+def GetSpecPyramid(fits):
+	""" 
+	GETSPECPYRAMID returns the min/max pyramid (see SPECPYRAMID) of a spectrum file.
+	The pyramid is built once, and kept with the spectrum in SPECCACHE.
+
+	Call - SP=GetSpecPyramid(FITS)
+
+	"""
+	iwvlngth,ispectrum=specfits(fits)
+	derived=speccache.derived(fits)
+	if 'pyramid' not in derived: derived['pyramid']=SpecPyramid(iwvlngth,ispectrum)
+	return derived['pyramid']
+class SpecCache:
+	""" 
+	CLASS SPECCACHE - An in-memory cache of parsed spectra, so that each spectrum file
+		is only read once per session. Entries are keyed by the path of the spectrum
+		file, and are only reused if the size and modification time of the file
+		have not changed since it was read. When the total size of the cached
+		arrays exceeds the memory cap, the least recently used spectra are dropped.
+
+	Call - SC=SpecCache(MAXMB)
+
+	INPUTS:
+		MAXMB - The memory cap (in megabytes) of the cached arrays
+
+	ATTRIBUTES:
+		SC.MAXBYTES - The memory cap (in bytes)
+		SC.NBYTES - The current size (in bytes) of all cached arrays
+		SC.ENTRIES - An ordered dictionary (least recently used first) keyed by
+			the absolute path of the spectrum. Each value is a dictionary with:
+				'stamp' - The tuple (SIZE,MTIME) of the file when read
+				'data' - The tuple of read-only arrays returned by the reader
+				'nbytes' - The size (in bytes) of the arrays in 'data'
+				'derived' - A dictionary for quantities derived from the spectrum,
+					which is dropped along with the entry
+		SC.GET(INFILE,READER) - Returns the cached arrays of INFILE. If INFILE is not
+			cached (or has changed on disk), READER(INFILE) is run and its output cached.
+		SC.DERIVED(INFILE) - Returns the 'derived' dictionary of a cached INFILE (or
+			an empty dictionary if INFILE is not cached)
+		SC.INVALIDATE(INFILE=NONE) - Drops INFILE from the cache (all files if INFILE is NONE)
+
+	NOTES:
+		The arrays handed back are read-only views, so the cached data cannot
+		be modified by accident. Use a copy if you need to change the arrays.
+
+	"""
+	def __init__(self,maxmb):
+		self.maxbytes=int(maxmb*1024*1024)
+		self.nbytes=0
+		self.entries=OrderedDict()
+	#The key and file stamp (size, modification time) for a given file
+	def _stamp(self,infile):
+		st=os.stat(infile)
+		return os.path.abspath(infile),(st.st_size,st.st_mtime)
+	def get(self,infile,reader):
+		key,stamp=self._stamp(infile)
+		entry=self.entries.pop(key,None)
+		#Drop stale entries (i.e. file has been changed on disk)
+		if entry is not None and entry['stamp']!=stamp:
+			if debug: print "SpecCache: %s changed on disk, re-reading"%infile
+			self.nbytes-=entry['nbytes']
+			entry=None
+		if entry is None:
+			if debug: print "SpecCache: reading %s"%infile
+			data=[]
+			nbytes=0
+			for arr in reader(infile):
+				#Arrays computed on demand (e.g. WAVESOLUTION) take no memory
+				if not isinstance(arr,np.ndarray):
+					data.append(arr)
+					continue
+				#Hand out read-only views only
+				view=arr.view()
+				view.flags.writeable=False
+				data.append(view)
+				#Memory-mapped arrays live in the (shared) page cache,
+				#so they do not count towards the memory cap
+				if not isinstance(arr,np.memmap): nbytes+=arr.nbytes
+			entry={'stamp':stamp,'data':tuple(data),'nbytes':nbytes,'derived':{}}
+			self.nbytes+=nbytes
+		#(Re)insert as the most recently used entry
+		self.entries[key]=entry
+		self._evict()
+		return entry['data']
+	def derived(self,infile):
+		key=os.path.abspath(infile)
+		if key in self.entries: return self.entries[key]['derived']
+		return {}
+	def invalidate(self,infile=None):
+		if infile is None:
+			self.entries.clear()
+			self.nbytes=0
+			return
+		entry=self.entries.pop(os.path.abspath(infile),None)
+		if entry is not None: self.nbytes-=entry['nbytes']
+		return
+	#Drop the least recently used entries until under the memory cap.
+	#The most recently used entry is always kept.
+	def _evict(self):
+		while self.nbytes>self.maxbytes and len(self.entries)>1:
+			key,entry=self.entries.popitem(last=False)
+			self.nbytes-=entry['nbytes']
+			if debug: print "SpecCache: evicted %s"%key
+		return
+
+#The spectrum cache used by SPECFITS
+speccache=SpecCache(speccachemb)
+
+#The magic bytes at the start of a binary spectrum file (see WRITEBINSPEC)
+binspecmagic='\x93LFSPEC\x01'
+#The file extension of binary spectrum files
+binspecext='.lfs'
+
+def IsBinSpec(infile):
+	""" 
+	ISBINSPEC checks if a spectrum file is in the TB_LINEFINDER binary format
+	(by checking the magic bytes at the start of the file).
+
+	Call - OUTPUT=IsBinSpec(INFILE)
+
+	"""
+	f=open(infile,'rb')
+	magic=f.read(len(binspecmagic))
+	f.close()
+	return magic==binspecmagic
+def WriteBinSpec(outfile,wvlngth,spectrum,**columns):
+	""" 
+	WRITEBINSPEC writes a spectrum to the TB_LINEFINDER binary format.
+
+	Call - WriteBinSpec(OUTFILE,WVLNGTH,SPECTRUM,[NAME=ARRAY,...])
+
+	INPUTS:
+		OUTFILE - The filename of the binary spectrum (should end in BINSPECEXT)
+		WVLNGTH - A NUMPY array with the wavelength of the spectrum
+		SPECTRUM - A NUMPY array with the flux of the spectrum
+		NAME=ARRAY - Any additional columns to save (e.g. error=ERRARRAY)
+
+	NOTES:
+		The format of the file is:
+			BINSPECMAGIC (8 bytes)
+			The length of the header (4 byte little-endian unsigned int)
+			A JSON header with the number of pixels ('npix'), the column
+				names ('columns'), and the data type ('dtype'). The header
+				is padded with spaces so the data starts on a 64 byte boundary.
+			The columns as raw little-endian 8-byte floats, one column
+				after the other (wavelength first, then flux, then any others)
+
+		The columns are stored contiguously, so they can be memory-mapped
+		(see READBINSPEC) without reading the file. The spectrum should all
+		ready be in order of increasing wavelength (see SORTSPEC), as
+		READBINSPEC does not check it.
+
+	"""
+	names=['wave','flux']+sorted(columns.keys())
+	arrays=[wvlngth,spectrum]+[columns[name] for name in sorted(columns.keys())]
+	header={'npix':len(wvlngth),'columns':names,'dtype':'<f8'}
+	header=json.dumps(header)
+	#Pad the header so the data is aligned to 64 bytes
+	hlen=len(header)
+	pad=(-(len(binspecmagic)+4+hlen))%64
+	header=header+' '*pad
+	f=open(outfile,'wb')
+	f.write(binspecmagic)
+	f.write(struct.pack('<I',len(header)))
+	f.write(header)
+	for arr in arrays:
+		np.asarray(arr,dtype='<f8').tofile(f)
+	f.close()
+	return
+def ReadBinSpec(infile,column=None):
+	""" 
+	READBINSPEC memory-maps a spectrum in the TB_LINEFINDER binary format (see WRITEBINSPEC)
+
+	Call - WVLNGTH,SPECTRUM=ReadBinSpec(INFILE)
+		or COLUMN=ReadBinSpec(INFILE,COLUMN=NAME)
+
+	NOTES:
+		The returned arrays are read-only NUMPY memmaps, so loading is
+		independent of the number of pixels, and the pages are shared
+		with any other process that has the same file open.
+
+		If COLUMN is given, only that column is returned (or None if the
+		file does not have it).
+
+	"""
+	f=open(infile,'rb')
+	magic=f.read(len(binspecmagic))
+	if magic!=binspecmagic:
+		f.close()
+		raise ValueError('%s is not a binary spectrum file'%infile)
+	hlen,=struct.unpack('<I',f.read(4))
+	header=json.loads(f.read(hlen))
+	f.close()
+	offset=len(binspecmagic)+4+hlen
+	npix=header['npix']
+	names=header['columns']
+	data=np.memmap(infile,dtype=header['dtype'],mode='r',offset=offset,shape=(len(names),npix))
+	if column is not None:
+		if column not in names: return None
+		return data[names.index(column)]
+	return data[0],data[1]
+def ConvertSpec(infile,outfile=None):
+	""" 
+	CONVERTSPEC converts an ASCII spectrum file to the TB_LINEFINDER binary format
+
+	Call - OUTFILE=ConvertSpec(INFILE,OUTFILE=None)
+
+	INPUTS:
+		INFILE - The ASCII spectrum file (see SPECFITS for format). If it has a
+			third column, it is kept as the 'error' column (see SPECERROR)
+		OUTFILE - The output binary spectrum. If None, INFILE with its
+			extension replaced by BINSPECEXT is used
+
+	OUTPUT:
+		OUTFILE - The filename of the binary spectrum
+
+	"""
+	if outfile is None: outfile=os.path.splitext(infile)[0]+binspecext
+	#Keep the (third column) error of the spectrum, if it has one
+	try:
+		wvlngth,spectrum,error=SortSpec(*ReadAsciiSpec(infile,usecols=(0,1,2)))
+		WriteBinSpec(outfile,wvlngth,spectrum,error=error)
+	except ValueError:
+		wvlngth,spectrum=SortSpec(*ReadAsciiSpec(infile))
+		WriteBinSpec(outfile,wvlngth,spectrum)
+	print "Converted %s to %s (%i pixels)"%(infile,outfile,len(wvlngth))
+	return outfile
+
+def SortSpec(wvlngth,*columns):
+	""" 
+	SORTSPEC makes sure a spectrum is in order of increasing wavelength.
+
+	Call - WVLNGTH,SPECTRUM,...=SortSpec(WVLNGTH,SPECTRUM,...)
+
+	NOTES:
+		A spectrum in decreasing order is reversed (as a view). Any other
+		unsorted spectrum is sorted (and a warning printed to screen).
+		Spectra that are all ready in order are returned unchanged.
+
+	"""
+	out=(wvlngth,)+columns
+	if len(wvlngth)<2 or np.all(wvlngth[1:]>=wvlngth[:-1]): return out
+	if np.all(wvlngth[1:]<=wvlngth[:-1]): return tuple(arr[::-1] for arr in out)
+	print "WARNING: Spectrum is not in order of wavelength. Sorting it."
+	order=np.argsort(wvlngth,kind='mergesort')
+	return tuple(arr[order] for arr in out)
+class WaveSolution:
+	""" 
+	CLASS WAVESOLUTION - A wavelength array that is computed on demand from a linear or
+		log-linear dispersion solution (e.g. the WCS of a FITS spectrum), rather than
+		stored in memory. It can be used in place of a NUMPY array of wavelengths
+		(indexing, slicing, SEARCHSORTED, MIN/MAX and arithmetic). Anything else
+		can use NUMPY.ASARRAY(WS) to get the full array of wavelengths.
+
+	Call - WS=WaveSolution(NPIX,CRVAL,CDELT,CRPIX=1.0,MODE='linear')
+
+	INPUTS:
+		NPIX - The number of pixels in the spectrum
+		CRVAL - The (FITS) reference value of the dispersion (CRVAL1)
+		CDELT - The (FITS) increment per pixel of the dispersion (CDELT1 or CD1_1)
+		CRPIX - The (FITS, i.e. 1-indexed) reference pixel (CRPIX1)
+		MODE - The form of the dispersion solution, one of:
+			'linear' - WAVELENGTH=CRVAL+CDELT*(PIX-CRPIX)
+			'log10' - WAVELENGTH=10**(CRVAL+CDELT*(PIX-CRPIX)) (i.e. IRAF DC-FLAG=1)
+			'ln' - WAVELENGTH=CRVAL*EXP(CDELT*(PIX-CRPIX)/CRVAL) (i.e. FITS WAVE-LOG)
+
+	ATTRIBUTES:
+		WS.WAVE(PIX) - The wavelength of the (0-indexed, can be fractional) pixel(s) PIX
+		WS.PIXEL(WVL) - The (0-indexed, fractional) pixel of the wavelength(s) WVL
+		WS.SEARCHSORTED(WVL,SIDE='left') - As NUMPY.SEARCHSORTED, but found analytically
+		WS.REVERSED() - The WAVESOLUTION with the pixels in reverse order
+
+	"""
+	def __init__(self,npix,crval,cdelt,crpix=1.0,mode='linear'):
+		self.npix=int(npix)
+		self.crval=float(crval)
+		self.cdelt=float(cdelt)
+		self.crpix=float(crpix)
+		self.mode=mode
+		self.shape=(self.npix,)
+		self.ndim=1
+		self.size=self.npix
+		self.dtype=np.dtype(float)
+		self.nbytes=0
+	def wave(self,pix):
+		x=self.cdelt*(np.asarray(pix,dtype=float)+1.0-self.crpix)
+		if self.mode=='log10': return 10.0**(self.crval+x)
+		if self.mode=='ln': return self.crval*np.exp(x/self.crval)
+		return self.crval+x
+	def pixel(self,wvl):
+		wvl=np.asarray(wvl,dtype=float)
+		if self.mode=='log10': x=np.log10(wvl)-self.crval
+		elif self.mode=='ln': x=self.crval*np.log(wvl/self.crval)
+		else: x=wvl-self.crval
+		return x/self.cdelt+self.crpix-1.0
+	def reversed(self):
+		#The last pixel becomes the reference pixel
+		last=float(self.wave(self.npix-1))
+		cdelt=-self.cdelt
+		if self.mode=='log10': last=math.log10(last)
+		#In 'ln' mode the step is relative to the reference wavelength (CRVAL)
+		if self.mode=='ln': cdelt=-self.cdelt*last/self.crval
+		rev=WaveSolution(self.npix,last,cdelt,1.0,self.mode)
+		#Check the reversed solution against this one (first, middle and last pixels)
+		pix=np.array([0,self.npix//2,self.npix-1])
+		if not np.allclose(rev.wave(self.npix-1-pix),self.wave(pix),rtol=1e-10,atol=0):
+			raise ValueError('WaveSolution.reversed() does not match the wavelength solution')
+		return rev
+	def searchsorted(self,wvl,side='left'):
+		wvl=np.asarray(wvl,dtype=float)
+		ind=np.clip(np.ceil(self.pixel(wvl)),0,self.npix).astype(int)
+		#Fix any rounding error in the analytic pixel position by checking the
+		#wavelength of the pixels either side of IND
+		if side=='left':
+			low=(ind>0)&(self.wave(ind-1)>=wvl)
+			high=(ind<self.npix)&(self.wave(ind)<wvl)
+		else:
+			low=(ind>0)&(self.wave(ind-1)>wvl)
+			high=(ind<self.npix)&(self.wave(ind)<=wvl)
+		ind=ind-low+high
+		if ind.ndim==0: return int(ind)
+		return ind
+	def min(self):
+		return float(min(self.wave(0),self.wave(self.npix-1)))
+	def max(self):
+		return float(max(self.wave(0),self.wave(self.npix-1)))
+	def __len__(self):
+		return self.npix
+	def __getitem__(self,ind):
+		if isinstance(ind,slice): return self.wave(np.arange(*ind.indices(self.npix)))
+		ind=np.asarray(ind)
+		if ind.dtype==bool: ind=np.nonzero(ind)[0]
+		if np.any((ind>=self.npix)|(ind<-self.npix)): raise IndexError('WaveSolution index out of range')
+		wvl=self.wave(ind%self.npix)
+		if wvl.ndim==0: return float(wvl)
+		return wvl
+	def __array__(self,dtype=None):
+		wvl=self.wave(np.arange(self.npix))
+		if dtype is not None: return wvl.astype(dtype)
+		return wvl
+	def __iter__(self):
+		return iter(np.asarray(self))
+	#Arithmetic is done on the full array of wavelengths
+	def __add__(self,other): return np.asarray(self)+other
+	def __radd__(self,other): return other+np.asarray(self)
+	def __sub__(self,other): return np.asarray(self)-other
+	def __rsub__(self,other): return other-np.asarray(self)
+	def __mul__(self,other): return np.asarray(self)*other
+	def __rmul__(self,other): return other*np.asarray(self)
+	def __div__(self,other): return np.asarray(self)/other
+	def __rdiv__(self,other): return other/np.asarray(self)
+	__truediv__=__div__
+	__rtruediv__=__rdiv__
+
+#Data types of the FITS BITPIX values
+fitsbitpix={8:'u1',16:'>i2',32:'>i4',64:'>i8',-32:'>f4',-64:'>f8'}
+#Data types of the FITS binary table TFORM codes
+fitstform={'L':'i1','B':'u1','I':'>i2','J':'>i4','K':'>i8','E':'>f4','D':'>f8','C':'>c8','M':'>c16'}
+#Column names (uppercase) of the wavelength and flux in FITS binary table spectra
+fitswavecols=['WAVE','WAVELENGTH','LAMBDA','LAM','WAV','LOGLAM']
+fitsfluxcols=['FLUX','SPEC','SPECTRUM','FLUX_NORM','NORMFLUX','FNORM']
+#Conversion of the FITS CUNIT1 to Angstroms
+fitsunits={'ANGSTROM':1.0,'ANGSTROMS':1.0,'A':1.0,'NM':10.0,'UM':1.0E4,'M':1.0E10}
+
+def IsFits(infile):
+	""" 
+	ISFITS checks if a file is a FITS file (by checking the first FITS header card).
+
+	Call - OUTPUT=IsFits(INFILE)
+
+	"""
+	f=open(infile,'rb')
+	card=f.read(30)
+	f.close()
+	return len(card)>=30 and card.startswith('SIMPLE  =') and card[29]=='T'
+def ReadFitsHeader(f):
+	""" 
+	READFITSHEADER reads the next FITS header from an open FITS file F.
+
+	Call - HEADER=ReadFitsHeader(F)
+
+	OUTPUT:
+		HEADER - A dictionary of the header keywords and their (int, float, bool or string)
+			values, or None if the end of the file was reached.
+
+	"""
+	header={}
+	while True:
+		block=f.read(2880)
+		if len(block)<2880: return None
+		for ii in range(0,2880,80):
+			card=block[ii:ii+80]
+			key=card[:8].strip()
+			if key=='END': return header
+			#Only keep the cards with values (e.g. not COMMENT/HISTORY)
+			if card[8:10]!='= ': continue
+			val=card[10:].strip()
+			if val.startswith("'"):
+				#String values are in quotes ('' is an escaped quote)
+				end=val.find("'",1)
+				while end>0 and val[end:end+2]=="''": end=val.find("'",end+2)
+				val=val[1:end].replace("''","'").rstrip()
+			else:
+				if '/' in val: val=val[:val.index('/')].strip()
+				if val=='T': val=True
+				elif val=='F': val=False
+				elif IsFloat(val.replace('D','E')):
+					if IsFloat(val) and val.lstrip('+-').isdigit(): val=int(val)
+					else: val=float(val.replace('D','E'))
+			header[key]=val
+def ReadFitsSpec(infile):
+	""" 
+	READFITSSPEC reads a 1D FITS spectrum, memory-mapping the flux.
+
+	Call - WVLNGTH,SPECTRUM=ReadFitsSpec(INFILE)
+
+	INPUTS:
+		INFILE - The FITS spectrum file (uncompressed). The spectrum is taken from the
+			first HDU with data that is either:
+			-An image (the flux). If the image has more than one dimension, the first
+				row is used (e.g. the flux band of IRAF multispec files). The wavelength
+				comes from the CRVAL1, CDELT1 (or CD1_1) and CRPIX1 keywords, and is
+				log-linear if DC-FLAG=1 (log10) or CTYPE1 is WAVE-LOG.
+			-A binary table with wavelength and flux columns (see FITSWAVECOLS and
+				FITSFLUXCOLS). The table can have a row for each pixel, or a single
+				row with the arrays. LOGLAM columns are converted to wavelengths.
+
+	OUTPUT:
+		WVLNGTH - The wavelength of the spectrum. For images this is a WAVESOLUTION
+			(computed on demand, not stored)
+		SPECTRUM - The flux of the spectrum (a read-only NUMPY memmap)
+
+	NOTES:
+		Wavelengths are converted to Angstroms using CUNIT1 (if given).
+		Spectra with decreasing wavelength are reversed so wavelength increases.
+		No external packages or services are needed.
+
+	"""
+	f=open(infile,'rb')
+	offset=0
+	while True:
+		header=ReadFitsHeader(f)
+		if header is None:
+			f.close()
+			raise ValueError('%s: no 1D spectrum found in FITS file'%infile)
+		offset=f.tell()
+		naxis=[header.get('NAXIS%i'%(ii+1),0) for ii in range(header.get('NAXIS',0))]
+		bitpix=header.get('BITPIX',8)
+		#Size of the data (padded to 2880 byte blocks)
+		nbytes=0
+		if len(naxis)>0: nbytes=abs(bitpix)/8*header.get('GCOUNT',1)*(int(np.prod(naxis))+header.get('PCOUNT',0))
+		nbytes=2880*((nbytes+2879)/2880)
+		xtension=header.get('XTENSION','IMAGE').strip()
+		#Image spectrum
+		if xtension=='IMAGE' and len(naxis)>0 and naxis[0]>1:
+			data=np.memmap(infile,dtype=fitsbitpix[bitpix],mode='r',offset=offset,shape=tuple(naxis[::-1]))
+			spectrum=data.reshape(-1,naxis[0])[0]
+			if header.get('BSCALE',1)!=1 or header.get('BZERO',0)!=0:
+				spectrum=spectrum*header.get('BSCALE',1)+header.get('BZERO',0)
+			if 'CRVAL1' not in header:
+				f.close()
+				raise ValueError('%s: no wavelength solution (CRVAL1) in FITS header'%infile)
+			cdelt=header.get('CDELT1',header.get('CD1_1',1.0))
+			mode='linear'
+			if header.get('DC-FLAG',0)==1: mode='log10'
+			elif 'LOG' in str(header.get('CTYPE1','')).upper(): mode='ln'
+			crval=header['CRVAL1']
+			scale=fitsunits.get(str(header.get('CUNIT1','Angstrom')).strip().upper(),1.0)
+			if mode=='log10': crval=crval+math.log10(scale)
+			else:
+				crval=crval*scale
+				cdelt=cdelt*scale
+			wvlngth=WaveSolution(naxis[0],crval,cdelt,header.get('CRPIX1',1.0),mode)
+			if cdelt<0:
+				wvlngth=wvlngth.reversed()
+				spectrum=spectrum[::-1]
+			break
+		#Binary table spectrum
+		if xtension=='BINTABLE' and len(naxis)==2:
+			names=[]
+			dtypes=[]
+			for ii in range(header.get('TFIELDS',0)):
+				name=str(header.get('TTYPE%i'%(ii+1),'COL%i'%(ii+1))).strip()
+				tform=str(header['TFORM%i'%(ii+1)]).strip()
+				#TFORM is [REPEAT]CODE (followed by e.g. '(MAXLEN)' for variable-length arrays)
+				match=re.match(r'^(\d*)([A-Z])',tform)
+				if match is None: raise ValueError('Unknown FITS column format TFORM%i=%s'%(ii+1,tform))
+				rep,code=match.groups()
+				rep=int(rep) if rep else 1
+				if code=='A': dtype='S%i'%rep
+				elif code in fitstform and rep!=1: dtype=(fitstform[code],(rep,))
+				elif code in fitstform: dtype=fitstform[code]
+				#Bits and variable-length arrays are just kept as raw bytes
+				elif code=='X': dtype='V%i'%((rep+7)/8)
+				else: dtype='V%i'%(rep*{'P':8,'Q':16}[code])
+				if rep==0: continue
+				names.append(name.upper())
+				dtypes.append((name.upper(),dtype))
+			wcol=[name for name in fitswavecols if name in names]
+			fcol=[name for name in fitsfluxcols if name in names]
+			if len(wcol)>0 and len(fcol)>0:
+				data=np.memmap(infile,dtype=np.dtype(dtypes),mode='r',offset=offset,shape=(naxis[1],))
+				wvlngth=data[wcol[0]]
+				spectrum=data[fcol[0]]
+				#A single row containing the arrays
+				if naxis[1]==1 and wvlngth.ndim>1:
+					wvlngth=wvlngth[0]
+					spectrum=spectrum[0]
+				if wcol[0]=='LOGLAM': wvlngth=10.0**wvlngth
+				scale=fitsunits.get(str(header.get('TUNIT%i'%(names.index(wcol[0])+1),'Angstrom')).strip().upper(),1.0)
+				if scale!=1.0: wvlngth=wvlngth*scale
+				wvlngth,spectrum=SortSpec(wvlngth,spectrum)
+				break
+		f.seek(offset+nbytes)
+	f.close()
+	return wvlngth,spectrum
+
+def ReadSpec(infile):
+	""" 
+	READSPEC reads the input spectrum file (without any caching; see SPECFITS)
+	Binary spectra (see WRITEBINSPEC) are memory-mapped, FITS spectra are read with
+	READFITSSPEC, and anything else is read as ASCII. The spectrum is always
+	returned in order of increasing wavelength (see SORTSPEC).
+
+	Call - WVLNGTH,SPECTRUM=ReadSpec(INFILE)
+
+	"""
+	if infile.endswith(binspecext) or IsBinSpec(infile):
+		return ReadBinSpec(infile)
+	if IsFits(infile):
+		return ReadFitsSpec(infile)
+	return SortSpec(*ReadAsciiSpec(infile))
+def OpenSpecFile(infile):
+	""" 
+	OPENSPECFILE opens a (possibly compressed) ASCII file for reading. Files compressed
+	with gzip, bzip2 or xz are detected by their magic bytes and decompressed on the fly.
+
+	Call - F=OpenSpecFile(INFILE)
+
+	NOTES:
+		xz compressed files need the LZMA module (standard library in Python 3,
+		backports.lzma for Python 2.7). An IOError is raised if it is not available.
+
+	"""
+	f=open(infile,'rb')
+	magic=f.read(6)
+	f.close()
+	if magic.startswith('\x1f\x8b'): return gzip.open(infile,'rb')
+	if magic.startswith('BZh'): return bz2.BZ2File(infile,'rb')
+	if magic.startswith('\xfd7zXZ\x00'):
+		if lzma is None: raise IOError('Need the lzma module to read %s'%infile)
+		return lzma.open(infile,'rb')
+	return open(infile,'rb')
+def ReadAsciiSpec(infile,usecols=(0,1),chunkbytes=2**22):
+	""" 
+	READASCIISPEC parses the input spectrum ASCII file (see SPECFITS for format)
+
+	Call - WVLNGTH,SPECTRUM=ReadAsciiSpec(INFILE)
+		or COLUMNS=ReadAsciiSpec(INFILE,USECOLS=(...))
+
+	INPUTS:
+		INFILE - The ASCII spectrum file (can be gzip, bzip2 or xz compressed)
+		USECOLS - A tuple of the (zero-indexed) columns to read
+		CHUNKBYTES - The number of bytes to parse at a time
+
+	OUTPUT:
+		A tuple of NUMPY arrays, one for each column in USECOLS
+
+	NOTES:
+		The file is read CHUNKBYTES at a time, and only the columns in USECOLS
+		are kept. The output arrays are preallocated (based on the size of the
+		file) and grown geometrically if needed, so the whole file is never
+		held in memory as a matrix of floats.
+
+		Chunks without comments or blank lines are parsed in one go by NUMPY.
+		Otherwise the chunk is parsed line by line: anything after a '#' is
+		ignored, and a ValueError (with the line number) is raised for a line
+		that has a different number of columns to the first line of data, or
+		a value that is not a float.
+
+	"""
+	f=OpenSpecFile(infile)
+	ncol=max(usecols)+1
+	#Guess the number of lines in the file (~25 bytes per line) for the
+	#initial size of the output arrays
+	nalloc=max(1024,os.path.getsize(infile)/25)
+	out=[np.empty(nalloc) for col in usecols]
+	npix=0
+	#NTOT is the number of columns in the file (found from the first data line)
+	ntot=None
+	#Number of lines read so far (for error messages)
+	nline=0
+	#Leftover part of a line at the end of the previous chunk
+	tail=''
+	while True:
+		chunk=f.read(chunkbytes)
+		if not chunk and not tail: break
+		#Only parse complete lines, keep the rest for the next chunk
+		if chunk:
+			chunk=tail+chunk
+			cut=chunk.rfind('\n')+1
+			if cut==0:
+				tail=chunk
+				continue
+			chunk,tail=chunk[:cut],chunk[cut:]
+		else:
+			chunk,tail=tail+'\n',''
+		nlines=chunk.count('\n')
+		vals=None
+		#Fast path: a chunk with no comments is parsed in one go, as long as every
+		#line has the same number of columns as the first line of data
+		if ntot is not None and '#' not in chunk:
+			vals=np.fromstring(chunk,sep=' ')
+			if len(vals)==nlines*ntot and SameColumns(chunk,nlines,ntot): vals=vals.reshape(nlines,ntot)[:,usecols]
+			else: vals=None
+		#Slow path: go line by line, only keeping the columns in USECOLS
+		if vals is None:
+			rows=[]
+			for ii,ln in enumerate(chunk.splitlines()):
+				if '#' in ln: ln=ln[:ln.index('#')]
+				cols=ln.split()
+				if len(cols)==0: continue
+				if ntot is None: ntot=len(cols)
+				try:
+					if len(cols)!=ntot: raise ValueError
+					rows.append([float(cols[col]) for col in usecols])
+				except (IndexError,ValueError):
+					f.close()
+					raise ValueError('%s: bad spectrum line %i: %s'%(infile,nline+ii+1,ln.strip()))
+			if ntot is not None and ntot<ncol:
+				f.close()
+				raise ValueError('%s: only %i columns in spectrum'%(infile,ntot))
+			vals=np.array(rows,dtype=float).reshape(-1,len(usecols))
+		nline+=nlines
+		#Grow the output arrays if needed (doubling in size)
+		nnew=len(vals)
+		if npix+nnew>nalloc:
+			nalloc=max(2*nalloc,npix+nnew)
+			for arr in out: arr.resize(nalloc,refcheck=False)
+		for jj in range(len(usecols)): out[jj][npix:npix+nnew]=vals[:,jj]
+		npix+=nnew
+	f.close()
+	#Trim the output arrays to the number of pixels read
+	for arr in out: arr.resize(npix,refcheck=False)
+	return tuple(out)
+def SameColumns(chunk,nlines,ntot):
+	""" 
+	SAMECOLUMNS checks that every line of CHUNK (a string of NLINES complete lines)
+	has NTOT whitespace separated values, without splitting it into lines.
+
+	Call - OUTPUT=SameColumns(CHUNK,NLINES,NTOT)
+
+	"""
+	buf=np.frombuffer(chunk,dtype=np.uint8)
+	#Values start at a non-space character after a space (or at the start)
+	space=buf<=32
+	starts=np.flatnonzero(space[:-1]>space[1:])+1
+	if not space[0]: starts=np.r_[0,starts]
+	if len(starts)!=nlines*ntot: return False
+	#Each line's NTOT values must all fall between the newlines around it
+	newlines=np.flatnonzero(buf==10)
+	starts=starts.reshape(nlines,ntot)
+	return (starts[:,-1]<newlines).all() and (starts[1:,0]>newlines[:-1]).all()
+def BenchReadSpec(sizes=(10**6,10**7),maxgenfromtxt=10**7,ncol=4):
+	""" 
+	BENCHREADSPEC times READASCIISPEC against the original NUMPY.GENFROMTXT reader
+	on synthetic spectra, and prints the results to screen.
+
+	Call - BenchReadSpec(SIZES=(10**6,10**7),MAXGENFROMTXT=10**7,NCOL=4)
+
+	INPUTS:
+		SIZES - A list of the number of lines in each synthetic spectrum
+		MAXGENFROMTXT - GENFROMTXT is only timed for spectra up to this many lines
+			(it needs several times the file size in memory)
+		NCOL - The number of columns in the synthetic spectra
+
+	NOTES:
+		Run from the command line with:
+			tb_linefinder.py --bench-readspec [NLINES ...]
+		The synthetic spectra are written to (and removed from) the temporary directory.
+		A 10**8 line spectrum needs ~5 GB of disk space.
+
+	"""
+	print "%12s %14s %14s %10s"%('Lines','genfromtxt(s)','ReadAscii(s)','Speed-up')
+	for nlines in sizes:
+		fd,tmpfile=tempfile.mkstemp(suffix='.ascii')
+		f=os.fdopen(fd,'w')
+		f.write('#Synthetic spectrum for BenchReadSpec\n')
+		#Write the file in blocks of 10**6 lines
+		for start in range(0,nlines,10**6):
+			nn=min(10**6,nlines-start)
+			block=np.empty((nn,ncol))
+			block[:,0]=3000.0+0.01*np.arange(start,start+nn)
+			block[:,1:]=np.random.normal(1.0,0.05,(nn,ncol-1))
+			np.savetxt(f,block,fmt='%.6f')
+		f.close()
+		t0=time.time()
+		ReadAsciiSpec(tmpfile)
+		tnew=time.time()-t0
+		told=float('nan')
+		if nlines<=maxgenfromtxt:
+			t0=time.time()
+			data=np.genfromtxt(tmpfile,dtype=type(0.00),comments='#')
+			told=time.time()-t0
+			del data
+		os.remove(tmpfile)
+		print "%12i %14.2f %14.2f %10.1f"%(nlines,told,tnew,told/tnew)
+	return
+def BenchLoadLog(sizes=(10**3,10**4,10**5,10**6),maxgenfromtxt=10**5):
+	""" 
+	BENCHLOADLOG times LOADLOG against the original NUMPY.GENFROMTXT log reader
+	on synthetic logfiles, and prints the results to screen.
+
+	Call - BenchLoadLog(SIZES=(10**3,10**4,10**5,10**6),MAXGENFROMTXT=10**5)
+
+	INPUTS:
+		SIZES - A list of the number of entries in each synthetic log
+		MAXGENFROMTXT - The original reader is only timed for logs up to this many
+			entries (its list-membership checks make it very slow for large logs)
+
+	NOTES:
+		Run from the command line with:
+			tb_linefinder.py --bench-loadlog [NROWS ...]
+		The synthetic logs are written to (and removed from) the temporary directory.
+
+	"""
+	#The ions/lines of the synthetic logs
+	ionlines=[('HI','1215'),('HI','1025'),('CIV','1548'),('CIV','1550'),('SiIV','1393'),('SiIV','1402'),\
+		('MgII','2796'),('MgII','2803'),('FeII','1608'),('OVI','1031')]
+	print "%12s %14s %14s %10s"%('Rows','genfromtxt(s)','LoadLog(s)','Speed-up')
+	for nrows in sizes:
+		fd,tmpfile=tempfile.mkstemp(suffix='.log')
+		f=os.fdopen(fd,'w')
+		f.write('#!Line List: lls.lst\n#!Spectrum: synthetic\n')
+		for ii in range(nrows):
+			ion,line=ionlines[ii%len(ionlines)]
+			f.write('%.5f;\t%s;\t%s;\t1;\t-50;\t50;\t;\tk;\n'%(0.00001*(ii//len(ionlines)),ion,line))
+		f.close()
+		t0=time.time()
+		LoadLog(tmpfile)
+		tnew=time.time()-t0
+		told=float('nan')
+		if nrows<=maxgenfromtxt:
+			t0=time.time()
+			#The original reader (genfromtxt, with list-membership checks of each row)
+			data=np.genfromtxt(tmpfile,delimiter=';',dtype=type('str'),comments='#')
+			log={'zs':[],'ions':[],'lines':{}}
+			for ii in range(len(data)):
+				z,ion,line=data[ii][0].strip(),data[ii][1].strip(),data[ii][2].strip()
+				if z not in log['zs']: log['zs'].append(z)
+				if ion not in log['ions']:
+					log['ions'].append(ion)
+					log['lines'][ion]=[]
+				if line not in log['lines'][ion]: log['lines'][ion].append(line)
+				log[z,ion,line,'flag']=data[ii][3].strip()
+				log[z,ion,line,'vel']=data[ii][4].strip(), data[ii][5].strip()
+				log[z,ion,line]=data[ii][6].strip()
+				log[z,ion,line,'colour']=data[ii][7].strip()
+			told=time.time()-t0
+			del data,log
+		os.remove(tmpfile)
+		print "%12i %14.2f %14.2f %10.1f"%(nrows,told,tnew,told/tnew)
+	return
 def specfits(infile):	
 	""" 
 	SPECFITS reads the input spectrum ASCII file and returns the data in two NUMPY arrays
@@ -196,9 +1286,13 @@ def specfits(infile):
 			Any additional columns after first two are ignored.
 			MUST CONTAIN THE SAME NUMBER OF COLUMNS IN EACH LINE (unless commented)
 			Can use '#' at the start of any line to remove comment
+			INFILE can also be a binary spectrum (see WRITEBINSPEC/CONVERTSPEC),
+			which is memory-mapped rather than read, or a 1D FITS spectrum
+			(see READFITSSPEC).
 
 	OUTPUT VARIABLES:
 		WVLNGTH - A NUMPY array with the wavelength (first column) of the input spectrum
+			(or a WAVESOLUTION for FITS images, computed from the header on demand)
 		SPECTRUM - A NUMPY array with the flux (second column) of the input spectrum
 
 
@@ -207,16 +1301,16 @@ def specfits(infile):
 		will be NUMPY arrays full of zeros. A warning will be printed
 		to the screen.
 
+		The spectrum is only parsed once per session, and is kept in
+		SPECCACHE (see SPECCACHE class). WVLNGTH and SPECTRUM are read-only
+		views of the cached arrays. Call SPECCACHE.INVALIDATE(INFILE) to
+		force the file to be re-read.
+
 	"""
 	#Check to see if file exists
 	if os.path.isfile(infile):
-		#REad spectrum file. All values must be floats
-		#Will ignore lines with '#' flag
-		#First column must be wavelength
-		#Second column must be flux
-		data=np.genfromtxt(infile,dtype=type(0.00),comments='#')
-		wvlngth=data[:,0]
-		spectrum=data[:,1]
+		#Get the spectrum from the cache (parses the file if necessary)
+		wvlngth,spectrum=speccache.get(infile,ReadSpec)
 		#Return spectrum data
 		return wvlngth,spectrum
 	#If file doesn't exist
@@ -228,6 +1322,39 @@ def specfits(infile):
 
 
 
+def ReadSpecError(infile):
+	""" 
+	READSPECERROR reads the (1 sigma) error of a spectrum file, if it has one
+	(without any caching; see SPECERROR).
+
+	Call - ERROR=ReadSpecError(INFILE)
+
+	NOTES:
+		The error is the third column of ASCII spectra, or the 'error' column of binary
+		spectra (see CONVERTSPEC). FITS spectra are read without an error.
+		Returns None if INFILE has no error.
+
+	"""
+	if infile.endswith(binspecext) or IsBinSpec(infile):
+		return ReadBinSpec(infile,column='error')
+	if IsFits(infile): return None
+	try:
+		wvlngth,error=SortSpec(*ReadAsciiSpec(infile,usecols=(0,2)))
+	except ValueError:
+		return None
+	return error
+def SpecError(infile):
+	""" 
+	SPECERROR returns the (1 sigma) error of a spectrum file (see READSPECERROR), or
+	None if it has no error. It is read once, and kept with the spectrum in SPECCACHE.
+
+	Call - ERROR=SpecError(INFILE)
+
+	"""
+	specfits(infile)
+	derived=speccache.derived(infile)
+	if 'error' not in derived: derived['error']=ReadSpecError(infile)
+	return derived['error']
 def IsFloat(str):
 	""" 
 	ISFLOAT checks if a given string is a float.
@@ -251,65 +1378,846 @@ def IsFloat(str):
 	return True
 
 
-def WriteLog(log,logfile,llistfile,fits):
+class LogStore:
+	""" 
+	CLASS LOGSTORE - The in-memory store of the log. Each entry (keyed by Z,ION,LINE) is a
+		row of columnar arrays, with hash indexes by redshift, ion and (ion,line), so
+		adding, changing, finding or removing an entry takes constant time.
+
+		LOGSTORE can be used in place of the original log dictionary (see LOADLOG),
+		i.e. LOG[Z,ION,LINE], LOG[Z,ION,LINE,'flag'], LOG[Z,ION,LINE,'vel'],
+		LOG[Z,ION,LINE,'colour'], (Z,ION,LINE) in LOG, LOG.POP(KEY,DEFAULT), and
+		LOG['zs'], LOG['ions'], LOG['lines'][ION] all work as before.
+
+	Call - LOG=LogStore()
+
+	ATTRIBUTES:
+		LOG.SLOTS - Dictionary of the row of each entry (keyed by (Z,ION,LINE))
+		LOG.Z, LOG.ION, LOG.LINE, LOG.FLAG, LOG.VMIN, LOG.VMAX, LOG.NOTES, LOG.COLOUR -
+			The string columns of the log (lists, indexed by row)
+		LOG.ZF, LOG.FLAGI, LOG.VMINF, LOG.VMAXF - NUMPY arrays of the numerical
+			values of Z, FLAG, VMIN and VMAX (indexed by row, NaN/-1 if not a number)
+		LOG.ALIVE - NUMPY boolean array of which rows are in use
+		LOG.BYZ, LOG.BYION, LOG.BYIONLINE - The indexes (dictionaries of the entries)
+			for each Z, ION and (ION,LINE)
+		LOG.RANK - Dictionary of the order each Z, ION and (ION,LINE) was first added in
+		LOG.SET(Z,ION,LINE,FLAG=None,VEL=None,NOTES=None,COLOUR=None) - Adds/changes an entry
+		LOG.EXTEND(ROWS) - Adds/changes many entries at once, given a list of
+			(Z,ION,LINE,FLAG,VMIN,VMAX,NOTES,COLOUR) tuples (much faster than SET)
+		LOG.REMOVE(Z,ION,LINE) - Removes an entry
+		LOG.REMOVESYSTEM(Z) - Removes every entry at redshift Z (returns the removed keys)
+		LOG.KEYS(Z=None,ION=None,LINE=None) - The list of entries (all, or only those with
+			the given Z, ION, and/or LINE), ordered by redshift, then ion, then line
+			(in the order each was first added)
+		LOG.ARRAYS() - Dictionary of the columns (as NUMPY arrays) of every entry, in LOG.KEYS() order
+		LOG.WATCH(NAME) - Starts recording which entries change for the consumer NAME
+		LOG.TAKE(NAME) - Returns (and clears) the set of entries changed since the last
+			TAKE for NAME
+		LOG.UNTAKE(NAME,CHANGED) - Gives back the entries taken by TAKE (e.g. if saving them failed)
+		LOG.ROWS(KEYS=None) - List of the (Z,ION,LINE,FLAG,VMIN,VMAX,NOTES,COLOUR) of every
+			entry (or of KEYS) in LOG.KEYS() order. Safe to call from another thread
+		LOG.LOCK - Lock held while the log is changed (hold it to read the log from another thread)
+		LOG.LISTENERS - List of functions called after every change to the log
+		LOG.META - Ordered dictionary of the '#!' header information of the logfile
+			(e.g. LOG.META['Line List'], LOG.META['Spectrum'])
+		LOG.BACKEND - The SQLITELOG the log was loaded from (None for a text logfile)
+		LOG.COMMIT() - Saves the changed entries to LOG.BACKEND (if any) in one transaction
+
+	NOTES:
+		New entries are given the defaults FLAG='0', VEL=('-50','50'), NOTES='' and COLOUR='k'.
+		Removed rows are reused by later entries.
+
+	"""
+	#Default values of a new entry
+	defaults={'flag':'0','vel':('-50','50'),'notes':'','colour':'k'}
+	def __init__(self):
+		self.slots={}
+		self.free=[]
+		self.z=[]
+		self.ion=[]
+		self.line=[]
+		self.flag=[]
+		self.vmin=[]
+		self.vmax=[]
+		self.notes=[]
+		self.colour=[]
+		self.zf=np.zeros(0)
+		self.flagi=np.zeros(0,dtype=int)
+		self.vminf=np.zeros(0)
+		self.vmaxf=np.zeros(0)
+		self.alive=np.zeros(0,dtype=bool)
+		self.byz={}
+		self.byion={}
+		self.byionline={}
+		#Order each redshift, ion and (ion,line) was first added in (one map per
+		#index, so a redshift string can not clash with an ion name)
+		self.zrank={}
+		self.ionrank={}
+		self.linerank={}
+		self.nrank=0
+		#Header information from the logfile (e.g. 'Line List', 'Spectrum')
+		self.meta=OrderedDict()
+		#Sets of changed entries for each consumer (see WATCH/TAKE)
+		self.changes={}
+		#The database the log is kept in (if any, see SQLITELOG)
+		self.backend=None
+		#Functions called (with no arguments) after every change (see AUTOSAVER)
+		self.listeners=[]
+		#Held while changing the log (and while reading it from other threads)
+		self.lock=threading.RLock()
+	#Number of entries
+	def __len__(self):
+		return len(self.slots)
+	#Convert a string to a float/int (NaN/-1 if not a number)
+	def _float(self,val):
+		if IsFloat(val): return float(val)
+		return np.nan
+	def _int(self,val):
+		if IsFloat(val): return int(float(val))
+		return -1
+	#The same for a list of strings
+	def _floats(self,vals):
+		try:
+			return np.array(vals,dtype=float)
+		except ValueError:
+			return np.array([self._float(val) for val in vals])
+	def _ints(self,vals):
+		try:
+			return np.array(vals,dtype=float).astype(int)
+		except ValueError:
+			return np.array([self._int(val) for val in vals],dtype=int)
+	#Record a changed entry for every consumer
+	def _changed(self,key):
+		for name in self.changes: self.changes[name].add(key)
+	def watch(self,name):
+		self.changes[name]=set()
+	def take(self,name):
+		with self.lock:
+			changed=self.changes[name]
+			self.changes[name]=set()
+		return changed
+	#Give back changes that were taken but not saved
+	def untake(self,name,changed):
+		with self.lock: self.changes[name].update(changed)
+	def commit(self):
+		if self.backend is not None: self.backend.save(self)
+		return
+	#Make a new row for an entry
+	def _insert(self,key):
+		z,ion,line=key
+		if len(self.free)>0:
+			row=self.free.pop()
+		else:
+			row=len(self.z)
+			for col in [self.z,self.ion,self.line,self.flag,self.vmin,self.vmax,self.notes,self.colour]: col.append(None)
+			#Grow the NUMPY columns (doubling in size)
+			if row>=len(self.alive):
+				nalloc=max(2*len(self.alive),16)
+				for name in ['zf','flagi','vminf','vmaxf','alive']:
+					arr=getattr(self,name)
+					new=np.zeros(nalloc,dtype=arr.dtype)
+					new[:len(arr)]=arr
+					setattr(self,name,new)
+		self.slots[key]=row
+		self.z[row]=z
+		self.ion[row]=ion
+		self.line[row]=line
+		self.zf[row]=self._float(z)
+		self.alive[row]=True
+		self._index(key)
+		self._setrow(row,self.defaults['flag'],self.defaults['vel'],self.defaults['notes'],self.defaults['colour'])
+		return row
+	#Add an entry to the indexes
+	def _index(self,key):
+		z,ion,line=key
+		for index,rank,ikey in [(self.byz,self.zrank,z),(self.byion,self.ionrank,ion),(self.byionline,self.linerank,(ion,line))]:
+			if ikey not in index:
+				index[ikey]={}
+				rank[ikey]=self.nrank
+				self.nrank+=1
+			index[ikey][key]=None
+	def _setrow(self,row,flag=None,vel=None,notes=None,colour=None):
+		if flag is not None:
+			self.flag[row]=flag
+			self.flagi[row]=self._int(flag)
+		if vel is not None:
+			self.vmin[row],self.vmax[row]=vel
+			self.vminf[row]=self._float(vel[0])
+			self.vmaxf[row]=self._float(vel[1])
+		if notes is not None: self.notes[row]=notes
+		if colour is not None: self.colour[row]=colour
+	#Tell the listeners the log has changed
+	def _notify(self):
+		for listener in self.listeners: listener()
+	def set(self,z,ion,line,flag=None,vel=None,notes=None,colour=None):
+		key=(z,ion,line)
+		with self.lock:
+			row=self.slots.get(key)
+			if row is None: row=self._insert(key)
+			self._setrow(row,flag,vel,notes,colour)
+			self._changed(key)
+		self._notify()
+		return
+	def remove(self,z,ion,line):
+		key=(z,ion,line)
+		with self.lock:
+			row=self.slots.pop(key,None)
+			if row is None: return False
+			self.alive[row]=False
+			self.free.append(row)
+			#Remove from the indexes (and any index that is now empty)
+			for index,rank,ikey in [(self.byz,self.zrank,z),(self.byion,self.ionrank,ion),(self.byionline,self.linerank,(ion,line))]:
+				del index[ikey][key]
+				if len(index[ikey])==0:
+					del index[ikey]
+					del rank[ikey]
+			self._changed(key)
+		self._notify()
+		return True
+	def removesystem(self,z):
+		keys=self.keys(z=z)
+		for key in keys: self.remove(*key)
+		return keys
+	def keys(self,z=None,ion=None,line=None):
+		#Candidate entries from the smallest applicable index
+		if ion is not None and line is not None: keys=list(self.byionline.get((ion,line),[]))
+		elif z is not None: keys=list(self.byz.get(z,[]))
+		elif ion is not None: keys=list(self.byion.get(ion,[]))
+		else: keys=list(self.slots)
+		keys=[key for key in keys if (z is None or key[0]==z) and (ion is None or key[1]==ion) and (line is None or key[2]==line)]
+		#Order by redshift, ion, then line (in the order they were first added)
+		zrank,ionrank,linerank=self.zrank,self.ionrank,self.linerank
+		keys.sort(key=lambda key:(zrank[key[0]],ionrank[key[1]],linerank[key[1],key[2]]))
+		return keys
+	def extend(self,rows):
+		with self.lock: self._extend(rows)
+		self._notify()
+		return
+	def _extend(self,rows):
+		#New entries first fill the rows freed by REMOVE, then are appended to the
+		#string columns. The NUMPY columns are converted all at once at the end
+		row0=len(self.z)
+		slots=self.slots
+		changed=[]
+		reused=[]
+		new=set()
+		for z,ion,line,flag,vmin,vmax,notes,colour in rows:
+			key=(z,ion,line)
+			changed.append(key)
+			row=slots.get(key)
+			if row is not None and row not in new:
+				#Entries all ready in LOG are changed as in SET
+				self._setrow(row,flag,(vmin,vmax),notes,colour)
+				continue
+			if row is None:
+				if len(self.free)>0:
+					row=self.free.pop()
+					reused.append(row)
+					self.z[row],self.ion[row],self.line[row]=z,ion,line
+					self.flag[row],self.vmin[row],self.vmax[row],self.notes[row],self.colour[row]=flag,vmin,vmax,notes,colour
+				else:
+					row=len(self.z)
+					for col,val in [(self.z,z),(self.ion,ion),(self.line,line),(self.flag,flag),\
+						(self.vmin,vmin),(self.vmax,vmax),(self.notes,notes),(self.colour,colour)]: col.append(val)
+				slots[key]=row
+				new.add(row)
+				self._index(key)
+			else:
+				#An entry repeated within ROWS (the last one is kept)
+				self.flag[row],self.vmin[row],self.vmax[row],self.notes[row],self.colour[row]=flag,vmin,vmax,notes,colour
+		#Grow the NUMPY columns to fit the new rows
+		nrow=len(self.z)
+		if nrow>len(self.alive):
+			nalloc=max(2*len(self.alive),nrow,16)
+			for name in ['zf','flagi','vminf','vmaxf','alive']:
+				arr=getattr(self,name)
+				new=np.zeros(nalloc,dtype=arr.dtype)
+				new[:len(arr)]=arr
+				setattr(self,name,new)
+		self.zf[row0:nrow]=self._floats(self.z[row0:nrow])
+		self.flagi[row0:nrow]=self._ints(self.flag[row0:nrow])
+		self.vminf[row0:nrow]=self._floats(self.vmin[row0:nrow])
+		self.vmaxf[row0:nrow]=self._floats(self.vmax[row0:nrow])
+		self.alive[row0:nrow]=True
+		#The reused rows (few, so converted one at a time)
+		for row in reused:
+			self.zf[row]=self._float(self.z[row])
+			self.flagi[row]=self._int(self.flag[row])
+			self.vminf[row]=self._float(self.vmin[row])
+			self.vmaxf[row]=self._float(self.vmax[row])
+			self.alive[row]=True
+		for name in self.changes: self.changes[name].update(changed)
+		return
+	def rows(self,keys=None):
+		with self.lock:
+			if keys is None: keys=self.keys()
+			rows=[]
+			for key in keys:
+				row=self.slots[key]
+				rows.append(key+(self.flag[row],self.vmin[row],self.vmax[row],self.notes[row],self.colour[row]))
+		return rows
+	def arrays(self):
+		keys=self.keys()
+		rows=np.array([self.slots[key] for key in keys],dtype=int)
+		out={'keys':keys}
+		for name in ['z','ion','line','flag','vmin','vmax','notes','colour']:
+			col=getattr(self,name)
+			out[name]=[col[row] for row in rows]
+		for name in ['zf','flagi','vminf','vmaxf']: out[name]=getattr(self,name)[rows]
+		return out
+	#Compatibility with the original log dictionary
+	def __contains__(self,key):
+		if key in ['zs','ions','lines']: return True
+		if isinstance(key,tuple) and len(key)==3: return key in self.slots
+		if isinstance(key,tuple) and len(key)==4: return key[:3] in self.slots and key[3] in ['flag','vel','colour']
+		return False
+	def __getitem__(self,key):
+		if key=='zs': return sorted(self.byz,key=self.zrank.get)
+		if key=='ions': return sorted(self.byion,key=self.ionrank.get)
+		if key=='lines':
+			lines=OrderedDict((ion,[]) for ion in self['ions'])
+			for ion,line in sorted(self.byionline,key=self.linerank.get): lines[ion].append(line)
+			return lines
+		row=self.slots[key[:3]]
+		if len(key)==3: return self.notes[row]
+		if key[3]=='flag': return self.flag[row]
+		if key[3]=='vel': return self.vmin[row],self.vmax[row]
+		if key[3]=='colour': return self.colour[row]
+		raise KeyError(key)
+	def __setitem__(self,key,val):
+		if len(key)==3: self.set(*key,notes=val)
+		elif key[3]=='flag': self.set(*key[:3],flag=val)
+		elif key[3]=='vel': self.set(*key[:3],vel=val)
+		elif key[3]=='colour': self.set(*key[:3],colour=val)
+		else: raise KeyError(key)
+	def pop(self,key,default=None):
+		if key not in self: return default
+		val=self[key]
+		#Popping the (Z,ION,LINE) entry removes it. The FLAG/VEL/COLOUR go with it.
+		if len(key)==3: self.remove(*key)
+		return val
+def WriteLog(log,logfile,llistfile,fits,verbose=True):
 	""" 
 	WRITELOG writes the TB_LINEFINDER output logfile.
 	
-	call WriteLog(LOG,LOGFILE,LLISTFILE,FITS)
+	call WriteLog(LOG,LOGFILE,LLISTFILE,FITS,VERBOSE=True)
 	
 	INPUT VARIABLES:
-		LOG - A dictionary with the log information (see LOADLOG for structure)
+		LOG - The LOGSTORE with the log information (see LOADLOG for structure)
 		LOGFILE - A string with the desired filename for the output logfile
 		LLISTFILE - A string with the input linelist filename
 		FITS - A string with the input spectrum filename
+		VERBOSE - If FALSE, nothing is printed (e.g. when saving from a background thread)
 
 	NOTES:
 		If no logfile is provided, it will not save log and display warning
+
+		The log is written to a temporary file (in the same directory) which then
+		replaces LOGFILE, so a crash while writing never leaves a partial logfile.
+		The log is copied (under LOG.LOCK) before writing, so LOG can be changed by
+		another thread meanwhile.
 	
 	"""
 	#Check to see if LOGFILE string has at least one character
 	if len(logfile)>1:
-		#Open LOGFILE buffer for writing
-		f=open(logfile,'w')
+		#Copy the header, entries and summary of LOG while it can't change
+		with log.lock:
+			meta=[(name,log.meta[name]) for name in log.meta]
+			rows=log.rows()
+			summary=LogSummary(log)
+		#Open a temporary file buffer for writing (renamed to LOGFILE once complete)
+		fd,tmpfile=tempfile.mkstemp(prefix=os.path.basename(logfile)+'.',suffix='.tmp',\
+			dir=os.path.dirname(os.path.abspath(logfile)))
+		f=os.fdopen(fd,'w')
 		#Write the input files used to generate TB_LINEFINDER logfile
 		f.write('#!Line List: %s\n'%llistfile)
 		f.write('#!Spectrum: %s\n'%fits)
+		#Keep any other header information the log was loaded with
+		for name,val in meta:
+			if name not in ['Line List','Spectrum']: f.write('#!%s: %s\n'%(name,val))
 		#Write column labels for user reference
 		f.write('#z;\t\tIon;\tline;\tflag;\tvmin;\tvmax;\tNotes;\tcolour\n')
 
-		#Loop through the LOG dictionary (redshift, ion/species, line identifier)
-		for z in log['zs']:
-			for ion in log['ions']:
-				for line in log['lines'][ion]:
-					#check if entry (keyed by z,ion,line) exists in log
-					if (z,ion,line) in log:
-						#If so, write to log file in format:
-						#Z; ION; LINE; FLAG; VMIN; VMAX; NOTES; COLOUR;
-						f.write('%s;\t'%z)
-						f.write('%s;\t'%ion)
-						f.write('%s;\t'%line)
-						f.write('%s;\t'%log[z,ion,line,'flag'])
-						f.write('%s;\t%s;\t'%log[z,ion,line,'vel'])
-						f.write('%s;\t'%log[z,ion,line])
-						f.write('%s;\n'%log[z,ion,line,'colour'])
-		#close Logfile writing buffer
+		#Loop through the LOG entries (by redshift, ion/species, line identifier)
+		for row in rows:
+			#Write to log file in format:
+			#Z; ION; LINE; FLAG; VMIN; VMAX; NOTES; COLOUR;
+			f.write('%s;\t%s;\t%s;\t%s;\t%s;\t%s;\t%s;\t%s;\n'%row)
+		#Make sure the log is on disk before replacing LOGFILE, and close buffer
+		f.flush()
+		os.fsync(f.fileno())
 		f.close()
-		#Print stuff informing user of WRITELOG's success (including contents
-		#of file
-		print "Wrote logfile: %s"%logfile
-		print "Contents:\n"
-		print "***********\n"
-		os.system('cat %s'%logfile)
-		print "\n***********"
+		ReplaceFile(tmpfile,logfile)
+		#Inform user of WRITELOG's success
+		if verbose: print "Wrote logfile: %s"%logfile
+		if verbose and logsummary: print summary
 	#If LOGFILE doesn't have a single character, cannot save. Print Warning
-	else: print "No log file provided. Did not Save."
-def LoadLog(logfile):
+	elif verbose: print "No log file provided. Did not Save."
+def ReplaceFile(tmpfile,outfile):
+	"""
+	REPLACEFILE renames TMPFILE to OUTFILE (replacing OUTFILE if it exists).
+
+	Call: ReplaceFile(TMPFILE,OUTFILE)
+
+	NOTES:
+		On POSIX systems the rename is atomic, i.e. OUTFILE is always either the old or
+		the new file. Windows cannot rename over an existing file, so OUTFILE is removed first.
+		TMPFILE is given the permissions of OUTFILE (or, for a new file, the default
+		permissions from the umask), as TEMPFILE.MKSTEMP makes it readable only by the user.
+	"""
+	if os.path.isfile(outfile): shutil.copymode(outfile,tmpfile)
+	else:
+		umask=os.umask(0)
+		os.umask(umask)
+		os.chmod(tmpfile,0666&~umask)
+	try:
+		os.rename(tmpfile,outfile)
+	except OSError:
+		if not os.path.isfile(outfile): raise
+		os.remove(outfile)
+		os.rename(tmpfile,outfile)
+	return
+def LogSummary(log):
+	"""
+	LOGSUMMARY returns a short (one line) summary of the LOG (see LOADLOG).
+
+	Call: summary=LogSummary(LOG)
+	"""
+	#(Under LOG.LOCK, as the log may be changed by another thread)
+	with log.lock:
+		return "Log: %d lines in %d systems (%d ions)"%(len(log),len(log['zs']),len(log['ions']))
+class LogJournal:
+	"""
+	CLASS LOGJOURNAL - Saves the changes to a log by appending them to a journal
+		(LOGFILE+'.journal'), rather than rewriting the whole logfile. The journal
+		is replayed by LOADLOG, and is folded back into the logfile by LJ.COMPACT().
+
+	Call - LJ=LogJournal(LOG,LOGFILE,LLISTFILE,FITS)
+
+	INPUTS:
+		LOG - The LOGSTORE to journal (see LOADLOG)
+		LOGFILE - A string with the filename of the logfile
+		LLISTFILE - A string with the input linelist filename (for compacting)
+		FITS - A string with the input spectrum filename (for compacting)
+
+	ATTRIBUTES:
+		LJ.JOURNALFILE - The filename of the journal
+		LJ.SEQ - The sequence number of the last record in the journal
+		LJ.SYNC(VERBOSE=True) - Appends a record of every LOG entry changed since the last
+			SYNC/COMPACT to the journal (returns the number of records written)
+		LJ.COMPACT(VERBOSE=True) - Rewrites LOGFILE with the full log (see WRITELOG), and
+			removes the journal
+
+	NOTES:
+		Each record of the journal is a line in the format (semicolon delimited):
+			SEQ; OP; Z; ION; LINE; FLAG; VMIN; VMAX; NOTES; COLOUR;
+		where SEQ is the sequence number of the record, and OP is either 'set' (the
+		entry was added/changed, and has the values given) or 'del' (the entry was removed).
+		The journal is flushed to disk after every SYNC.
+		SYNC and COMPACT can be called from any thread (with VERBOSE=FALSE, they print
+		nothing, so they don't get in the way of questions in the terminal).
+	"""
+	def __init__(self,log,logfile,llistfile,fits):
+		self.log=log
+		self.logfile=logfile
+		self.llistfile=llistfile
+		self.fits=fits
+		self.journalfile=JournalFile(logfile)
+		#Held while writing (SYNC may be called from a background thread, see AUTOSAVER)
+		self.lock=threading.Lock()
+		#Continue the sequence numbers of an existing journal
+		self.seq=0
+		if os.path.isfile(self.journalfile):
+			for rec in ReadJournal(self.journalfile): self.seq=max(self.seq,rec[0])
+			#End an incomplete last record, so new records start on their own line
+			f=open(self.journalfile,'rb+')
+			f.seek(0,2)
+			if f.tell()>0:
+				f.seek(-1,2)
+				if f.read(1)!='\n': f.write('\n')
+			f.close()
+		#Have LOG record the changed entries for the journal
+		self.log.watch('journal')
+	def sync(self,verbose=True):
+		with self.lock:
+			#Copy the changed entries (in log order, removed entries last) while
+			#the log can't change
+			with self.log.lock:
+				changed=self.log.take('journal')
+				if len(changed)==0: return 0
+				keys=[key for key in self.log.keys() if key in changed]
+				rows=self.log.rows(keys)
+				dels=[key for key in changed if key not in self.log]
+				summary=LogSummary(self.log)
+			if len(self.logfile)<=1:
+				if verbose: print "No log file provided. Did not Save."
+				return 0
+			try:
+				f=open(self.journalfile,'a')
+				try:
+					for row in rows:
+						self.seq+=1
+						f.write('%d;\tset;\t%s;\t%s;\t%s;\t%s;\t%s;\t%s;\t%s;\t%s;\n'%((self.seq,)+row))
+					for z,ion,line in dels:
+						self.seq+=1
+						f.write('%d;\tdel;\t%s;\t%s;\t%s;\t;\t;\t;\t;\t;\n'%(self.seq,z,ion,line))
+					#Make sure the records are on disk
+					f.flush()
+					os.fsync(f.fileno())
+				finally:
+					f.close()
+			except:
+				#The changes aren't saved, so keep them for the next SYNC (records
+				#written before the error are simply written again)
+				self.log.untake('journal',changed)
+				raise
+		if verbose and logsummary: print "Journaled %d change(s) to %s. %s"%(len(rows)+len(dels),self.journalfile,summary)
+		return len(rows)+len(dels)
+	def compact(self,verbose=True):
+		with self.lock:
+			#Anything not yet journaled goes into the logfile as well
+			changed=self.log.take('journal')
+			if len(self.logfile)<=1:
+				if verbose: print "No log file provided. Did not Save."
+				return
+			try:
+				WriteLog(self.log,self.logfile,self.llistfile,self.fits,verbose)
+			except:
+				#Nothing was saved, so the changes still need journaling
+				self.log.untake('journal',changed)
+				raise
+			#The logfile now has every change, so the journal can go
+			if os.path.isfile(self.journalfile): os.remove(self.journalfile)
+			self.seq=0
+		return
+def JournalFile(logfile):
+	"""
+	JOURNALFILE returns the filename of the journal of LOGFILE (see LOGJOURNAL)
+
+	Call: journalfile=JournalFile(LOGFILE)
+	"""
+	return logfile+'.journal'
+def ReadJournal(journalfile):
+	"""
+	READJOURNAL reads the records of a log journal (see LOGJOURNAL).
+
+	Call: records=ReadJournal(JOURNALFILE)
+
+	OUTPUT:
+		RECORDS - A list of (SEQ,OP,Z,ION,LINE,FLAG,(VMIN,VMAX),NOTES,COLOUR) tuples,
+			sorted by the sequence number SEQ
+
+	NOTES:
+		A record cut short (e.g. by a crash while writing) is skipped with a warning.
+		NOTES may contain semicolons.
+	"""
+	records=[]
+	f=open(journalfile)
+	for ii,row in enumerate(f):
+		if row.startswith('#') or len(row.strip())==0: continue
+		cols=row.split(';',2)
+		#A complete record ends with a semicolon and a newline
+		try:
+			if not row.endswith(';\n') or len(cols)<3 or cols[1].strip() not in ['set','del']: raise ValueError
+			seq=int(cols[0])
+			z,ion,line,flag,vmin,vmax,notes,colour=ParseLogRow(cols[2])
+		except ValueError:
+			print "Warning: Skipping incomplete record on line %d of %s"%(ii+1,journalfile)
+			continue
+		records.append((seq,cols[1].strip(),z,ion,line,flag,(vmin,vmax),notes,colour))
+	f.close()
+	records.sort(key=lambda rec:rec[0])
+	return records
+def ReplayJournal(log,journalfile):
+	"""
+	REPLAYJOURNAL applies the records of a log journal (see LOGJOURNAL) to LOG.
+
+	Call: nrec=ReplayJournal(LOG,JOURNALFILE)
+
+	OUTPUT:
+		NREC - The number of records applied
+	"""
+	records=ReadJournal(journalfile)
+	for seq,op,z,ion,line,flag,vel,notes,colour in records:
+		if op=='set': log.set(z,ion,line,flag=flag,vel=vel,notes=notes,colour=colour)
+		else: log.remove(z,ion,line)
+	return len(records)
+class AutoSaver(threading.Thread):
+	"""
+	CLASS AUTOSAVER - Saves the log from a background thread, once the log has not
+		changed for a short time. Any number of changes in that time are saved together.
+
+	Call - AS=AutoSaver(SAVE,IDLE=AUTOSAVEIDLE,MAXDELAY=AUTOSAVEMAX)
+
+	INPUTS:
+		SAVE - The function (with no arguments) that saves the log, e.g. LOGJOURNAL.SYNC
+		IDLE - How long (in seconds) after the last change to save
+		MAXDELAY - The longest (in seconds) a change can wait to be saved, even if the
+			log keeps changing
+
+	ATTRIBUTES:
+		AS.POKE() - Tells AS the log has changed. Returns straight away (add it to
+			LOG.LISTENERS to have every change saved, see LOGSTORE)
+		AS.FLUSH() - Saves any waiting changes now (in the calling thread)
+		AS.STOP() - Saves any waiting changes, and stops the thread
+		AS.NSAVES - The number of times SAVE has been called
+
+	NOTES:
+		The thread is started when AS is made, and is a daemon thread (it doesn't
+		stop Python from exiting), so call AS.STOP() before quitting.
+		If SAVE fails, the error is printed and the save is tried again later.
+	"""
+	def __init__(self,save,idle=None,maxdelay=None):
+		threading.Thread.__init__(self,name='AutoSaver')
+		self.daemon=True
+		self.save=save
+		if idle is None: idle=autosaveidle
+		if maxdelay is None: maxdelay=autosavemax
+		self.idle=idle
+		self.maxdelay=maxdelay
+		#FIRST/LAST are the times of the first and last change not yet saved (None if saved)
+		self.first=None
+		self.last=None
+		self.stopping=False
+		self.nsaves=0
+		#COND guards FIRST/LAST/STOPPING, SAVING is held while saving
+		self.cond=threading.Condition()
+		self.saving=threading.Lock()
+		self.start()
+	def poke(self):
+		with self.cond:
+			now=time.time()
+			if self.first is None: self.first=now
+			self.last=now
+			self.cond.notify()
+	def run(self):
+		while True:
+			with self.cond:
+				#Wait for a change...
+				while self.first is None and not self.stopping: self.cond.wait()
+				if self.stopping: return
+				#...then for the log to be left alone for IDLE seconds (or MAXDELAY to pass)
+				due=min(self.last+self.idle,self.first+self.maxdelay)
+				if time.time()<due:
+					self.cond.wait(due-time.time())
+					continue
+			self.flush()
+	def flush(self):
+		with self.saving:
+			with self.cond:
+				if self.first is None: return
+				first,self.first,self.last=self.first,None,None
+			try:
+				self.save()
+				self.nsaves+=1
+			except Exception as err:
+				print "Warning: Autosave failed (%s). Will try again."%err
+				#Keep the changes waiting (and don't retry straight away)
+				with self.cond:
+					if self.first is None: self.first=first
+					self.last=time.time()
+		return
+	def stop(self):
+		with self.cond:
+			self.stopping=True
+			self.cond.notify()
+		self.join()
+		self.flush()
+		return
+def IsSQLiteLog(logfile):
+	"""
+	ISSQLITELOG returns TRUE if LOGFILE is (or should be created as) a database of logs
+	(see SQLITELOG), i.e. it ends in '.db' or '.sqlite', or is an SQLite file.
+
+	Call: IsSQLiteLog(LOGFILE)
+	"""
+	if os.path.splitext(logfile)[1].lower() in ['.db','.sqlite']: return True
+	if not os.path.isfile(logfile): return False
+	f=open(logfile,'rb')
+	magic=f.read(16)
+	f.close()
+	return magic=='SQLite format 3\x00'
+class SQLiteLog:
+	"""
+	CLASS SQLITELOG - A database (SQLite file) holding the logs of many spectra, which
+		can be queried without loading the logs (see QUERYLOG).
+
+	Call - DB=SQLiteLog(DBFILE)
+
+	INPUTS:
+		DBFILE - Filename of the database (created if it doesn't exist)
+
+	ATTRIBUTES:
+		DB.CONN - The SQLITE3 connection to the database
+		DB.SPECTRA() - List of the spectra (filenames) with a log in the database
+		DB.LOAD(FITS,LLISTFILE='') - Returns the LOGSTORE of the spectrum FITS (empty if
+			FITS has no log yet). Changes are saved by LOG.COMMIT() (see LOGSTORE)
+		DB.SAVE(LOG,KEYS=None) - Saves the LOG entries changed since the last SAVE (or KEYS,
+			if given) in one transaction
+		DB.IMPORTLOG(LOGFILE,FITS=None) - Adds (replaces) the log of a text logfile. FITS is
+			the spectrum the log is of (by default, the '#!Spectrum:' in LOGFILE)
+		DB.EXPORTLOG(FITS,LOGFILE) - Writes the log of FITS as a text logfile (see WRITELOG)
+		DB.CLOSE() - Closes the database
+
+	NOTES:
+		The database has two tables:
+			SPECTRA(ID, SPECTRUM, LINELIST) - One row per spectrum, with the linelist used
+			LINES(SPECTRUM_ID, Z, ZF, ION, LINE, FLAG, FLAGI, VMIN, VMAX, NOTES, COLOUR) - One row
+				per log entry. ZF and FLAGI are Z and FLAG as numbers (for queries)
+		LINES is indexed by redshift, ion and flag.
+		The text columns are kept exactly as in the logfile, so a log exported from
+		the database is the same as the log imported.
+	"""
+	def __init__(self,dbfile):
+		self.dbfile=dbfile
+		self.conn=sqlite3.connect(dbfile)
+		self.conn.text_factory=str
+		with self.conn:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS spectra (id INTEGER PRIMARY KEY, spectrum TEXT UNIQUE, linelist TEXT)')
+			self.conn.execute('CREATE TABLE IF NOT EXISTS lines (spectrum_id INTEGER, z TEXT, zf REAL, ion TEXT, line TEXT, '\
+				+'flag TEXT, flagi INTEGER, vmin TEXT, vmax TEXT, notes TEXT, colour TEXT, '\
+				+'PRIMARY KEY (spectrum_id,z,ion,line))')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS lines_zf ON lines (zf)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS lines_ion ON lines (ion,line)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS lines_flag ON lines (flagi)')
+	def close(self):
+		self.conn.close()
+	def spectra(self):
+		return [row[0] for row in self.conn.execute('SELECT spectrum FROM spectra ORDER BY id')]
+	#The ID of spectrum FITS (adding it if LLISTFILE is given)
+	def _specid(self,fits,llistfile=None):
+		row=self.conn.execute('SELECT id FROM spectra WHERE spectrum=?',(fits,)).fetchone()
+		if row is not None:
+			if llistfile: self.conn.execute('UPDATE spectra SET linelist=? WHERE id=?',(llistfile,row[0]))
+			return row[0]
+		if llistfile is None: return None
+		return self.conn.execute('INSERT INTO spectra (spectrum,linelist) VALUES (?,?)',(fits,llistfile)).lastrowid
+	def load(self,fits,llistfile=''):
+		log=LogStore()
+		log.meta['Line List']=llistfile
+		log.meta['Spectrum']=fits
+		row=self.conn.execute('SELECT id,linelist FROM spectra WHERE spectrum=?',(fits,)).fetchone()
+		if row is not None:
+			if not llistfile: log.meta['Line List']=row[1]
+			for z,ion,line,flag,vmin,vmax,notes,colour in self.conn.execute('SELECT z,ion,line,flag,vmin,vmax,notes,colour '\
+				+'FROM lines WHERE spectrum_id=? ORDER BY rowid',(row[0],)):
+				log.set(z,ion,line,flag=flag,vel=(vmin,vmax),notes=notes,colour=colour)
+		#Record the changes to save (see SAVE)
+		log.watch('db')
+		log.backend=self
+		return log
+	def save(self,log,keys=None):
+		if keys is None: keys=log.take('db')
+		if len(keys)==0: return
+		#Everything is saved, or nothing is
+		with self.conn:
+			specid=self._specid(log.meta['Spectrum'],log.meta.get('Line List',''))
+			rows=[]
+			for key in keys:
+				if key in log:
+					row=log.slots[key]
+					rows.append((specid,key[0],float(log.zf[row]),key[1],key[2],log.flag[row],int(log.flagi[row]),\
+						log.vmin[row],log.vmax[row],log.notes[row],log.colour[row]))
+				else: self.conn.execute('DELETE FROM lines WHERE spectrum_id=? AND z=? AND ion=? AND line=?',(specid,)+tuple(key))
+			self.conn.executemany('INSERT OR REPLACE INTO lines VALUES (?,?,?,?,?,?,?,?,?,?,?)',rows)
+		return
+	def importlog(self,logfile,fits=None):
+		text=LoadLog(logfile)
+		if fits is None: fits=text.meta.get('Spectrum',logfile)
+		text.meta['Spectrum']=fits
+		text.meta['Line List']=text.meta.get('Line List','')
+		#Replace any log the spectrum already has
+		with self.conn:
+			specid=self._specid(fits,text.meta['Line List'])
+			self.conn.execute('DELETE FROM lines WHERE spectrum_id=?',(specid,))
+			self.save(text,keys=text.keys())
+		print "Imported %s into %s (%d lines for %s)"%(logfile,self.dbfile,len(text),fits)
+		return
+	def exportlog(self,fits,logfile):
+		log=self.load(fits)
+		WriteLog(log,logfile,log.meta['Line List'],fits)
+		return
+def QueryLog(dbfile,zmin=None,zmax=None,ion=None,line=None,flag=None,spectrum=None):
+	"""
+	QUERYLOG finds the log entries in a database of logs (see SQLITELOG)
+
+	Call: rows=QueryLog(DBFILE,ZMIN=None,ZMAX=None,ION=None,LINE=None,FLAG=None,SPECTRUM=None)
+
+	INPUTS:
+		DBFILE - Filename of the database
+		ZMIN,ZMAX - Only entries with ZMIN<=Z<=ZMAX
+		ION, LINE - Only entries of this ion (and line identifier)
+		FLAG - Only entries with this flag (an integer). All of the FLAG bits must be
+			set in the entry's flag (e.g. FLAG=8 gives all lower limits, blended or not).
+			FLAG=0 (no good/skip) only gives entries flagged 0.
+		SPECTRUM - Only entries of this spectrum
+
+	OUTPUT:
+		ROWS - List of (SPECTRUM,Z,ION,LINE,FLAG,VMIN,VMAX,NOTES,COLOUR) tuples, ordered by
+			spectrum and redshift
+	"""
+	where=[]
+	args=[]
+	if zmin is not None:
+		where.append('lines.zf>=?')
+		args.append(float(zmin))
+	if zmax is not None:
+		where.append('lines.zf<=?')
+		args.append(float(zmax))
+	if ion is not None:
+		where.append('lines.ion=?')
+		args.append(ion)
+	if line is not None:
+		where.append('lines.line=?')
+		args.append(line)
+	if flag is not None and int(flag)==0:
+		where.append('lines.flagi=0')
+	elif flag is not None:
+		where.append('lines.flagi>=0 AND (lines.flagi & ?)=?')
+		args+=[int(flag),int(flag)]
+	if spectrum is not None:
+		where.append('spectra.spectrum=?')
+		args.append(spectrum)
+	sql='SELECT spectra.spectrum,z,ion,line,flag,vmin,vmax,notes,colour FROM lines JOIN spectra ON lines.spectrum_id=spectra.id'
+	if len(where)>0: sql+=' WHERE '+' AND '.join(where)
+	sql+=' ORDER BY spectra.id,lines.zf'
+	db=SQLiteLog(dbfile)
+	rows=db.conn.execute(sql,args).fetchall()
+	db.close()
+	return rows
+def ParseLogRow(row):
+	"""
+	PARSELOGROW splits a line of a logfile (see LOADLOG) into its columns.
+
+	Call: Z,ION,LINE,FLAG,VMIN,VMAX,NOTES,COLOUR=ParseLogRow(ROW)
+
+	INPUTS:
+		ROW - A string with the line of the logfile, in the format:
+			Z; ION; LINE; FLAG; VMIN; VMAX; NOTES; COLOUR;
+
+	OUTPUT:
+		The columns of ROW (strings, with whitespace removed)
+
+	NOTES:
+		NOTES may contain semicolons (anything between VMAX and COLOUR belongs to NOTES).
+		The final semicolon is optional.
+		Raises a VALUEERROR if ROW has too few columns, or no Z, ION, or LINE.
+	"""
+	cols=row.rstrip('\r\n').split(';')
+	#Drop the (empty) column after the final semicolon
+	if len(cols)>1 and len(cols[-1].strip())==0: cols.pop()
+	if len(cols)<8: raise ValueError('%d columns instead of 8'%len(cols))
+	z,ion,line=cols[0].strip(),cols[1].strip(),cols[2].strip()
+	if len(z)==0 or len(ion)==0 or len(line)==0: raise ValueError('missing redshift, ion or line')
+	notes=';'.join(cols[6:-1])
+	return z,ion,line,cols[3].strip(),cols[4].strip(),cols[5].strip(),notes.strip(),cols[-1].strip()
+def LoadLog(logfile,errors=None,maxerrors=20):
 	""" 
 	LOADLOG loads the log file.
 
 
 	
-	Call: LoadLog(LOGFILE)
+	Call: LoadLog(LOGFILE,ERRORS=None,MAXERRORS=20)
 
 	INPUTS:
 		LOGFILE - String containing filename out TB_LINEFINDER output logfile.
@@ -340,10 +2248,13 @@ def LoadLog(logfile):
 
 			When the output logfile is being read, any line beginning with '#'
 			will be ignored
+		ERRORS - If a list is given, the (LINE NUMBER, MESSAGE) of every line of
+			LOGFILE that could not be read is appended to it
+		MAXERRORS - Only the first MAXERRORS bad lines are reported to the screen
 
 	OUTPUT:
-		LOG - A dictionary with all the log information.
-		The dictionary is keyed in the following way
+		LOG - A LOGSTORE with all the log information.
+		It can be used as a dictionary keyed in the following way
 
 		LOG['zs'] - A list of redshifts for each system
 
@@ -372,52 +2283,134 @@ def LoadLog(logfile):
 			is keyed by (Z,ION,LINE,'vel'), which are found in the lists of
 			LOG['zs'], LOG['ions'], and LOG['lines'][ION] (respectively)
 
+		LOG.META - The header information of LOGFILE, keyed by name (e.g.
+			LOG.META['Line List'], LOG.META['Spectrum'])
+
 	NOTES:
 		If no LOGFILE string is found in the current directory, a blank 
-		LOG dictionary is loaded, with LOG['ion'], LOG['zs'], and LOG['lines']
+		LOG store is loaded, with LOG['ion'], LOG['zs'], and LOG['lines']
 		generated. The file will be created at saving the log.
 
+		If a journal of LOGFILE exists (LOGFILE+'.journal', see LOGJOURNAL), its
+		changes are applied on top of LOGFILE.
+
+		The file is read one line at a time (see PARSELOGROW), so lines that cannot
+		be read are reported and skipped, rather than stopping the whole log
+		from loading. If an entry appears more than once, the last one is kept.
+
+		LOG['zs'], LOG['ions'] and LOG['lines'] are generated from the LOG entries,
+		so changing them has no effect. Use LOG.SET/LOG.REMOVE (or set/pop the
+		keys as above) to change the log.
+
 	"""
-	#THe main LOG dictionary
-	log={}
-	#Key LOG withe the redshift and ion lists
-	log['zs']=[]
-	log['ions']=[]
-	#Key LOG with a sub-dictionary of the spectra lines
-	log['lines']={}
+	#THe main LOG store (keeps the redshift, ion and line lists itself)
+	log=LogStore()
 	#Check if the LOGFILE all ready exists, and read it.
 	if os.path.isfile(logfile):
 		print "Loading logfile: %s"%logfile
-		#Read in the semicolon delimted file
-		data=np.genfromtxt(logfile,delimiter=';',dtype=type('str'),comments='#')
-		if len(data)>0:
-			#For each line in the file
-			for ii in range(len(data)):
-				#REad in each column, remove whitespace around the string,
-				#and format the data.
-				z=data[ii][0].strip()
-				ion=data[ii][1].strip()
-				line=data[ii][2].strip()
-				#If Z isn't in 'zs' list, add it.
-				if z not in log['zs']: log['zs'].append(z)
-				#If ION isn't in 'ions' list, add it.
-				#Also, need to add ION as a key to 'lines' dictionary
-				if ion not in log['ions']:
-					log['ions'].append(ion)
-					log['lines'][ion]=[]
-				#If LINE isn't in ['lines'][ION], include it
-				if line not in log['lines'][ion]: log['lines'][ion].append(line)
-				log[z,ion,line,'flag']=data[ii][3].strip()
-				log[z,ion,line,'vel']=data[ii][4].strip(), data[ii][5].strip()
-				log[z,ion,line]=data[ii][6].strip()#Add NOTE
-				log[z,ion,line,'colour']=data[ii][7].strip()
+		nerr=0
+		#ROWS is the batch of parsed lines (added to LOG every BATCH lines)
+		rows=[]
+		batch=2**16
+		f=open(logfile)
+		#Read one line at a time
+		for ii,row in enumerate(f):
+			#Keep the header information ('#!NAME: VALUE')
+			if row.startswith('#!'):
+				if ':' in row:
+					name,val=row[2:].split(':',1)
+					log.meta[name.strip()]=val.strip()
+				continue
+			#Skip comments and blank lines
+			if row.startswith('#') or len(row.strip())==0: continue
+			try:
+				z,ion,line,flag,vmin,vmax,notes,colour=ParseLogRow(row)
+			except ValueError as err:
+				#Report the bad line, and carry on with the rest of the file
+				nerr+=1
+				if errors is not None: errors.append((ii+1,str(err)))
+				if nerr<=maxerrors: print "Warning: Skipping line %d of %s (%s)"%(ii+1,logfile,err)
+				continue
+			rows.append((z,ion,line,flag,vmin,vmax,notes,colour))
+			#Add the entries to LOG (LOG keeps track of the 'zs', 'ions' and 'lines')
+			if len(rows)>=batch:
+				log.extend(rows)
+				rows=[]
+		log.extend(rows)
+		f.close()
+		if nerr>maxerrors: print "Warning: Skipped %d bad lines in total in %s"%(nerr,logfile)
 	#If no LOGFILE is found, inform the user that is the case.
 	else:
 		print "Logfile not found at startup. Will create %s on exit"%logfile
+	#Apply any changes journaled since the logfile was last written (see LOGJOURNAL)
+	if os.path.isfile(JournalFile(logfile)):
+		nrec=ReplayJournal(log,JournalFile(logfile))
+		print "Replayed %d journaled change(s) from %s"%(nrec,JournalFile(logfile))
 	#return LOG
 	return log
 
 
+class LogLineIndex:
+	""" 
+	CLASS LOGLINEINDEX - The observed wavelengths of every line in the LOG, kept in one
+		sorted NUMPY array, so the lines in the LOG that fall within any wavelength
+		range are found with a binary search.
+
+	Call - LI=LogLineIndex(LOG,LLIST)
+
+	INPUTS:
+		LOG - The LOGSTORE (see LOADLOG)
+		LLIST - The linelist dictionary (see LOADLINELIST)
+
+	ATTRIBUTES:
+		LI.WVLS - A sorted NUMPY array of the observed wavelength of each line in LOG
+		LI.KEYS - The list of (Z,ION,LINE) log keys of each element of LI.WVLS
+		LI.ADD(Z,ION,LINE) - Adds a line to the index
+		LI.REMOVE(Z,ION,LINE) - Removes a line from the index
+		LI.QUERY(WMIN,WMAX) - Returns (KEYS,WVLS), the log keys and observed wavelengths
+			of the lines in the index strictly between WMIN and WMAX
+
+	NOTES:
+		Lines that are not in LLIST are not indexed. LI.ADD and LI.REMOVE should
+		be called whenever a line is added/removed from LOG to keep the index up to date.
+
+	"""
+	def __init__(self,log,llist):
+		self.llist=llist
+		keys=[key for key in log.keys() if key[1:] in llist]
+		wvls=np.array([self._wvl(key) for key in keys],dtype=float)
+		order=np.argsort(wvls,kind='mergesort')
+		self.wvls=wvls[order]
+		self.keys=[keys[ii] for ii in order]
+		self.keyset=set(self.keys)
+	#Observed wavelength of a log key
+	def _wvl(self,key):
+		z,ion,line=key
+		return self.llist[ion,line][0]*(1.0+float(z))
+	def add(self,z,ion,line):
+		key=(z,ion,line)
+		if key in self.keyset or (ion,line) not in self.llist: return
+		wvl=self._wvl(key)
+		ind=self.wvls.searchsorted(wvl)
+		self.wvls=np.insert(self.wvls,ind,wvl)
+		self.keys.insert(ind,key)
+		self.keyset.add(key)
+		return
+	def remove(self,z,ion,line):
+		key=(z,ion,line)
+		if key not in self.keyset: return
+		wvl=self._wvl(key)
+		i0=self.wvls.searchsorted(wvl,side='left')
+		i1=self.wvls.searchsorted(wvl,side='right')
+		ind=i0+self.keys[i0:i1].index(key)
+		self.wvls=np.delete(self.wvls,ind)
+		self.keys.pop(ind)
+		self.keyset.discard(key)
+		return
+	def query(self,wmin,wmax):
+		i0=self.wvls.searchsorted(wmin,side='right')
+		i1=self.wvls.searchsorted(wmax,side='left')
+		return self.keys[i0:i1],self.wvls[i0:i1]
 class UpdateLog:
 	""" 
 	CLASS UPDATELOG - The GUI environment for editing and updating the LOG file/dictionary for a given
@@ -461,20 +2454,27 @@ class UpdateLog:
 		UL.AX - Matplotlib axes instance of velocity profile
 		UL.VMINLINE - The vertical line object to signify UL.VMIN on UL.AX plot
 		UL.VMAXLINE - The vertical line object to signify UL.VMAX on UL.AX plot
+		UL.VSPAN - The shaded span between UL.VMINLINE and UL.VMAXLINE
+		UL.BACKGROUND - The cached figure (without UL.VMINLINE, UL.VMAXLINE, UL.VSPAN) for blitting
+		UL.DRAGGING - The mouse button (1 or 3) held down while dragging a velocity limit (or None)
 		UL.CANVAS - The TKinter canvas in UL.ULFRAME for displaying plots.
-		UL.DRAWVMIN(REDRAW=TRUE) - (Re)draws the UL.VMIN line (UL.VMINLINE) on the UL.AX plot.
-			Set REDRAW=FALSE if it is the first instance.
-		UL.DRAWVMAX(REDRAW=TRUE) - (Re)draws the UL.VMAX line (UL.VMAXLINE) on the UL.AX plot.
-			Set REDRAW=FALSE if it is the first instance.			
+		UL.ONDRAW(EVENT) - Caches UL.BACKGROUND after the figure is drawn
+		UL.BLITVELS() - Blits UL.VSPAN, UL.VMINLINE and UL.VMAXLINE onto UL.BACKGROUND
+		UL.DRAWVMIN() - Moves the UL.VMIN line (UL.VMINLINE) on the UL.AX plot.
+		UL.DRAWVMAX() - Moves the UL.VMAX line (UL.VMAXLINE) on the UL.AX plot.
+		UL.DRAWSPAN() - Moves UL.VSPAN to between UL.VMIN and UL.VMAX, and blits
 		UL.ONSETVELS(EVENT) - Takes the mouse click event, and gets the x-coordinate (velocity).
 			If the left/right mouse button, UL.ONSETVELS fills in the entry for UL.VMIN/UL.VMAX
 			value, and redraws the UL.VMINLINE/UL.VMAXLINE (respectively) 
+		UL.ONDRAGVELS(EVENT) - Moves UL.VMIN/UL.VMAX with the mouse while the button is held down
+		UL.ONRELEASEVELS(EVENT) - Stops dragging UL.VMIN/UL.VMAX
 		UL.ONSAVEBUTTON - Takes all the information (flags, notes, colours, velocity limits) for the
 			absrotpion profile, saves it to UL.LOG, and destroys the UPDATELOG widget.
 
 	NOTES:
 		-The left mouse button shoudl set UL.VMIN on the window
 		-The right mouse button sets UL.VMAX.
+		-Holding the left/right mouse button down drags UL.VMIN/UL.VMAX
 		-The flag coding is:
 			0 - No good/skip
 			1 - OK (i.e. use the line)
@@ -610,45 +2610,88 @@ class UpdateLog:
 		#WVL should be Redshifted 
 		wvl=wvl*(1.0+z)
 		#get velocity profile of the line from the spectrum
-		tmpvel,tmpspec=velspec(wvl, iwvlngth, vmin,vmax, ispectrum)
-		self.fig=plt.figure(figsize=(6,6))
+		tmpvels,tmpspecs,npix=velspecs([wvl], iwvlngth, vmin,vmax, ispectrum)
+		tmpvel=tmpvels[0,:npix[0]]
+		tmpspec=tmpspecs[0,:npix[0]]
+		#(The figure is not registered with pyplot, so it is released with the window)
+		self.fig=Figure(figsize=(6,6))
 		self.fig.subplots_adjust(hspace=2.0,wspace=2.0)
-		self.ax=plt.subplot(1,1,1)
+		self.ax=self.fig.add_subplot(1,1,1)
 		self.ax.plot(tmpvel,tmpspec,'k',drawstyle='steps')
 		self.ax.set_xlabel(r'Relative velocity (km s$^{-1}$)')
 		self.ax.set_ylabel(r'Relative intensity')
 		self.Canvas=FigureCanvasTkAgg(self.fig,self.ULFrame)
 		self.Canvas._tkcanvas.grid(row=0,column=0)
-		self.DrawVmin(redraw=False)
-		self.DrawVmax(redraw=False)
-		self.fig.canvas.mpl_connect("button_press_event",self.OnSetVels)
+		#The velocity limits (and the shaded span between them) are animated artists.
+		#They are not drawn with the rest of the figure, but blitted on top of a
+		#cached background (UL.BACKGROUND), so moving them does not redraw the figure.
+		self.background=None
+		self.vminline=self.ax.axvline(self.Vmin.get(),linestyle='--',color='r',animated=True)
+		self.vmaxline=self.ax.axvline(self.Vmax.get(),linestyle='--',color='r',animated=True)
+		self.vspan=self.ax.axvspan(self.Vmin.get(),self.Vmax.get(),color='r',alpha=0.15,animated=True)
+		#Which limit is being dragged (the mouse button held down, None otherwise)
+		self.dragging=None
+		self.Canvas.mpl_connect("draw_event",self.OnDraw)
+		self.Canvas.mpl_connect("button_press_event",self.OnSetVels)
+		self.Canvas.mpl_connect("motion_notify_event",self.OnDragVels)
+		self.Canvas.mpl_connect("button_release_event",self.OnReleaseVels)
+		self.Canvas.draw()
 		self.Canvas.start_event_loop(0)
 
+	#After every full draw of the figure, cache the background and blit the velocity limits
+	def OnDraw(self,event):
+		self.background=self.Canvas.copy_from_bbox(self.fig.bbox)
+		self.BlitVels()
+	#Blit the velocity limits and shaded span onto the cached background
+	def BlitVels(self):
+		if self.background is None: return
+		self.Canvas.restore_region(self.background)
+		for artist in [self.vspan,self.vminline,self.vmaxline]:
+			self.ax.draw_artist(artist)
+		self.Canvas.blit(self.fig.bbox)
 	#Functions to draw velocity limits on UL.AX instance. One is for each limit
-	def DrawVmin(self,redraw=True):
-		#REDRAW defines whether the line has to be redrawn. If not, it needs to create UL.VMINLINE 
-		ymin,ymax=self.ax.get_ylim()
-		if redraw: self.ax.lines.remove(self.vminline[0])
-		self.vminline=self.ax.plot([self.Vmin.get(),self.Vmin.get()],[ymin,ymax],'--r')
-		self.Canvas.draw()
-	def DrawVmax(self,redraw=True):
-		#REDRAW defines whether the line has to be redrawn. If not, it needs to create UL.VMAXLINE 
-		ymin,ymax=self.ax.get_ylim()
-		if redraw: self.ax.lines.remove(self.vmaxline[0])
-		self.vmaxline=self.ax.plot([self.Vmax.get(),self.Vmax.get()],[ymin,ymax],'--r')
-		self.Canvas.draw()
+	def DrawVmin(self):
+		vmin=self.Vmin.get()
+		self.vminline.set_xdata([vmin,vmin])
+		self.DrawSpan()
+	def DrawVmax(self):
+		vmax=self.Vmax.get()
+		self.vmaxline.set_xdata([vmax,vmax])
+		self.DrawSpan()
+	#Update the shaded span between the velocity limits and blit
+	def DrawSpan(self):
+		vmin=self.Vmin.get()
+		vmax=self.Vmax.get()
+		#The span is in data coordinates in x, and axes coordinates in y
+		self.vspan.set_xy([[vmin,0.0],[vmin,1.0],[vmax,1.0],[vmax,0.0],[vmin,0.0]])
+		self.BlitVels()
 
 	def OnSetVels(self,event):
 		#set UL.Vmin and UL.Vmax based on left/right mouse clicks
 		#Also redraw the velocity limit lines on UL.AX
+		if event.inaxes!=self.ax: return
 		vel=event.xdata
-		ymin,ymax=self.ax.get_ylim()
 		if event.button==1:
 			self.Vmin.set(vel)
-			self.DrawVmin(redraw=True)
+			self.DrawVmin()
+			self.dragging=1
 		elif event.button==3:
 			self.Vmax.set(vel)
-			self.DrawVmax(redraw=True)
+			self.DrawVmax()
+			self.dragging=3
+	def OnDragVels(self,event):
+		#Move UL.Vmin/UL.Vmax with the mouse while the left/right button is held down
+		if self.dragging is None or event.inaxes!=self.ax: return
+		vel=event.xdata
+		if self.dragging==1:
+			self.Vmin.set(vel)
+			self.DrawVmin()
+		else:
+			self.Vmax.set(vel)
+			self.DrawVmax()
+	def OnReleaseVels(self,event):
+		#Stop dragging the velocity limits
+		self.dragging=None
 	def onSaveButton(self):
 		#Saves the current values in the GUI to the log file.
 		#Determine flag based on true/false values
@@ -658,80 +2701,779 @@ class UpdateLog:
 		self.log[self.zstr,self.ion,self.line,'vel']=str(self.Vmin.get()),str(self.Vmax.get())
 		self.log[self.zstr,self.ion,self.line]=self.Notes.get()
 		self.log[self.zstr,self.ion,self.line,'colour']=self.Colour.get()
+		#If the LOG is kept in a database, commit the entry (see SQLITELOG)
+		self.log.commit()
 		#Destroy the widget
 		self.Canvas.stop_event_loop()
 		self.ULmaster.destroy()
+		self.fig.clf()
 		#Quit UPDATELOG
 		return		
 def LoadLineList(file):
 	""" 
 	LOADLINELIST - Loads the supplied linelist into a dictionary for TB_LINEFINDER
 
-	Call - LLIST=LoadLineList(FILE)
-	
-	INPUT: FILE - The input ASCII file with the linelist for identification.
+	Call - LLIST=LoadLineList(FILE)
+	
+	INPUT: FILE - The input ASCII file with the linelist for identification.
+
+			Each line in the file must contain information on each spectral line
+			of interest in the format (whitespace delimited):
+				REST_WAVELENGTH ION SHORT_WL OSCILLATOR_STRENGTH
+	
+				REST_WAVELENGTH - The rest wavelength of the spectral line (e.g. 1215.6701)
+				ION - The species (including ionization state) of the spectral line (e.g. HI)
+				SHORT_WL - A short identifier of the wavelength (e.g. 1215)
+					Needed to descrimante between absorption lines of a given ION
+				OSCILLATOR_STRENGTH - The oscillator strength of the feature
+					This is only used for display purposes. (e.g. 0.4164)
+	
+				EXAMPLE:
+				1215.6701 HI 1215 0.4164
+	
+			If Ly-alpha not present, LOADLINELIST will add it by default
+			MUST CONTAIN THE SAME NUMBER OF COLUMNS IN EACH LINE (unless commented)
+			Can use '#' at the start of any line to comment
+
+	OUTPUT: LLIST - A dictionary with the linelist information. LLIST is structured as follows:
+		LLIST['ions'] - A list of all the ion species in the linelist (ION column)
+		LLIST['lines'] - A dictionary (keyed by an ION in LLIST['ions']) of all the
+			SHORT_WL identifiers for a given ION
+	
+		LLIST['lines'][ION] is a list of all the SHORT_WL for a given ION
+	
+		LLIST[ION,SHORT_WL] - A tuple with (WAVELENGTH,OSCILLATOR_STRENGTH) for 
+			the spectral line identified ION,SHORT_WL
+
+		LLIST['key'] - A short string identifying the lines and wavelengths of the
+			linelist (see LINELISTKEY)
+	
+	NOTES
+		For simplicity, SHORT_WL is abbreviated LINE in the code. 
+		Will add Ly-alpha (HI 1215) by default if not present in FILE
+
+"""
+	#Read in FILE.
+	#FILE in format: wvl	ION	lineID	fval	
+	data=np.genfromtxt(file,comments='#',dtype=type('str'))
+	#Create LLIST, the linelist dictionary
+	llist={}
+	#Create the list of ions and lines
+	llist['ions']=[]
+	llist['lines']={}
+	#For each line in FILE
+	for ii in range(len(data)):
+		ion=data[ii][1]
+		line=data[ii][2]
+		#Convert WAVELENGTH and OSCILLATOR_STRENGTH to a float
+		wvl=float(data[ii][0])#WAVELENGTH
+		f=float(data[ii][3])#OSCILLATOR_STRENGTH
+		#Save tuple to list
+		llist[ion,line]=wvl,f
+		#Check to see if ION or LINE (aka SHORT_WL) are in LLIST
+		#'ions' or 'lines' lists. If not, add them.
+		if ion not in llist['ions']:
+			llist['ions'].append(ion)
+			llist['lines'][ion]=[]
+		if line not in llist['lines'][ion]: llist['lines'][ion].append(line)
+	#Line list requires Ly-alpha. Add to LLIST if not present.
+	if ('HI','1215') not in llist:
+		llist['HI','1215']=1215.6701,0.41640
+	#Identify the linelist once (for the tables kept for it, see GETLINECOVERAGE)
+	llist['key']=LineListKey(llist)
+	#REturn LLIST
+	return llist	
+class LineCoverage:
+	""" 
+	CLASS LINECOVERAGE - A table of which lines in a linelist are covered by a spectrum,
+		for any redshift. The rest wavelengths of the lines are kept sorted, along with
+		the wavelength segments covered by the spectrum (i.e. split at any gaps in the
+		spectrum), so the lines covered at redshift Z are found with a binary search
+		for each segment, rather than checking every line.
+
+	Call - LC=LineCoverage(WVLNGTH,LLIST,GAPFACTOR=5.0)
+
+	INPUTS:
+		WVLNGTH - The wavelength array of the spectrum (increasing order, as from SPECFITS)
+		LLIST - The linelist dictionary (see LOADLINELIST)
+		GAPFACTOR - A gap in the spectrum is anywhere the step between two pixels
+			(in velocity) is more than GAPFACTOR times the median step
+
+	ATTRIBUTES:
+		LC.KEYS - The list of (ION,LINE) keys of LLIST, sorted by ION, then LINE
+		LC.REST - A NUMPY array of the rest wavelengths of LC.KEYS, in increasing order
+		LC.ORDER - The index in LC.KEYS of each element of LC.REST
+		LC.RESTWL - A dictionary of the rest wavelength of each (ION,LINE) key
+		LC.SEGMENTS - A NUMPY array (NSEG x 2) of the (start,end) wavelengths of
+			each gap-free segment of the spectrum
+		LC.VISIBLE(Z) - Returns the list of (ION,LINE) keys covered by the spectrum
+			at redshift Z (sorted by ION, then LINE)
+		LC.ZRANGES(ION,LINE) - Returns the list of (ZMIN,ZMAX) redshift intervals
+			over which the line is covered by the spectrum
+		LC.COVERED(WVLS) - Returns a boolean NUMPY array of whether each (observed)
+			wavelength in WVLS is covered by the spectrum
+
+	NOTES:
+		A line is covered if its observed wavelength is strictly within a segment.
+
+	"""
+	def __init__(self,wvlngth,llist,gapfactor=5.0):
+		#Every line in the linelist, in the order they are displayed
+		self.keys=[]
+		for ion in sorted(llist['ions']):
+			for line in sorted(llist['lines'][ion]):
+				if (ion,line) in llist: self.keys.append((ion,line))
+		rest=np.array([llist[key][0] for key in self.keys],dtype=float)
+		#The rest wavelength of each line (for ZRANGES)
+		self.restwl=dict(zip(self.keys,rest))
+		self.order=np.argsort(rest,kind='mergesort')
+		self.rest=rest[self.order]
+		#Find the gaps in the spectrum (a dispersion solution has no gaps)
+		if isinstance(wvlngth,WaveSolution) or len(wvlngth)<3:
+			self.segments=np.array([[wvlngth[0],wvlngth[-1]]],dtype=float)
+		else:
+			wvl=np.asarray(wvlngth,dtype=float)
+			step=np.diff(wvl)/wvl[:-1]
+			gaps=np.nonzero(step>gapfactor*np.median(step))[0]
+			starts=np.concatenate([[0],gaps+1])
+			ends=np.concatenate([gaps,[len(wvl)-1]])
+			self.segments=np.column_stack([wvl[starts],wvl[ends]])
+	def visible(self,z):
+		inds=[]
+		for wmin,wmax in self.segments:
+			#Lines whose observed wavelength is strictly within the segment
+			i0=self.rest.searchsorted(wmin/(1.0+z),side='right')
+			i1=self.rest.searchsorted(wmax/(1.0+z),side='left')
+			inds.append(self.order[i0:i1])
+		inds=np.sort(np.concatenate(inds))
+		return [self.keys[ii] for ii in inds]
+	def zranges(self,ion,line):
+		wvl=self.restwl[ion,line]
+		return [(wmin/wvl-1.0,wmax/wvl-1.0) for wmin,wmax in self.segments]
+	def covered(self,wvls):
+		wvls=np.asarray(wvls,dtype=float)
+		seg=np.clip(self.segments[:,0].searchsorted(wvls,side='left')-1,0,len(self.segments)-1)
+		return (wvls>self.segments[seg,0])&(wvls<self.segments[seg,1])
+def LineListKey(llist):
+	"""
+	LINELISTKEY returns a short string identifying the lines (and their wavelengths and
+	f-values) of a linelist dictionary (see LOADLINELIST). Linelists with the same lines
+	have the same key.
+
+	Call - KEY=LineListKey(LLIST)
+	"""
+	return hashlib.md5(repr(sorted((key,llist[key]) for key in llist if isinstance(key,tuple)))).hexdigest()
+def GetLineCoverage(fits,llist):
+	""" 
+	GETLINECOVERAGE returns the coverage table (see LINECOVERAGE) of a spectrum file
+	and linelist. The table is built once, and kept with the spectrum in SPECCACHE.
+
+	Call - LC=GetLineCoverage(FITS,LLIST)
+
+	"""
+	iwvlngth,ispectrum=specfits(fits)
+	derived=speccache.derived(fits)
+	#Tables are kept for each linelist (identified by its lines and wavelengths, see
+	#LINELISTKEY). The key is found once, when the linelist is loaded.
+	if 'key' not in llist: llist['key']=LineListKey(llist)
+	lkey=llist['key']
+	if 'coverage' not in derived: derived['coverage']={}
+	if lkey not in derived['coverage']: derived['coverage'][lkey]=LineCoverage(iwvlngth,llist)
+	return derived['coverage'][lkey]
+#DOUBLETS is the list of (ION,LINE1,LINE2) doublets searched for by FINDDOUBLETS
+#(LINE1 is the stronger member). The rest wavelengths and f-values come from the linelist.
+doublets=[('CIV','1548','1550'),('SiIV','1393','1402'),('MgII','2796','2803'),\
+	('OVI','1031','1037'),('NV','1238','1242')]
+def NoiseLevel(spectrum):
+	"""
+	NOISELEVEL estimates the (per pixel) noise of a spectrum from the scatter between
+	neighbouring pixels (robust to absorption lines and a varying continuum).
+
+	Call - SIGMA=NoiseLevel(SPECTRUM)
+	"""
+	diff=np.diff(np.asarray(spectrum,dtype=float))
+	diff=diff[np.isfinite(diff)]
+	if len(diff)==0: return np.nan
+	#Median absolute deviation (scaled to a Gaussian sigma) of the differences
+	return 1.4826*np.median(np.abs(diff-np.median(diff)))/np.sqrt(2.0)
+def FindDoublets(wvlngth,spectrum,llist,dblts=None,dv=None,zmin=0.0,zmax=None,nsigma=4.0,nsmooth=3,vsep=300.0,tol=0.3):
+	"""
+	FINDDOUBLETS searches a (continuum normalised) spectrum for absorption doublets
+	(e.g. CIV 1548/1550), and returns the candidate redshifts ranked by score.
+
+	Call - CANDS=FindDoublets(WVLNGTH,SPECTRUM,LLIST,DBLTS=None,DV=None,ZMIN=0.0,ZMAX=None,
+		NSIGMA=4.0,NSMOOTH=3,VSEP=300.0,TOL=0.3)
+
+	INPUTS:
+		WVLNGTH,SPECTRUM - The wavelength (ascending) and normalised flux of the spectrum
+		LLIST - The linelist dictionary (see LOADLINELIST), for the rest wavelengths
+			and f-values of the doublets
+		DBLTS - The list of (ION,LINE1,LINE2) doublets to search for (default DOUBLETS)
+		DV - The step (km/s) of the redshift grid (default, the median pixel size)
+		ZMIN,ZMAX - The redshift range to search
+		NSIGMA - Both members must absorb by more than NSIGMA times the noise
+		NSMOOTH - The flux is averaged over NSMOOTH pixels before the search
+		VSEP - Candidates (of the same doublet) closer than VSEP (km/s) are merged
+		TOL - The fractional tolerance on the optical depth ratio of the members
+
+	OUTPUT:
+		CANDS - List of (SCORE,Z,ION,LINE1,LINE2) tuples, highest SCORE first
+
+	NOTES:
+		For each doublet, the flux at both members' observed wavelengths is found for
+		every redshift of a log(1+z) grid in one pass (NUMPY.INTERP). The optical depth
+		ratio TAU1/TAU2 of an unsaturated doublet is F1*WL1/(F2*WL2) (~2 for CIV), and
+		tends to 1 as the lines saturate, so a ratio between 1 and F1*WL1/(F2*WL2) (within
+		TOL) is expected. Redshifts with a ratio outside that range are penalised.
+		SCORE is the geometric mean of the members' absorption, in units of the noise.
+		Only local peaks of SCORE (at least VSEP apart) are kept.
+	"""
+	if dblts is None: dblts=doublets
+	wvlngth=np.asarray(wvlngth,dtype=float)
+	flux=np.asarray(spectrum,dtype=float)
+	good=np.isfinite(wvlngth)&np.isfinite(flux)
+	wvlngth=wvlngth[good]
+	flux=flux[good]
+	if len(wvlngth)<2*nsmooth: return []
+	#Average the flux over NSMOOTH pixels (with a cumulative sum)
+	if nsmooth>1:
+		csum=np.concatenate([[0.0],np.cumsum(flux)])
+		smooth=(csum[nsmooth:]-csum[:-nsmooth])/nsmooth
+		half=nsmooth//2
+		flux=np.concatenate([flux[:half],smooth,flux[len(smooth)+half:]])
+	sigma=NoiseLevel(spectrum)/np.sqrt(nsmooth)
+	if not sigma>0: sigma=1e-3
+	c=clight
+	if dv is None: dv=c*np.median(np.diff(np.log(wvlngth)))
+	cands=[]
+	for ion,line1,line2 in dblts:
+		if (ion,line1) not in llist or (ion,line2) not in llist: continue
+		wl1,f1=llist[ion,line1]
+		wl2,f2=llist[ion,line2]
+		#Redshifts where both members are in the spectrum
+		zlo=max(zmin,wvlngth[0]/min(wl1,wl2)-1.0)
+		zhi=wvlngth[-1]/max(wl1,wl2)-1.0
+		if zmax is not None: zhi=min(zhi,zmax)
+		if zhi<=zlo: continue
+		#The log(1+z) grid
+		lnz=np.arange(np.log1p(zlo),np.log1p(zhi),dv/c)
+		zs=np.expm1(lnz)
+		#Absorption (1-flux) and optical depth of each member at every redshift
+		d1=1.0-np.interp(wl1*(1.0+zs),wvlngth,flux)
+		d2=1.0-np.interp(wl2*(1.0+zs),wvlngth,flux)
+		floor=max(sigma,1e-3)
+		tau1=-np.log(np.clip(1.0-d1,floor,1.0))
+		tau2=-np.log(np.clip(1.0-d2,floor,1.0))
+		#Expected (unsaturated) ratio, and the ratio found
+		rexp=(f1*wl1)/(f2*wl2)
+		rlo,rhi=min(1.0,rexp),max(1.0,rexp)
+		ratio=np.clip(tau1,1e-6,None)/np.clip(tau2,1e-6,None)
+		#How far (in log) the ratio is outside of the expected range
+		miss=np.log(np.clip(ratio,None,rlo*(1.0-tol))/(rlo*(1.0-tol)))+np.log(np.clip(ratio,rhi*(1.0+tol),None)/(rhi*(1.0+tol)))
+		score=np.sqrt(np.clip(d1,0,None)*np.clip(d2,0,None))/sigma*np.exp(-0.5*(miss/0.2)**2)
+		score[(d1<nsigma*sigma)|(d2<nsigma*sigma)]=0.0
+		#Local peaks of the score
+		peak=np.where((score[1:-1]>0)&(score[1:-1]>=score[:-2])&(score[1:-1]>=score[2:]))[0]+1
+		#Keep the best peaks, at least VSEP apart
+		nsep=max(1,int(round(vsep/dv)))
+		kept=[]
+		for ii in peak[np.argsort(-score[peak])]:
+			if all(abs(ii-jj)>=nsep for jj in kept):
+				kept.append(ii)
+				cands.append((score[ii],zs[ii],ion,line1,line2))
+	cands.sort(reverse=True)
+	return cands
+#COMPANIONS lists the ions commonly seen with each ion (besides the other ions of the same
+#element), used by HYPOTHESISTABLE to score redshift hypotheses.
+companions={'HI':['CII','SiII','SiIII','CIV','SiIV','OVI'],'CIV':['SiIV','NV','OVI'],\
+	'CII':['SiII','OI','FeII'],'SiII':['FeII','OI','AlII'],'MgII':['FeII','MgI'],'OVI':['NV']}
+class HypothesisTable:
+	"""
+	CLASS HYPOTHESISTABLE - Ranks the (ION,LINE) identifications of a feature at a given
+		wavelength. Every line of the linelist gives a redshift hypothesis, scored by how many
+		of its related lines (the strongest lines of the same element, or of its COMPANIONS)
+		absorb at their predicted wavelengths, and whether the redshift is all ready in the log.
+
+	Call - HT=HypothesisTable(LLIST,NSTRONG=8)
+
+	INPUTS:
+		LLIST - The linelist dictionary (see LOADLINELIST)
+		NSTRONG - Only the NSTRONG strongest lines (f*wavelength) of each related ion are checked
+
+	ATTRIBUTES:
+		KEYS - The (ION,LINE) of each line of LLIST
+		CODE - The ion of each line (as an integer)
+		WL,FL - The rest wavelength and f*wavelength (line strength) of each line
+		HYP,REL - The (hypothesis, related line) pairs, as two index arrays into KEYS
+
+	NOTES:
+		The pairs only depend on the linelist, so they are found once. Ranking a feature
+		(see HYPOTHESISTABLE.RANK) then needs one interpolation of the spectrum at
+		all of the predicted wavelengths, whatever the number of lines.
+	"""
+	def __init__(self,llist,nstrong=8):
+		self.keys=sorted(key for key in llist if isinstance(key,tuple))
+		self.wl=np.array([llist[key][0] for key in self.keys],dtype=float)
+		self.fl=np.array([llist[key][1] for key in self.keys],dtype=float)*self.wl
+		#Group the ions by element (e.g. SiII and SiIV are both Si), and by COMPANIONS
+		ions=sorted(set(key[0] for key in self.keys))
+		iion=dict((ion,ii) for ii,ion in enumerate(ions))
+		related=np.zeros((len(ions),len(ions)),dtype=bool)
+		for ii,ion in enumerate(ions):
+			for jj,other in enumerate(ions):
+				if ion.rstrip('IVX')==other.rstrip('IVX'): related[ii,jj]=True
+			for other in companions.get(ion,[]):
+				if other in iion:
+					related[ii,iion[other]]=True
+					related[iion[other],ii]=True
+		self.code=np.array([iion[key[0]] for key in self.keys],dtype=int)
+		#The lines of each ion, and the NSTRONG strongest
+		members=[np.where(self.code==ii)[0] for ii in range(len(ions))]
+		strongest=[mm[np.argsort(-self.fl[mm])][:nstrong] for mm in members]
+		hyp,rel=[],[]
+		for ii,jj in zip(*np.nonzero(related)):
+			hyp.append(np.repeat(members[ii],len(strongest[jj])))
+			rel.append(np.tile(strongest[jj],len(members[ii])))
+		self.hyp=np.concatenate(hyp) if hyp else np.zeros(0,dtype=int)
+		self.rel=np.concatenate(rel) if rel else np.zeros(0,dtype=int)
+		#A line is not related to itself
+		self.hyp,self.rel=self.hyp[self.hyp!=self.rel],self.rel[self.hyp!=self.rel]
+		return
+	def rank(self,wvl,wvlngth,spectrum,error=None,zlogged=None,zmin=-0.01,nsigma=3.0,dvlog=100.0):
+		"""
+		Call - HYPS=HT.rank(WVL,WVLNGTH,SPECTRUM,ERROR=None,ZLOGGED=None,ZMIN=-0.01,NSIGMA=3.0,DVLOG=100.0)
+
+		INPUTS:
+			WVL - The wavelength of the feature
+			WVLNGTH,SPECTRUM,ERROR - The (continuum normalised) spectrum and its error (if
+				None, the noise is estimated with NOISELEVEL)
+			ZLOGGED - The redshifts of the systems in the log
+			ZMIN - Hypotheses below ZMIN are left out
+			NSIGMA - A line absorbs if 1-flux is more than NSIGMA times the error
+			DVLOG - A hypothesis within DVLOG (km/s) of a logged system is in the log
+
+		OUTPUT:
+			HYPS - List of (SCORE,Z,ION,LINE,NDET,NREL,NMISS,LOGGED) tuples, best first. NDET of
+				the NREL related lines (in the spectrum) absorb, and NMISS lines stronger
+				than LINE (of the same ion) do not. LOGGED is True if Z is in the log.
+
+		NOTES:
+			SCORE=NDET+NSAME-2*NMISS (+3 if LOGGED), where NSAME of the absorbing lines are
+			of the same ion, so hypotheses with confirming lines (and without missing
+			strong lines) rank first.
+		"""
+		c=clight
+		wvlngth=np.asarray(wvlngth,dtype=float)
+		flux=np.asarray(spectrum,dtype=float)
+		if error is None: error=np.zeros(len(flux))+NoiseLevel(flux)
+		error=np.asarray(error,dtype=float)
+		good=np.isfinite(wvlngth)&np.isfinite(flux)&np.isfinite(error)
+		wvlngth,flux,error=wvlngth[good],flux[good],error[good]
+		zs=wvl/self.wl-1.0
+		#Predicted wavelength (and absorption) of each related line, for each hypothesis
+		hyp,rel=self.hyp,self.rel
+		wrel=self.wl[rel]*(1.0+zs[hyp])
+		inspec=(wrel>wvlngth[0])&(wrel<wvlngth[-1])
+		absorbs=inspec&(1.0-np.interp(wrel,wvlngth,flux)>nsigma*np.interp(wrel,wvlngth,error))
+		#Lines of the same ion, stronger than the hypothesis, that do not absorb
+		sameion=self.code[rel]==self.code[hyp]
+		missing=inspec&~absorbs&sameion&(self.fl[rel]>=self.fl[hyp])
+		nrel=np.bincount(hyp,weights=inspec,minlength=len(zs))
+		ndet=np.bincount(hyp,weights=absorbs,minlength=len(zs))
+		nsame=np.bincount(hyp,weights=absorbs&sameion,minlength=len(zs))
+		nmiss=np.bincount(hyp,weights=missing,minlength=len(zs))
+		#Hypotheses close to a system in the log
+		logged=np.zeros(len(zs),dtype=bool)
+		if zlogged is not None and len(zlogged)>0:
+			zlogged=np.sort(np.asarray(zlogged,dtype=float))
+			jj=np.clip(np.searchsorted(zlogged,zs),1,len(zlogged))
+			dz=np.minimum(np.abs(zlogged[jj-1]-zs),np.abs(zlogged[np.clip(jj,0,len(zlogged)-1)]-zs))
+			logged=dz/(1.0+zs)*c<dvlog
+		score=ndet+nsame-2*nmiss+3*logged
+		keep=np.where(zs>=zmin)[0]
+		keep=keep[np.lexsort((-ndet[keep],-score[keep]))]
+		return [(score[ii],zs[ii],self.keys[ii][0],self.keys[ii][1],int(ndet[ii]),int(nrel[ii]),int(nmiss[ii]),bool(logged[ii])) for ii in keep]
+def FindAbsorbers(wvlngth,spectrum,error=None,continuum=None,nsigma=5.0,minpix=3):
+	"""
+	FINDABSORBERS finds the absorption features (troughs) in a spectrum, for a
+	catalog of lines to identify.
+
+	Call - TROUGHS=FindAbsorbers(WVLNGTH,SPECTRUM,ERROR=None,CONTINUUM=None,NSIGMA=5.0,MINPIX=3)
+
+	INPUTS:
+		WVLNGTH,SPECTRUM - The wavelength (ascending) and flux of the spectrum
+		ERROR - The (1 sigma) error of the flux. If None, a constant noise is
+			estimated from the spectrum (see NOISELEVEL)
+		CONTINUUM - The continuum of the flux. If None, the flux is taken to be
+			normalised (i.e. the continuum is 1)
+		NSIGMA - Troughs must have an equivalent width of at least NSIGMA times its error
+		MINPIX - Troughs must be at least MINPIX pixels wide
+
+	OUTPUT:
+		TROUGHS - A dictionary of NUMPY arrays (one element per trough, in order of wavelength):
+			TROUGHS['wmin'],TROUGHS['wmax'] - The wavelength range of the trough
+			TROUGHS['imin'],TROUGHS['imax'] - The pixel range (IMAX is one past the end)
+			TROUGHS['centroid'] - The (absorption weighted) centroid wavelength
+			TROUGHS['dv'] - The velocity extent (km/s)
+			TROUGHS['ew'],TROUGHS['ewerr'] - The observed equivalent width and its error (Angstroms)
+			TROUGHS['sig'] - The significance (EW/EWERR)
+
+	NOTES:
+		A trough is a run of consecutive pixels absorbed by more than the 1 sigma error.
+		The runs are found from the changes of the absorbed/not absorbed mask, and the
+		sums over each run use NUMPY.ADD.REDUCEAT, so the time taken is linear in the
+		number of pixels (~1 s for 10^7 pixels).
+	"""
+	wvlngth=np.asarray(wvlngth,dtype=float)
+	flux=np.asarray(spectrum,dtype=float)
+	if continuum is not None: flux=flux/np.asarray(continuum,dtype=float)
+	if error is None: error=np.zeros(len(flux))+NoiseLevel(flux)
+	else:
+		error=np.asarray(error,dtype=float)
+		if continuum is not None: error=error/np.asarray(continuum,dtype=float)
+	#Pixel widths
+	dwl=np.gradient(wvlngth) if len(wvlngth)>1 else np.ones(len(wvlngth))
+	depth=1.0-flux
+	#Absorbed pixels (bad pixels are never absorbed)
+	absorbed=(depth>error)&np.isfinite(depth)&np.isfinite(error)
+	#Start/end of each run of absorbed pixels
+	edges=np.diff(np.concatenate([[0],absorbed.view(np.int8),[0]]))
+	starts=np.flatnonzero(edges==1)
+	ends=np.flatnonzero(edges==-1)
+	names=['wmin','wmax','imin','imax','centroid','dv','ew','ewerr','sig']
+	if len(starts)==0: return dict((name,np.zeros(0)) for name in names)
+	#Sums over each run (REDUCEAT sums from each start to the next start, so
+	#the unabsorbed pixels in between are zeroed)
+	wdepth=np.where(absorbed,depth*dwl,0.0)
+	ew=np.add.reduceat(wdepth,starts)
+	ewvar=np.add.reduceat(np.where(absorbed,(error*dwl)**2,0.0),starts)
+	wsum=np.add.reduceat(wdepth*wvlngth,starts)
+	ewerr=np.sqrt(ewvar)
+	sig=ew/np.where(ewerr>0,ewerr,np.inf)
+	keep=(sig>=nsigma)&(ends-starts>=minpix)
+	starts=starts[keep]
+	ends=ends[keep]
+	troughs={'imin':starts,'imax':ends,'ew':ew[keep],'ewerr':ewerr[keep],'sig':sig[keep]}
+	troughs['wmin']=wvlngth[starts]
+	troughs['wmax']=wvlngth[ends-1]
+	troughs['centroid']=wsum[keep]/ew[keep]
+	troughs['dv']=(troughs['wmax']-troughs['wmin'])/troughs['centroid']*clight
+	return troughs
+def GetAbsorbers(fits):
+	""" 
+	GETABSORBERS returns the troughs (see FINDABSORBERS) of a spectrum file, using its
+	error if it has one (see SPECERROR). They are found once, and kept with the spectrum
+	in SPECCACHE.
+
+	Call - TROUGHS=GetAbsorbers(FITS)
+
+	"""
+	iwvlngth,ispectrum=specfits(fits)
+	error=SpecError(fits)
+	derived=speccache.derived(fits)
+	if 'absorbers' not in derived:
+		derived['absorbers']=FindAbsorbers(iwvlngth,ispectrum,error)
+	return derived['absorbers']
+def ExplainedTroughs(troughs,logindex):
+	"""
+	EXPLAINEDTROUGHS finds which troughs (see FINDABSORBERS) are explained by lines all ready
+	in the log, i.e. have a logged line (see LOGLINEINDEX) within their wavelength range.
+
+	Call - EXPLAINED=ExplainedTroughs(TROUGHS,LOGINDEX)
+
+	OUTPUT:
+		EXPLAINED - A NUMPY boolean array (TRUE if the trough is explained)
+	"""
+	#Number of logged lines below the start and up to the end of each trough
+	nlo=np.searchsorted(logindex.wvls,troughs['wmin'],'left')
+	nhi=np.searchsorted(logindex.wvls,troughs['wmax'],'right')
+	return nhi>nlo
+def WriteAbsorbers(troughs,outfile=None,explained=None):
+	"""
+	WRITEABSORBERS writes the catalog of troughs (see FINDABSORBERS) as a semicolon delimited
+	table (to the screen if OUTFILE is None) with the columns:
+		CENTROID; WMIN; WMAX; DV; EW; EWERR; SIG; (EXPLAINED;)
+
+	Call - WriteAbsorbers(TROUGHS,OUTFILE=None,EXPLAINED=None)
+	"""
+	f=sys.stdout
+	if outfile is not None: f=open(outfile,'w')
+	f.write('#centroid;\twmin;\twmax;\tdv;\tew;\tewerr;\tsig;')
+	if explained is not None: f.write('\texplained;')
+	f.write('\n')
+	for ii in range(len(troughs['centroid'])):
+		f.write('%.3f;\t%.3f;\t%.3f;\t%.1f;\t%.4f;\t%.4f;\t%.1f;'%tuple(troughs[name][ii] for name in \
+			['centroid','wmin','wmax','dv','ew','ewerr','sig']))
+		if explained is not None: f.write('\t%i;'%explained[ii])
+		f.write('\n')
+	if outfile is not None: f.close()
+	return
+def MeasureLog(log,llist,wvlngth,spectrum,error=None,nsigma=3.0):
+	"""
+	MEASURELOG measures the rest-frame equivalent width, the apparent optical depth (AOD)
+	column density, and the velocity centroid of every line in the log, between its
+	logged velocity limits (VMIN/VMAX).
+
+	Call - MEAS=MeasureLog(LOG,LLIST,WVLNGTH,SPECTRUM,ERROR=None,NSIGMA=3.0)
+
+	INPUTS:
+		LOG - The LOGSTORE (see LOADLOG)
+		LLIST - The linelist dictionary (see LOADLINELIST), for the rest wavelengths and f-values
+		WVLNGTH,SPECTRUM - The wavelength (ascending) and continuum normalised flux
+		ERROR - The (1 sigma) error of the flux. If None, a constant noise is estimated
+			from the spectrum (see NOISELEVEL)
+		NSIGMA - Upper limits (FLAG 4) are the measured value plus NSIGMA times the error
+
+	OUTPUT:
+		MEAS - Dictionary of the measurements (one element per line, in LOG.KEYS() order):
+			MEAS['keys'] - The (Z,ION,LINE) of each line
+			MEAS['flag'] - The FLAG of each line (integer)
+			MEAS['vmin'],MEAS['vmax'] - The velocity limits (km/s)
+			MEAS['npix'] - The number of pixels measured
+			MEAS['ew'],MEAS['ewerr'] - Rest-frame equivalent width and its error (Angstroms)
+			MEAS['n'],MEAS['nerr'] - AOD column density and its error (cm^-2)
+			MEAS['vcen'] - Optical depth weighted velocity centroid (km/s)
+			MEAS['limit'] - '<' for upper limits (FLAG 4), '>' for lower limits (FLAG 8),
+				'=' otherwise. For limits, EW and N are the limiting values.
+
+	NOTES:
+		Lines with FLAG 0 (no good/skip), lines not in LLIST, and lines with no pixels
+		between VMIN and VMAX are left out.
+		The AOD column density is N=3.768E14/(F*WL)*INTEGRAL(TAU DV), with TAU=LN(1/FLUX)
+		(flux is limited to the noise level, so saturated pixels give a finite TAU).
+		All sums use cumulative sums over the spectrum, so every line is measured at
+		once (the time taken is linear in the number of pixels plus the number of lines).
+	"""
+	wvlngth=np.asarray(wvlngth,dtype=float)
+	flux=np.asarray(spectrum,dtype=float)
+	if error is None: error=np.zeros(len(flux))+NoiseLevel(flux)
+	error=np.asarray(error,dtype=float)
+	win=LineWindows(log,llist,wvlngth)
+	if debug: print "MeasureLog: measuring %d of %d lines"%(len(win['keys']),len(log.keys()))
+	ew,ewerr,n,nerr,vcen=LineSums(win,wvlngth,flux,error)
+	#Limits (upper limits take precedence)
+	flag=win['flag']
+	upper=(flag>0)&(flag&4>0)
+	lower=(flag>0)&(flag&8>0)&~upper
+	limit=np.where(upper,'<',np.where(lower,'>','='))
+	ew=np.where(upper,np.clip(ew,0,None)+nsigma*ewerr,ew)
+	n=np.where(upper,np.clip(n,0,None)+nsigma*nerr,n)
+	return {'keys':win['keys'],'flag':flag,'vmin':win['vmin'],'vmax':win['vmax'],'npix':win['i1']-win['i0'],\
+		'ew':ew,'ewerr':ewerr,'n':n,'nerr':nerr,'vcen':vcen,'limit':limit}
+def LineWindows(log,llist,wvlngth):
+	"""
+	LINEWINDOWS finds the pixels between the velocity limits of every (measurable) line in the log.
+
+	Call - WIN=LineWindows(LOG,LLIST,WVLNGTH)
+
+	OUTPUT:
+		WIN - Dictionary with (one element per line, in LOG.KEYS() order) 'keys', 'flag', 'z',
+			'vmin', 'vmax', 'wobs' (observed wavelength), 'wrest', 'fval', and the
+			pixel range 'i0' to 'i1'-1 of each line.
+
+	NOTES:
+		Lines with FLAG 0, lines not in LLIST, and lines with no pixels are left out.
+	"""
+	c=clight
+	cols=log.arrays()
+	keys=cols['keys']
+	flag=cols['flagi']
+	#Rest wavelength and f-value of each line (NaN if not in LLIST)
+	rest=np.array([llist[key[1:]] if key[1:] in llist else (np.nan,np.nan) for key in keys],dtype=float).reshape(-1,2)
+	zs=cols['zf']
+	vmin,vmax=cols['vminf'],cols['vmaxf']
+	wobs=rest[:,0]*(1.0+zs)
+	#Pixel range of each line (I0 to I1-1)
+	i0=np.searchsorted(wvlngth,wobs*(1.0+vmin/c),'left')
+	i1=np.searchsorted(wvlngth,np.where(np.isfinite(wobs),wobs*(1.0+vmax/c),-np.inf),'right')
+	use=(flag!=0)&np.isfinite(wobs)&np.isfinite(vmin)&np.isfinite(vmax)&(i1>i0)
+	return {'keys':[key for key,ok in zip(keys,use) if ok],'flag':flag[use],'z':zs[use],'vmin':vmin[use],\
+		'vmax':vmax[use],'wobs':wobs[use],'wrest':rest[use,0],'fval':rest[use,1],'i0':i0[use],'i1':i1[use]}
+def LineSums(win,wvlngth,flux,error,dwl=None):
+	"""
+	LINESUMS measures the lines in the windows WIN (see LINEWINDOWS), using cumulative sums
+	along the last axis of FLUX, so FLUX can be a single spectrum or a (NREAL,NPIX) array of
+	realisations (see MONTECARLOLOG).
+
+	Call - EW,EWERR,N,NERR,VCEN=LineSums(WIN,WVLNGTH,FLUX,ERROR,DWL=None)
+
+	OUTPUT:
+		Arrays of shape (NLINES) (or (NREAL,NLINES)) of the rest-frame equivalent width and
+		its error (Angstroms), the AOD column density and its error (cm^-2), and the velocity
+		centroid (km/s). See MEASURELOG.
+
+	NOTES:
+		DWL are the pixel widths (by default, from the spacing of WVLNGTH).
+	"""
+	c=clight
+	i0,i1,zs,wobs=win['i0'],win['i1'],win['z'],win['wobs']
+	#Pixel widths, optical depth (and its error)
+	if dwl is None: dwl=np.gradient(wvlngth) if len(wvlngth)>1 else np.ones(len(wvlngth))
+	floor=np.clip(error,1e-3,None)
+	tau=-np.log(np.clip(flux,floor,None))
+	tauerr=error/np.clip(flux,floor,None)
+	#Cumulative sums (with a leading zero) of each integrand
+	def total(vals):
+		vals=np.where(np.isfinite(vals),vals,0.0)
+		cum=np.zeros(vals.shape[:-1]+(vals.shape[-1]+1,))
+		np.cumsum(vals,axis=-1,out=cum[...,1:])
+		return cum[...,i1]-cum[...,i0]
+	ew=total((1.0-flux)*dwl)/(1.0+zs)
+	ewerr=np.sqrt(total((error*dwl)**2))/(1.0+zs)
+	taudl=total(tau*dwl)
+	#Integral of TAU dv (dv=c*dwl/wobs), and the centroid
+	aod=3.768E14/(win['fval']*win['wrest'])*c/wobs
+	n=aod*taudl
+	nerr=aod*np.sqrt(total((tauerr*dwl)**2))
+	vcen=c*(total(tau*dwl*wvlngth)/np.where(taudl!=0,taudl,np.nan)/wobs-1.0)
+	return ew,ewerr,n,nerr,vcen
+def MonteCarloLog(log,llist,wvlngth,spectrum,error=None,nreal=1000,seed=0,index=0,maxmem=2**28):
+	"""
+	MONTECARLOLOG measures the lines in the log (as MEASURELOG), and their Monte Carlo errors:
+	the flux is perturbed by its error NREAL times, and every realisation is measured.
 
-			Each line in the file must contain information on each spectral line
-			of interest in the format (whitespace delimited):
-				REST_WAVELENGTH ION SHORT_WL OSCILLATOR_STRENGTH
-	
-				REST_WAVELENGTH - The rest wavelength of the spectral line (e.g. 1215.6701)
-				ION - The species (including ionization state) of the spectral line (e.g. HI)
-				SHORT_WL - A short identifier of the wavelength (e.g. 1215)
-					Needed to descrimante between absorption lines of a given ION
-				OSCILLATOR_STRENGTH - The oscillator strength of the feature
-					This is only used for display purposes. (e.g. 0.4164)
-	
-				EXAMPLE:
-				1215.6701 HI 1215 0.4164
-	
-			If Ly-alpha not present, LOADLINELIST will add it by default
-			MUST CONTAIN THE SAME NUMBER OF COLUMNS IN EACH LINE (unless commented)
-			Can use '#' at the start of any line to comment
+	Call - MEAS=MonteCarloLog(LOG,LLIST,WVLNGTH,SPECTRUM,ERROR=None,NREAL=1000,SEED=0,INDEX=0,MAXMEM=2**28)
 
-	OUTPUT: LLIST - A dictionary with the linelist information. LLIST is structured as follows:
-		LLIST['ions'] - A list of all the ion species in the linelist (ION column)
-		LLIST['lines'] - A dictionary (keyed by an ION in LLIST['ions']) of all the
-			SHORT_WL identifiers for a given ION
-	
-		LLIST['lines'][ION] is a list of all the SHORT_WL for a given ION
-	
-		LLIST[ION,SHORT_WL] - A tuple with (WAVELENGTH,OSCILLATOR_STRENGTH) for 
-			the spectral line identified ION,SHORT_WL
-	
-	NOTES
-		For simplicity, SHORT_WL is abbreviated LINE in the code. 
-		Will add Ly-alpha (HI 1215) by default if not present in FILE
+	INPUTS:
+		LOG,LLIST,WVLNGTH,SPECTRUM,ERROR - As in MEASURELOG (if ERROR is None, the noise
+			is estimated from the spectrum)
+		NREAL - The number of realisations
+		SEED,INDEX - The random numbers are drawn from RANDOMSTATE([SEED,INDEX]), so each
+			sightline (INDEX) has its own reproducible stream
+		MAXMEM - The (approximate) memory budget, in bytes, of the realisations
 
-"""
-	#Read in FILE.
-	#FILE in format: wvl	ION	lineID	fval	
-	data=np.genfromtxt(file,comments='#',dtype=type('str'))
-	#Create LLIST, the linelist dictionary
-	llist={}
-	#Create the list of ions and lines
-	llist['ions']=[]
-	llist['lines']={}
-	#For each line in FILE
-	for ii in range(len(data)):
-		ion=data[ii][1]
-		line=data[ii][2]
-		#Convert WAVELENGTH and OSCILLATOR_STRENGTH to a float
-		wvl=float(data[ii][0])#WAVELENGTH
-		f=float(data[ii][3])#OSCILLATOR_STRENGTH
-		#Save tuple to list
-		llist[ion,line]=wvl,f
-		#Check to see if ION or LINE (aka SHORT_WL) are in LLIST
-		#'ions' or 'lines' lists. If not, add them.
-		if ion not in llist['ions']:
-			llist['ions'].append(ion)
-			llist['lines'][ion]=[]
-		if line not in llist['lines'][ion]: llist['lines'][ion].append(line)
-	#Line list requires Ly-alpha. Add to LLIST if not present.
-	if ('HI','1215') not in llist:
-		llist['HI','1215']=1215.6701,0.41640
-	#REturn LLIST
-	return llist	
+	OUTPUT:
+		MEAS - The output of MEASURELOG with the added keys:
+			MEAS['ewmc'],MEAS['nmc'] - The standard deviation of the rest-frame equivalent
+				width and AOD column density of the realisations
+			MEAS['nreal'] - The number of realisations
+
+	NOTES:
+		Only the pixels inside a line window are perturbed, and the realisations are drawn
+		in batches (as large as MAXMEM allows) into one array that is reused for every line
+		and batch. The results do not depend on MAXMEM (the random numbers are drawn in order).
+	"""
+	wvlngth=np.asarray(wvlngth,dtype=float)
+	flux=np.asarray(spectrum,dtype=float)
+	if error is None: error=np.zeros(len(flux))+NoiseLevel(flux)
+	error=np.asarray(error,dtype=float)
+	meas=MeasureLog(log,llist,wvlngth,flux,error)
+	win=LineWindows(log,llist,wvlngth)
+	dwl=np.gradient(wvlngth) if len(wvlngth)>1 else np.ones(len(wvlngth))
+	#Keep only the pixels inside a line window (PIX), and shift the windows to match
+	cover=np.zeros(len(wvlngth)+1,dtype=int)
+	np.add.at(cover,win['i0'],1)
+	np.add.at(cover,win['i1'],-1)
+	pix=np.flatnonzero(np.cumsum(cover)[:-1]>0)
+	newpos=np.cumsum(np.cumsum(cover)[:-1]>0)-1
+	win=dict(win)
+	win['i0']=newpos[win['i0']]
+	win['i1']=win['i0']+meas['npix']
+	flux,error,dwl,wvl=flux[pix],error[pix],dwl[pix],wvlngth[pix]
+	#Measured values (the sums are of the deviations from these)
+	ew0,ewerr,n0,nerr,vcen=LineSums(win,wvl,flux,error,dwl)
+	#Batch size from the memory budget (LINESUMS needs ~10 arrays of the realisations' size)
+	nbatch=int(max(1,min(nreal,maxmem//(80*max(len(pix),1)))))
+	realisations=np.empty((nbatch,len(pix)))
+	rs=np.random.RandomState([seed,index])
+	sums=np.zeros((4,len(ew0)))
+	ndone=0
+	while ndone<nreal:
+		nb=min(nbatch,nreal-ndone)
+		real=realisations[:nb]
+		np.multiply(rs.standard_normal((nb,len(pix))),error,out=real)
+		real+=flux
+		ew,ewerr,n,nerr,vcen=LineSums(win,wvl,real,error,dwl)
+		sums+=[np.nansum(ew-ew0,axis=0),np.nansum((ew-ew0)**2,axis=0),np.nansum(n-n0,axis=0),np.nansum((n-n0)**2,axis=0)]
+		ndone+=nb
+	meas['ewmc']=np.sqrt(np.clip(sums[1]/nreal-(sums[0]/nreal)**2,0,None))
+	meas['nmc']=np.sqrt(np.clip(sums[3]/nreal-(sums[2]/nreal)**2,0,None))
+	meas['nreal']=nreal
+	return meas
+def MeasureSightline(task):
+	"""
+	MEASURESIGHTLINE runs MONTECARLOLOG on one spectrum/logfile pair, and writes the
+	measurements to a file (see WRITEMEASUREMENTS). Run in the worker processes of MONTECARLOLOGS.
+
+	Call - OUTFILE,NLINES=MeasureSightline((INDEX,FITS,LOGFILE,LLISTFILE,OUTFILE,NREAL,SEED,MAXMEM))
+	"""
+	index,fits,logfile,llistfile,outfile,nreal,seed,maxmem=task
+	if ('llist',llistfile) not in batchcache: batchcache['llist',llistfile]=LoadLineList(llistfile)
+	wvlngth,spectrum=specfits(fits)
+	meas=MonteCarloLog(LoadLog(logfile),batchcache['llist',llistfile],wvlngth,spectrum,SpecError(fits),\
+		nreal=nreal,seed=seed,index=index,maxmem=maxmem)
+	WriteMeasurements(meas,outfile)
+	return outfile,len(meas['keys'])
+def MonteCarloLogs(llistfile,outdir,pairs,nreal=1000,seed=0,nproc=None,maxmem=2**28):
+	"""
+	MONTECARLOLOGS measures the lines (with Monte Carlo errors, see MONTECARLOLOG) in the
+	logs of many spectra, one sightline per worker process.
+
+	Call - MonteCarloLogs(LLISTFILE,OUTDIR,PAIRS,NREAL=1000,SEED=0,NPROC=None,MAXMEM=2**28)
+
+	INPUTS:
+		LLISTFILE - The input linelist filename
+		OUTDIR - The directory for the output tables (created if needed). Each logfile is
+			measured to OUTDIR/<SPECTRUM>_<LOGFILE>.meas (see PAIRNAME)
+		PAIRS - A list of (SPECTRUM,LOGFILE) filename pairs
+		NREAL,SEED,MAXMEM - As in MONTECARLOLOG (MAXMEM is per process). The I-th pair is
+			given the random stream [SEED,I], so the results do not depend on NPROC.
+		NPROC - The number of worker processes (by default, the number of CPUs)
+
+	NOTES:
+		Run from the command line with:
+			tb_linefinder.py --measure-mc <LINELIST> <OUTDIR> <SPECTRUM>:<LOGFILE> [...] [--nreal=1000] [--seed=0] [--nproc=N] [--maxmem=256]
+		(with --maxmem in MB)
+	"""
+	if nproc is None: nproc=multiprocessing.cpu_count()
+	if not os.path.isdir(outdir): os.makedirs(outdir)
+	tasks=[]
+	used=set()
+	for ii,(fits,logfile) in enumerate(pairs):
+		outfile=os.path.join(outdir,PairName(fits,logfile,ii,used)+'.meas')
+		tasks.append((ii,fits,logfile,llistfile,outfile,nreal,seed,maxmem))
+	print "Measuring %d sightlines (%d realisations) with %d process(es)"%(len(tasks),nreal,nproc)
+	t0=time.time()
+	if nproc>1:
+		pool=multiprocessing.Pool(nproc)
+		results=pool.imap_unordered(MeasureSightline,tasks)
+	else:
+		pool=None
+		results=(MeasureSightline(task) for task in tasks)
+	for ii,(outfile,nlines) in enumerate(results):
+		print "[%d/%d] %s (%d lines) %.1f s"%(ii+1,len(tasks),outfile,nlines,time.time()-t0)
+	if pool is not None:
+		pool.close()
+		pool.join()
+	return
+def WriteMeasurements(meas,outfile=None):
+	"""
+	WRITEMEASUREMENTS writes the measurements of MEASURELOG as a semicolon delimited table
+	(to the screen if OUTFILE is None) with the columns:
+		Z; ION; LINE; FLAG; VMIN; VMAX; NPIX; EW; EWERR; LIMIT; LOGN; LOGNERR; VCEN;
+	EW is the rest-frame equivalent width (mA), LOGN the log10 AOD column density (cm^-2),
+	LOGNERR its error (dex), and VCEN the velocity centroid (km/s). Measurements from
+	MONTECARLOLOG have the added columns EWMC (mA) and LOGNMC (dex), the Monte Carlo errors.
+
+	Call - WriteMeasurements(MEAS,OUTFILE=None)
+	"""
+	f=sys.stdout
+	if outfile is not None: f=open(outfile,'w')
+	mc='ewmc' in meas
+	f.write('#z;\t\tIon;\tline;\tflag;\tvmin;\tvmax;\tnpix;\tEW(mA);\tEWerr;\tlimit;\tlogN;\tlogNerr;\tvcen;')
+	if mc: f.write('\tEWmc;\tlogNmc;')
+	f.write('\n')
+	for ii,(z,ion,line) in enumerate(meas['keys']):
+		n,nerr=meas['n'][ii],meas['nerr'][ii]
+		logn=np.log10(n) if n>0 else np.nan
+		lognerr=nerr/n/np.log(10.0) if n>0 else np.nan
+		f.write('%s;\t%s;\t%s;\t%i;\t%.1f;\t%.1f;\t%i;\t%.1f;\t%.1f;\t%s;\t%.3f;\t%.3f;\t%.1f;'%(z,ion,line,\
+			meas['flag'][ii],meas['vmin'][ii],meas['vmax'][ii],meas['npix'][ii],1000*meas['ew'][ii],\
+			1000*meas['ewerr'][ii],meas['limit'][ii],logn,lognerr,meas['vcen'][ii]))
+		if mc: f.write('\t%.1f;\t%.3f;'%(1000*meas['ewmc'][ii],meas['nmc'][ii]/n/np.log(10.0) if n>0 else np.nan))
+		f.write('\n')
+	if outfile is not None: f.close()
+	return
 class LineAdder:
 	""" 
 	CLASS LINEADDER - The graphical interface for checking all spectral lines in
@@ -741,12 +3483,16 @@ class LineAdder:
 		for selecting which lines the user wants to add to the LOG dictionary
 
 
-	Call - LA=LineAdder(RADIOLIST,VELPLOTWIN)
+	Call - LA=LineAdder(RADIOLIST,VELPLOTWIN,PAGESIZE=None,ONPAGE=None)
 
 	INPUTS: RADIOLIST - A list of all the spectral lines available to generate
 			the Checkbuttons for selection. Each element in RADIOLIST
 			is a tuple of (ION,LINE) (the spectrl line key in LLIST dictionary)
 		VELPLOTWIN - The TKinter Window that will contain the widget for selecting lines
+		PAGESIZE - The number of Checkbuttons shown at once (one page). If None, all
+			of them are shown.
+		ONPAGE - A function called with the page number when the page is changed
+			(e.g. to show the velocity profiles of the page)
 
 	ATTRIBUTES:
 		LA.ADDLINES - A dictionary with all the spectral lines selected by the Checkbuttons.
@@ -754,11 +3500,15 @@ class LineAdder:
 			depending if the corresponding Checkbutton was clicked (TRUE) or not (FALSE)
 		LA.MASTER - The master TKinter window (VELPLOTWIN)
 		LA.POPUP - The Frame of the TKinter window (i.e. the popup menu)
+		LA.PAGEFRAME - The Frame (in LA.POPUP) with the Checkbuttons of the page shown
+		LA.PAGE,LA.NPAGE - The page shown, and the number of pages
+		LA.PAGELABEL - The label showing the page number
 		LA.VARLIST - A 	dictionary with the variables that contain whether a given
 			Checkbutton has been pressed or not. VARLIST is keyed by each element
-			in RADIOLIST, and is a TKINTER.BOOLEANVAR.
+			in RADIOLIST shown so far, and is a TKINTER.BOOLEANVAR.
 		LA.SAVEBUTTON - THe widget button for ending the widget to enable saving
 			information to LOG dictionary.
+		LA.SHOWPAGE(PAGE) - Shows the Checkbuttons of page PAGE (and runs ONPAGE)
 		LA.CLOSELAMENU - A function to close VELPLOTWIN and return the class stuff
 			back to the place where LINEADDER was called.
 
@@ -768,37 +3518,77 @@ class LineAdder:
 	
 		The grid of Checkbuttons will have the same layout as the figure showing
 		the velocity plots corresponding to each Checkbutton.
+
+		The Checkbuttons are only made for the page shown, and the lines checked are
+		kept when changing pages (with the PREV/NEXT buttons, or the Page Up/Page Down keys).
 	
 		On pressing the SAVEBUTTON, VELPLOTWIN will be destroyed.
 
 	"""
 	#Intialize the class when called
-	def __init__(self,radiolist,VelPlotWin):
+	def __init__(self,radiolist,VelPlotWin,pagesize=None,onpage=None):
 		if debug: print "Initialize LineAdder Function"
 		#Define ADDLINES and populate each spectral line key
 		#from RADIOLIST with FALSE value (i.e. do not add line)
 		self.addlines={}
 		for key in radiolist:self.addlines[key]=False
+		self.radiolist=radiolist
+		#The number of pages of Checkbuttons
+		if pagesize is None: pagesize=max(1,len(radiolist))
+		self.pagesize=pagesize
+		self.npage=max(1,(len(radiolist)+pagesize-1)//pagesize)
+		self.page=0
+		self.onpage=onpage
 		#Define the parent window, and set up Tkinter frame
 		self.master=VelPlotWin
 		self.popup = Tkinter.Frame(self.master)
 		self.popup.grid()
 		self.master.title('LineAdder')
-		#Generate list of lines and radio buttons
+		#Generate list of lines and radio buttons (as each page is shown)
 		self.varlist={}
-		#ROW is the row number in the LA.POPUP grid
+		self.pageframe=None
+		#NCOL is the number of columns (set to 3) of Checkbuttons
+		ncol=3
+		#Buttons to change the page (if there is more than one)
+		if self.npage>1:
+			prevbutton=Tkinter.Button(self.popup,text="< Prev",command=lambda:self.showpage(self.page-1))
+			prevbutton.grid(column=0,row=2,sticky='EW')
+			self.pagelabel=Tkinter.Label(self.popup,text='')
+			self.pagelabel.grid(column=1,row=2,sticky='EW')
+			nextbutton=Tkinter.Button(self.popup,text="Next >",command=lambda:self.showpage(self.page+1))
+			nextbutton.grid(column=2,row=2,sticky='EW')
+			self.master.bind('<Prior>',lambda event:self.showpage(self.page-1))
+			self.master.bind('<Next>',lambda event:self.showpage(self.page+1))
+		self.showpage(0,callback=False)
+		#Define the "Save to Log" button for exiting the VELPLOTWIN window
+		#This will run the function CLOSELAMENU (below)
+		self.savebutton=Tkinter.Button(self.popup,text="Save to Log", command=self.closeLAMenu)#Runs OnFitButton function when clicked
+		self.savebutton.grid(column=0,row=3,columnspan=ncol,sticky='EW')
+		#Tell VELPLOTWIN to wait until window closes.
+		self.popup.wait_window()
+
+	#Function to show the Checkbuttons of page PAGE (and run LA.ONPAGE, if CALLBACK)
+	def showpage(self,page,callback=True):
+		if page<0 or page>=self.npage: return
+		self.page=page
+		#Remove the Checkbuttons of the previous page
+		if self.pageframe is not None: self.pageframe.destroy()
+		self.pageframe=Tkinter.Frame(self.popup)
+		self.pageframe.grid(column=0,row=1,columnspan=3,sticky='EW')
+		#ROW is the row number in the LA.PAGEFRAME grid
 		row=1
 		#NCOL is the number of columns (set to 3) of Checkbuttons
 		ncol=3
 		#A dummy variable to keep track of which column the next
 		#Checkbutton should occupy
 		colnum=0
-		#FOr each spectral line key, create a Checkbutton
-		#and the associated Tkinter variable for that button.
-		for key in radiolist:
-			self.varlist[key]=Tkinter.BooleanVar()
-			self.varlist[key].set(self.addlines[key])
-			rb=Tkinter.Checkbutton(self.popup,text='%s (%s)'%key,\
+		#FOr each spectral line key on the page, create a Checkbutton
+		#and the associated Tkinter variable for that button (if new).
+		for key in self.radiolist[page*self.pagesize:(page+1)*self.pagesize]:
+			if key not in self.varlist:
+				self.varlist[key]=Tkinter.BooleanVar()
+				self.varlist[key].set(self.addlines[key])
+			rb=Tkinter.Checkbutton(self.pageframe,text='%s (%s)'%key,\
 				variable=self.varlist[key])
 			rb.grid(column=colnum,row=row,sticky='EW')
 			colnum+=1#Increment COLNUM for next Checkbutton
@@ -807,15 +3597,9 @@ class LineAdder:
 			if colnum==ncol:
 				colnum=0
 				row+=1
-		#If the row does not have enough buttons to fill it, increment
-		#ROW
-		if colnum>0: row+=1
-		#Define the "Save to Log" button for exiting the VELPLOTWIN window
-		#This will run the function CLOSELAMENU (below)
-		self.savebutton=Tkinter.Button(self.popup,text="Save to Log", command=self.closeLAMenu)#Runs OnFitButton function when clicked
-		self.savebutton.grid(column=0,row=row,columnspan=ncol,sticky='EW')
-		#Tell VELPLOTWIN to wait until window closes.
-		self.popup.wait_window()
+		if self.npage>1: self.pagelabel.config(text='Page %d of %d'%(page+1,self.npage))
+		if callback and self.onpage is not None: self.onpage(page)
+		return
 
 	#Function to close the LineAdder menu (i.e. VELPLOTWIN)
 	def closeLAMenu(self):
@@ -831,112 +3615,162 @@ class LineAdder:
 		self.popup.destroy()
 		self.master.destroy()
 		return
-def VelPlots(log,z,llist,fits,VelPlotWin,VPfig,VelFig):
-	""" 
-	VELPLOTS - The function that plots all lines for a provided redshift 
-		within provided linelist LLIST as a velocity profile. It will
-		then spawn a Tkinter window to select the spectral lines to
-		add to the LOG dictionary using the LINEADDER
-		class (defined above). Upon line selection, the user will be queryed
-		about the COLOUR,FLAG, VMIN/VMAX and NOTE for each spectral line added
-		to the log with the GETUSERINPUT.
-
-	Call - LOG=VelPlots(LOG,Z,LLIST,FITS,VELPLOTWIN,VPFIG, VELFIG)
-
-	INPUTS: LOG - The LOG dictionary defined from READLOG with the
-			spectral information
-		Z - The redshift of the system of interest (float)
-		LLIST - The linelist dictionary LLIST from input linelist file
-		FITS - The name of the input spectrum ASCII file to be plotted
-		VELPLOTWIN - The TKinter window that contains the matplotlib Canvas
-		VELFIG - The matplotlib TKagg canvas for velocity profiles in VELPLOTWIN window
-		VPFIG - The matplotlib figure embedded in the VELFIG canvas
+def SetupVelFig(VPfig):
+	"""
+	SETUPVELFIG sets up a matplotlib figure for the velocity profiles (see DRAWVELPANELS),
+	with one label for the x and y axis of all the panels.
 
-	OUTPUT: LOG - The edited LOG dictionary inputted into VELPLOTS.
+	Call - SetupVelFig(VPFIG)
+	"""
+	#BIGAX is the full axes instance for the entire figure.
+	bigax = VPfig.add_subplot(111)    # The big subplot
+	#BIGAX is used to set up one label for the x and y axis....
+	#All the tick marks, etc, need to be turned off
+	bigax.spines['top'].set_color('none')
+	bigax.spines['bottom'].set_color('none')
+	bigax.spines['left'].set_color('none')
+	bigax.spines['right'].set_color('none')
+	#bigax.xaxis.tick_labels([])
+	#bigax.yaxis.tick_labels([])
+	bigax.tick_params(labelcolor='none', top='off', bottom='off', left='off', right='off')
+	#Label axes in BIGAX
+	bigax.set_xlabel(r'Relative Velocity (km s$^{-1}$)')
+	bigax.set_ylabel(r'Flux')
+	#Set up the spacing in between subplots
+	VPfig.subplots_adjust(wspace=0.3, hspace=0.5)
+	return
+def VelPanelData(log,z,llist,fits,logindex,lkeys,vmin=-1000,vmax=1000):
+	"""
+	VELPANELDATA gets what is plotted in the velocity profile panels (see DRAWVELPANELS)
+	of the lines LKEYS at redshift Z, without plotting anything (so the next page can be
+	found before it is shown).
 
-	NOTES:
-		The layout of the VELPLOTWIN canvas should be in the same order
-		as the Checkbuttons that appear in the LINEADDER GUI window. It
-		will have 3 columns total, and as many rows as needed for each 
-		spectral line within the wavelength range of the spectrum.
+	Call - DATA=VelPanelData(LOG,Z,LLIST,FITS,LOGINDEX,LKEYS,VMIN=-1000,VMAX=1000)
 
+	OUTPUT:
+		DATA - List of (LKEY,F,TMPVEL,TMPSPEC,MARKS) for each line of LKEYS, with the
+			oscillator strength F, the velocity profile (TMPVEL,TMPSPEC), and MARKS the
+			list of (VEL,COLOUR,LABEL) of the lines in LOG that fall in the panel
 	"""
 	#Load the spectrum from the ascii file with SPECFITS
 	#IWVLNGTH and ISPECTRUM are numpy arrays with the
 	#wavelength and flux of the spectrum. 
 	iwvlngth, ispectrum=specfits(fits)
-	if debug: print "VelPlots Loaded spectrum"
+	#Get the velocity profiles of every spectral line at once with VELSPECS
+	#(centred at the redshifted wavelength of each line)
+	#TMPVELS are the velocity arrays, TMPSPECS are the corresponding fluxes
+	#(If USEVELGRID, cut them from the constant-velocity grid of the spectrum instead)
+	if len(lkeys)==0: return []
+	lwvls=[llist[lkey][0]*(1.0+z) for lkey in lkeys]
+	if usevelgrid:
+		tmpvels,tmpspecs,npix=GetVelGrid(fits).windows(lwvls,vmin,vmax)
+	else:
+		tmpvels,tmpspecs,npix=velspecs(lwvls, iwvlngth, vmin,vmax, ispectrum)
+	data=[]
+	for ii in range(len(lkeys)):
+		#Grabd the wavelenght and oscilaltor strength of the line
+		wvl,f=llist[lkeys[ii]]
+		#WVL should be Redshifted 
+		wvl=wvl*(1.0+z)
+		#The lines in the LOG allready that are within the velocity
+		#profile of the spectral line come from one range
+		#query of LOGINDEX (see LOGLINEINDEX)
+		marks=[]
+		ckeys,cwls=logindex.query(wvl*(1.0+vmin/clight),wvl*(1.0+vmax/clight))
+		for (lz,lion,lline),wl in zip(ckeys,cwls):
+			#Get the velocity of this line with respect to the the spectral line
+			vel=(wl-wvl)/wvl*clight
+			marks.append((vel,log[lz,lion,lline,'colour'],'z=%s\n%s %s'%(lz,lion,lline)))
+		#Get the spectrum slice within vmin/vmax of the spectrum
+		data.append((lkeys[ii],f,tmpvels[ii,:npix[ii]],tmpspecs[ii,:npix[ii]],marks))
+	return data
+def DrawVelPanels(VPfig,log,z,llist,fits,logindex,vmin=-1000,vmax=1000,ncol=3,page=0,pagesize=None,data=None):
+	"""
+	DRAWVELPANELS plots the velocity profile of every line in LLIST (within the
+	wavelength range of the spectrum) at redshift Z in the figure VPFIG, one
+	panel per line. Lines in LOG that fall in each panel are marked. This is the
+	plot used by VELPLOTS (in the GUI) and BATCHVELPLOTS (without it).
+
+	Call - RADIOLIST=DrawVelPanels(VPFIG,LOG,Z,LLIST,FITS,LOGINDEX,VMIN=-1000,VMAX=1000,NCOL=3,
+		PAGE=0,PAGESIZE=None,DATA=None)
+
+	INPUTS:
+		VPFIG - The matplotlib figure (see SETUPVELFIG)
+		LOG, Z, LLIST, FITS - As for VELPLOTS
+		LOGINDEX - The LOGLINEINDEX of LOG (None to build one from LOG)
+		VMIN,VMAX - The velocity range (km/s) of each panel
+		NCOL - The number of columns of panels
+		PAGE,PAGESIZE - Only the PAGE-th page (of PAGESIZE panels) is plotted. If PAGESIZE
+			is None, every line is plotted.
+		DATA - The VELPANELDATA of the lines of the page, if all ready found (e.g. while
+			the GUI was idle)
+
+	OUTPUT:
+		RADIOLIST - The list of (ION,LINE) keys of all the lines (in order, on every page)
+
+	NOTES:
+		The panels are kept with the figure (VPFIG.VELPANELS, a list of [AX,PROFILE,MARKS],
+		with the profile LINE2D and the artists marking the LOG lines), and are reused the
+		next time VPFIG is drawn: the axes are moved (and hidden if not needed) and the
+		profiles updated with SET_DATA, so drawing many redshifts in one figure does
+		not add to it.
+		Only the lines of the page are cut from the spectrum and plotted, so the time
+		taken does not depend on the size of the linelist.
+	"""
+	if logindex is None: logindex=LogLineIndex(log,llist)
 	#LKEYS will contain a list of all the spectral
 	#line keys within LLIST that are within the 
-	#wavelength range of the spectrum.
-	lkeys=[]
-	#Sort the ions list alphabetically to put
-	#IONS in order
-	llist['ions'].sort()
-	#Loop through each ION/LINE combination in the linelist
-	#to identify which lines are covered by the spectrum.
-	#If that is true, add the LLIST key to LKEYS.
-	for ion in llist['ions']:
-		#Sort the lines for a given ION so they are in order
-		llist['lines'][ion].sort()
-		for line in llist['lines'][ion]:
-			#DOuble check ION/LINE  is in LLIST
-			#If this fails, something is fundamentally flawed...
-			if (ion,line) in llist:
-				#Get the wavelength of the spectral line
-				wvl,f=llist[ion,line]
-				#Redshift the line....
-				wvl=wvl*(1.0+z)
-				if debug: print "Wavelength check: is %.3f within (%.3f,%.3f)"%(wvl,min(iwvlngth),max(iwvlngth))
-				#If redshifted line covered by spectrum, add to LKEYS
-				if wvl>min(iwvlngth) and wvl<max(iwvlngth):
-					if debug: print "Passed wavelngth check",ion,line
-			 		lkeys.append((ion,line))
-	#NCOL is the number of columns in the VELPLOTWIN velocity profile grid
-	ncol=3
-	#NROW is the number of rows in the VELPLOTWIN grid.
-	nrow=len(lkeys)/ncol+1
-	if debug: print "VelPlots panel Nrow,ncol,nkeys:", nrow,ncol,len(lkeys)
-	#Set the limits of the plotted velocity profile to be +/- 1000 km/s
-	vmin=-1000
-	vmax=1000
-	if debug: print "VelPlots Plotting lines:",lkeys
+	#wavelength range of the spectrum (sorted by ION, then LINE).
+	#These are found from the (precomputed) coverage table of the
+	#spectrum and linelist (see LINECOVERAGE)
+	lkeys=GetLineCoverage(fits,llist).visible(z)
+	if debug: print "Passed wavelngth check",lkeys
 	#RADIOLIST is the list of LLIST spectral lines that require
 	#Checkbuttons in the LINEADDER GUI window
-	radiolist=[]
-	#The axes instance variable to share with all other panels
-	shareax=None
+	radiolist=list(lkeys)
+	#PKEYS are the lines on the page
+	pkeys=lkeys
+	if pagesize is not None: pkeys=lkeys[page*pagesize:(page+1)*pagesize]
+	if data is None: data=VelPanelData(log,z,llist,fits,logindex,pkeys,vmin,vmax)
+	#NROW is the number of rows in the VELPLOTWIN grid (with NCOL columns).
+	nrow=len(pkeys)/ncol+1
+	if debug: print "VelPlots panel Nrow,ncol,nkeys:", nrow,ncol,len(pkeys)
+	if debug: print "VelPlots Plotting lines:",pkeys
+	#The panels all ready in the figure (see NOTES)
+	if not hasattr(VPfig,'velpanels'): VPfig.velpanels=[]
+	panels=VPfig.velpanels
 	#Loop through all spectral lines for plotting and plot them!
-	for ii in range(len(lkeys)):
-		#Get the spectral line key (ION,LINE) tuple
-		lkey=lkeys[ii]
-		#Grabd the wavelenght and oscilaltor strength of the line
-		wvl,f=llist[lkey]
-		#WVL should be Redshifted 
-		wvl=wvl*(1.0+z)
+	for ii in range(len(data)):
+		#Get the spectral line key (ION,LINE) tuple, oscilaltor strength, the velocity
+		#profile (TMPVEL is the velocity array, TMPSPEC is the corresponding flux),
+		#and the lines in the LOG to mark
+		lkey,f,tmpvel,tmpspec,logmarks=data[ii]
 		#IND refers to the matplotlib subplot index for the
 		#velocity profile
 		ind=ii+1
-		#Get the spectrum slice within vmin/vmax of the spectrum
-		#using VELSPEC (centred at the redshifted wavelength WVL)
-		#TMPVEL is the velocity array, TMPSPEC is the corresponding flux
-		tmpvel,tmpspec=velspec(wvl, iwvlngth, vmin,vmax, ispectrum)
-		#Variable to contain axes instance for the subplot
-		ax=None
-		#To share the same zoom on all plotting windows, the first window
-		#must be identified (ii==0), while subsequent widnows must share
-		#the x/y axes (SHAREX/SHAREY)
-		if ii==0:
-			#Add a subplot to the VELPLOTWIN figure, call it AX
-			ax=VPfig.add_subplot(nrow,ncol,ind)
-			shareax=ax
+		#Reuse the panel if there is one (moved to its place in the grid)
+		if ii<len(panels):
+			ax,profile,marks=panels[ii]
+			ax.change_geometry(nrow,ncol,ind)
+			ax.set_visible(True)
+			#Remove the marks of the previous redshift
+			for artist in marks: artist.remove()
+			del marks[:]
 		else:
+			#Add a subplot to the VELPLOTWIN figure, call it AX.
+			#To share the same zoom on all plotting windows, the panels
+			#after the first share its x axis (SHAREX)
+			shareax=None
+			if len(panels)>0: shareax=panels[0][0]
 			ax=VPfig.add_subplot(nrow,ncol,ind,sharex=shareax)
-		
+			profile,=ax.plot([],[],'k',drawstyle='steps')
+			marks=[]
+			panels.append([ax,profile,marks])
 		#Plot the velocity profile to AX
-		ax.plot(tmpvel,tmpspec,'k',drawstyle='steps')
-		#Add key to RADIOLIST
-		radiolist.append(lkey)
+		profile.set_data(tmpvel,tmpspec)
+		ax.relim()
+		ax.set_autoscaley_on(True)
+		ax.autoscale_view(scalex=False)
 		#GEt y-axis limits of the velocity profile, and modify
 		#YMIN to include and extra 10% of the original heaigh
 		ymin,ymax=ax.get_ylim()
@@ -947,44 +3781,87 @@ def VelPlots(log,z,llist,fits,VelPlotWin,VPfig,VelFig):
 		#provide the oscillator strength for reference
 		title='%s %s\nf=%.5f'%(ion,line,f)
 		ax.set_title(title)
-		#Loop through the current LOG dictionary, and plot
-		#a vertical dashed line to inform the user if there
+		#Plot a vertical dashed line to inform the user if there
 		#is potentially another line from a different system.
-		#LZ is the redshift of a system in the LOG allready
-		for lz in log['zs']:
-			#LION is the ion in the log
-			for lion in log['ions']:
-				#LLINE is the line identifier for LION
-				for lline in log['lines'][lion]:
-					#If the log has the key (LZ,LION,LLINE) and (LION,LLINE) are in the linelist LLIST
-					if (lion,lline) in llist and (lz,lion,lline) in log:
-						#Get the wavelength of the LION,LLINE
-						#And redshift it by LZ
-						wl,f=llist[lion,lline]
-						#Get the velocity of this line
-						#with respect to the the spectral
-						#Line being plotted.
-						vel=(wl*(1.0+float(lz))-wvl)/wvl*2.998E5
-						#If it's ALSO within the velocity
-						#profile of the spectral line plotted
-						if vel>vmin and vel<vmax:
-							#Plot a vertical dashed line, and add
-							#a label to inform the user of the contaminating
-							#line.
-							if debug: 'VelPlot Adding Log redshift',lz
-							col=log[lz,lion,lline,'colour']
-							ax.plot([vel,vel],[ymin,ymax],'--'+col, linewidth=3)
-							fval='%.5f'%f
-							label='z=%s\n%s %s'%(lz,lion,lline)
-							ax.text(vel,ymax,label,color=col,va='top',ha='left',rotation='vertical')
+		for vel,col,label in logmarks:
+			#Plot a vertical dashed line, and add
+			#a label to inform the user of the contaminating
+			#line.
+			if debug: print 'VelPlot Adding Log line',label
+			marks.extend(ax.plot([vel,vel],[ymin,ymax],'--'+col, linewidth=3))
+			marks.append(ax.text(vel,ymax,label,color=col,va='top',ha='left',rotation='vertical'))
 		#Set the subplot velocity limits to the velocity range specified by VMIN/VMAX
 		ax.set_xlim(vmin,vmax)
-	#Update the VELFIG canvas
-	VelFig.draw()
+	#Hide the panels not needed at this redshift
+	for ax,profile,marks in panels[len(data):]: ax.set_visible(False)
+	return radiolist
+def VelPlots(log,z,llist,fits,VelPlotWin,VPfig,VelFig,logindex=None,pagesize=None):
+	""" 
+	VELPLOTS - The function that plots all lines for a provided redshift 
+		within provided linelist LLIST as a velocity profile. It will
+		then spawn a Tkinter window to select the spectral lines to
+		add to the LOG dictionary using the LINEADDER
+		class (defined above). Upon line selection, the user will be queryed
+		about the COLOUR,FLAG, VMIN/VMAX and NOTE for each spectral line added
+		to the log with the GETUSERINPUT.
+
+	Call - LOG=VelPlots(LOG,Z,LLIST,FITS,VELPLOTWIN,VPFIG, VELFIG,LOGINDEX=None,PAGESIZE=None)
+
+	INPUTS: LOG - The LOG dictionary defined from READLOG with the
+			spectral information
+		Z - The redshift of the system of interest (float)
+		LLIST - The linelist dictionary LLIST from input linelist file
+		FITS - The name of the input spectrum ASCII file to be plotted
+		VELPLOTWIN - The TKinter window that contains the matplotlib Canvas
+		VELFIG - The matplotlib TKagg canvas for velocity profiles in VELPLOTWIN window
+		VPFIG - The matplotlib figure embedded in the VELFIG canvas
+		LOGINDEX - The LOGLINEINDEX of LOG (used to mark lines in LOG that fall
+			in each velocity profile). If None, one is built from LOG. Any lines
+			added to LOG are also added to LOGINDEX.
+		PAGESIZE - The number of velocity profiles shown at once (one page, see
+			LINEADDER). If None, all of them are shown.
+
+	OUTPUT: LOG - The edited LOG dictionary inputted into VELPLOTS.
+
+	NOTES:
+		The layout of the VELPLOTWIN canvas should be in the same order
+		as the Checkbuttons that appear in the LINEADDER GUI window. It
+		will have 3 columns total, and as many rows as needed for each 
+		spectral line within the wavelength range of the spectrum.
+
+		With PAGESIZE, only the page shown is plotted, and the velocity profiles
+		of the next page are found while the GUI is idle (with VELPLOTWIN.AFTER_IDLE, so
+		the spectrum cache and LOG are only ever used from the Tk thread).
+
+	"""
+	#Load the spectrum (IWVLNGTH and ISPECTRUM are passed to UPDATELOG)
+	iwvlngth, ispectrum=specfits(fits)
+	if logindex is None: logindex=LogLineIndex(log,llist)
+	#The lines of every page, and the plot data (see VELPANELDATA) of the pages found
+	#so far. PENDING has the AFTER_IDLE job of each page waiting to be found.
+	lkeys=GetLineCoverage(fits,llist).visible(z)
+	pages={}
+	pending={}
+	def fetch(page):
+		pending.pop(page,None)
+		if page not in pages: pages[page]=VelPanelData(log,z,llist,fits,logindex,lkeys[page*pagesize:(page+1)*pagesize])
+	#Plot the velocity profiles of the lines (on page PAGE) in the VPFIG figure
+	def drawpage(page):
+		#A page shown before it was found is found by DRAWVELPANELS instead
+		if page in pending: VelPlotWin.after_cancel(pending.pop(page))
+		radiolist=DrawVelPanels(VPfig,log,z,llist,fits,logindex,page=page,pagesize=pagesize,data=pages.get(page))
+		#Update the VELFIG canvas
+		VelFig.draw()
+		#Find the next page once the GUI is idle
+		if pagesize is not None and (page+1)*pagesize<len(lkeys) and page+1 not in pages and page+1 not in pending:
+			pending[page+1]=VelPlotWin.after_idle(fetch,page+1)
+		return radiolist
+	radiolist=drawpage(0)
 	if debug: print "VelPlots RadioList:", radiolist
 	#Use the LINEADDER class to generate the GUI window to select lines
 	#for adding to LOG
-	lineadder=LineAdder(radiolist,VelPlotWin)
+	lineadder=LineAdder(radiolist,VelPlotWin,pagesize,drawpage)
+	for job in pending.values(): VelPlotWin.after_cancel(job)
 	#ADDLINES is a dicitionary keyed by the elements of RADIOLIST.
 	#Each key corresponds to whether or not the line should be added
 	#(true if add, false if not)
@@ -996,28 +3873,221 @@ def VelPlots(log,z,llist,fits,VelPlotWin,VPfig,VelFig):
 	for key in addlines:
 		#If the user selected it (i.e. value==True)
 		if addlines[key]==True:
-			#Check if that system allready exists. If not
-			#add ZSTR to the list of redshifts in LOG['zs']
-			if zstr not in log['zs']: log['zs'].append(zstr)
 			#Obtain the ION,LINE identifier of the spectral line
+			#(LOG adds ZSTR, ION and LINE to its lists once the entry is made)
 			ion,line=key
-			#Check to see if ION allready in LOG['ions'] list.
-			#If not, add it, and make an entry into LOG['lines'] dictionary
-			#for that ion.
-			if ion not in log['ions']:
-				log['ions'].append(ion)
-				log['lines'][ion]=[]
-			#IF LINE identifier not in the LOG['lines'][ION] list, add it
-			if line not in log['lines'][ion]: log['lines'][ion].append(line)
 			#Pass the system/spectral line information to GETUSERINPUT
 			#to query user for log information about the line, and update
 			#the LOG dictionary appropriately
 			wvl,f=llist[ion,line]
 			UL=UpdateLog(log, z,ion,line,wvl, iwvlngth, ispectrum)
 			log=UL.log
+			#Keep LOGINDEX up to date with the new line
+			logindex.add(zstr,ion,line)
 	#Now you have an updated LOG dictionary for a given system redshift, return it.
 	return log
 
+def MemoryUsage():
+	"""
+	MEMORYUSAGE returns the memory (resident set size, in MB) used by this process
+	(NaN if it cannot be found, i.e. not on Linux).
+
+	Call - MB=MemoryUsage()
+	"""
+	try:
+		f=open('/proc/self/statm')
+		pages=int(f.read().split()[1])
+		f.close()
+	except (IOError,ValueError,IndexError): return np.nan
+	return pages*os.sysconf('SC_PAGE_SIZE')/2.0**20
+class VelStackViewer:
+	"""
+	CLASS VELSTACKVIEWER - The window showing the velocity profiles (see VELPLOTS) in the
+		LINEFINDER session. The window, figure, canvas and toolbar are made once, and
+		the panels are reused for every redshift (see DRAWVELPANELS), so viewing many
+		systems does not use more memory. The window is hidden (rather than destroyed)
+		between redshifts.
+
+	Call - VV=VelStackViewer(MASTER)
+
+	INPUTS:
+		MASTER - The TKinter window the viewer belongs to
+
+	ATTRIBUTES:
+		VV.WINDOW - The TKinter Toplevel window
+		VV.FIG - The matplotlib figure (see SETUPVELFIG), not registered with pyplot
+		VV.CANVAS - The matplotlib TKagg canvas of VV.FIG
+		VV.TOOLBAR - The matplotlib toolbar for zooming, panning, etc
+		VV.MEMORY - The memory used (MB, see MEMORYUSAGE) after each redshift shown
+		VV.SHOW() - Shows the window (resetting the zoom history of VV.TOOLBAR)
+		VV.HIDE() - Hides the window, and records the memory used
+		VV.REPORT() - Returns a summary of the memory used over the session
+		VV.CLOSE() - Destroys the window and clears VV.FIG
+	"""
+	def __init__(self,master):
+		self.window=Tkinter.Toplevel(master)
+		self.window.wm_title("Velocity Profiles")
+		#Closing the window only hides it
+		self.window.protocol("WM_DELETE_WINDOW",self.window.withdraw)
+		self.fig=Figure(figsize=(8,8))
+		SetupVelFig(self.fig)
+		self.canvas=FigureCanvasTkAgg(self.fig,master=self.window)
+		self.canvas.get_tk_widget().pack(side=Tkinter.TOP, fill=Tkinter.BOTH, expand=1)
+		self.toolbar=NavigationToolbar2TkAgg(self.canvas,self.window)
+		self.window.withdraw()
+		self.memory=[MemoryUsage()]
+		return
+	def show(self):
+		self.window.deiconify()
+		self.toolbar.update()
+		return
+	def hide(self):
+		self.window.withdraw()
+		self.memory.append(MemoryUsage())
+		if debug: print "VelStackViewer:",self.report()
+		return
+	def report(self):
+		mem=np.array(self.memory)
+		return "%d velocity stacks shown, memory %.1f MB at start, %.1f MB now (max %.1f MB), %d panels, %d pyplot figures open"%\
+			(len(mem)-1,mem[0],mem[-1],np.nanmax(mem),len(getattr(self.fig,'velpanels',[])),len(plt.get_fignums()))
+	def close(self):
+		self.window.destroy()
+		self.fig.clf()
+		return
+def ReadSystems(sysfile):
+	"""
+	READSYSTEMS reads the systems to plot with BATCHVELPLOTS from either a logfile
+	(see LOADLOG) or a plain list of redshifts.
+
+	Call - LOG,ZS=ReadSystems(SYSFILE)
+
+	INPUTS:
+		SYSFILE - A logfile, or an ASCII file with a redshift in the first (whitespace
+			delimited) column of each line. A file with no semicolons (outside
+			of comments) is taken to be a list of redshifts.
+
+	OUTPUT:
+		LOG - The LOGSTORE of SYSFILE (empty for a list of redshifts)
+		ZS - The list of redshifts (strings, in the order they first appear)
+	"""
+	f=open(sysfile)
+	islog=any(';' in row for row in f if not row.startswith('#'))
+	f.close()
+	if islog:
+		log=LoadLog(sysfile)
+		return log,log['zs']
+	zs=[]
+	for row in open(sysfile):
+		cols=row.split()
+		if row.startswith('#') or len(cols)==0: continue
+		if not IsFloat(cols[0]):
+			print "Warning: Skipping line in %s (not a redshift): %s"%(sysfile,row.strip())
+			continue
+		zstr='%.5f'%float(cols[0])
+		if zstr not in zs: zs.append(zstr)
+	return LogStore(),zs
+def PairName(fits,sysfile,index,used):
+	"""
+	PAIRNAME returns the name used for the output files of a (SPECTRUM,SYSFILE) pair in
+	batch runs (see BATCHVELPLOTS): <SPECTRUM>_<SYSFILE> (without the extensions).
+
+	Call - NAME=PairName(FITS,SYSFILE,INDEX,USED)
+
+	INPUTS:
+		FITS,SYSFILE - The filenames of the pair
+		INDEX - The position of the pair in the batch
+		USED - The set of names all ready given (NAME is added to it)
+
+	NOTES:
+		If the name is all ready used (e.g. same-named files in different directories),
+		the pair's INDEX is added to it, so no two pairs write to the same files.
+	"""
+	name='%s_%s'%(os.path.splitext(os.path.basename(fits))[0],os.path.splitext(os.path.basename(sysfile))[0])
+	if name in used: name='%s_%i'%(name,index)
+	used.add(name)
+	return name
+#The linelist/logs already read by a BATCHVELPLOTS worker process (keyed by filename)
+batchcache={}
+def RenderVelStack(task):
+	"""
+	RENDERVELSTACK renders the velocity profiles of one system to a file, without a
+	GUI (see BATCHVELPLOTS). Run in the worker processes of BATCHVELPLOTS.
+
+	Call - OUTFILE,NPANEL=RenderVelStack((FITS,SYSFILE,LLISTFILE,ZSTR,OUTFILE))
+
+	NOTES:
+		The linelist, the log (and its LOGLINEINDEX), and the spectrum are only read
+		once per process (see BATCHCACHE and SPECCACHE), and the figure is only made once.
+	"""
+	fits,sysfile,llistfile,zstr,outfile=task
+	if ('llist',llistfile) not in batchcache: batchcache['llist',llistfile]=LoadLineList(llistfile)
+	llist=batchcache['llist',llistfile]
+	if ('log',sysfile,llistfile) not in batchcache:
+		log,zs=ReadSystems(sysfile)
+		batchcache['log',sysfile,llistfile]=log,LogLineIndex(log,llist)
+	log,logindex=batchcache['log',sysfile,llistfile]
+	#One figure per process, with its panels reused for every system (see DRAWVELPANELS)
+	if 'fig' not in batchcache:
+		batchcache['fig']=Figure(figsize=(8,8))
+		FigureCanvasAgg(batchcache['fig'])
+		SetupVelFig(batchcache['fig'])
+	VPfig=batchcache['fig']
+	radiolist=DrawVelPanels(VPfig,log,float(zstr),llist,fits,logindex)
+	VPfig.suptitle('%s z=%s'%(os.path.basename(fits),zstr))
+	VPfig.savefig(outfile)
+	return outfile,len(radiolist)
+def BatchVelPlots(llistfile,outdir,pairs,fmt='png',nproc=None):
+	"""
+	BATCHVELPLOTS renders the velocity profiles (as in the VELPLOTS window) of every
+	system of every spectrum to image files, without a GUI.
+
+	Call - BatchVelPlots(LLISTFILE,OUTDIR,PAIRS,FMT='png',NPROC=None)
+
+	INPUTS:
+		LLISTFILE - The input linelist filename
+		OUTDIR - The directory for the output files (created if needed). Each system is
+			saved to OUTDIR/<SPECTRUM>_<SYSFILE>_z<Z>.<FMT> (see PAIRNAME)
+		PAIRS - A list of (SPECTRUM,SYSFILE) filename pairs. SYSFILE is a logfile or a
+			list of redshifts (see READSYSTEMS)
+		FMT - The output file format (e.g. 'png' or 'pdf')
+		NPROC - The number of worker processes (by default, the number of CPUs).
+			With NPROC=1, everything is rendered in this process.
+
+	NOTES:
+		Run from the command line with:
+			tb_linefinder.py --batch <LINELIST> <OUTDIR> <SPECTRUM>:<SYSFILE> [...] [--format=pdf] [--nproc=N]
+		The systems of each spectrum are handed to the workers in order, so each worker
+		mostly reads each spectrum once. Progress (and the rendering rate) is printed
+		to the screen.
+	"""
+	if nproc is None: nproc=multiprocessing.cpu_count()
+	if not os.path.isdir(outdir): os.makedirs(outdir)
+	#TASKS is the list of systems to render (grouped by spectrum)
+	tasks=[]
+	used=set()
+	for ii,(fits,sysfile) in enumerate(pairs):
+		log,zs=ReadSystems(sysfile)
+		base=PairName(fits,sysfile,ii,used)
+		for zstr in zs: tasks.append((fits,sysfile,llistfile,zstr,os.path.join(outdir,'%s_z%s.%s'%(base,zstr,fmt))))
+	print "Rendering %d systems from %d spectra with %d process(es)"%(len(tasks),len(pairs),nproc)
+	t0=time.time()
+	if nproc>1:
+		pool=multiprocessing.Pool(nproc)
+		#Hand out a few consecutive systems (of the same spectrum) at a time
+		chunk=max(1,min(16,len(tasks)//(4*nproc)))
+		results=pool.imap_unordered(RenderVelStack,tasks,chunk)
+	else:
+		pool=None
+		results=(RenderVelStack(task) for task in tasks)
+	for ii,(outfile,npanel) in enumerate(results):
+		dt=time.time()-t0
+		print "[%d/%d] %s (%d panels) %.1f systems/s"%(ii+1,len(tasks),outfile,npanel,(ii+1)/max(dt,1e-6))
+	if pool is not None:
+		pool.close()
+		pool.join()
+	dt=time.time()-t0
+	print "Rendered %d systems in %.1f s (%.1f systems/s)"%(len(tasks),dt,len(tasks)/max(dt,1e-6))
+	return
 class linefinder_tk(Tkinter.Tk):# Base for standard window
 	""" 
 	CLASS LINEFINDER_TK is the main TKINTER interface for TB_LINEFINDER. IT grabs the input/output file names
@@ -1035,16 +4105,22 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		LF.logfile - The logfile filename string obtained from LF.entryOut
 		LF.entryLlist - TKINTER string variable with input linelist filename
 		LF.log - the LLOG dictionary that contains the data to be written to LF.entryLlist
+		LF.logindex - The LOGLINEINDEX of the observed wavelengths of the lines in LF.log
 		LF.SProot - The TKInter parent for the full spectrum plot window
 		LF.SpecPlot - The matplotlib canvas embedded in LF.SPROOT
 		LF.ax - the Matplotlib Axes instance for the full spectrum plot window (LF.SpecPlot)
 		LF.fig - Matplotlib figure instance for the full spectrum plot window (LF.SpecPlot)
 
 		LF.onExit() - function to close the LF window and exit TB_LINEFINDER for good
+		LF.onTutorial() - Turns the tutorial mode (USETUTORIAL) on/off
+		LF.onVelGrid() - Turns the constant-velocity grid (USEVELGRID) for velocity profiles on/off
 		LF.initialize() - The initilization functuon of the LF window (set up the user input fields,
 		LF.PlotSpec() - Function to plot the spectrum from LF.fits
+		LF.OnXlimChanged(AX) - Redraws the spectrum at the resolution needed for the new x-limits of AX
 		LF.PlotFits() - Function to generate the the TKinter LF.SProot window
 		LF.UpdatePlot() - Refresh the LF.SpecPlot canvas with current LOG dictionary content
+			(only the markers of log entries that changed are updated)
+		LF.logartists - The markers on LF.ax for each LOG entry, keyed by (Z,ION,LINE)
 		LF.LogMenu(LOGMENUWIN) - Defines the TKinter window for editing the current LOG dictionary content
 			in the LOGMENUWIN child window.
 		LF.OnChangeLog() - Update LOG dictionary content with user input (done via command line)
@@ -1098,6 +4174,8 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 	#Function to quit the entire GUI
         def onExit(self):
                 print "Quitting..."
+                #Close an open Line Finder session first, so the log is saved (see CLOSELOG)
+                if self.log is not None: self.onQ()
                 self.quit()
 	def onTutorial(self):
 		global usetutorial
@@ -1108,6 +4186,51 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 			usetutorial=True
 			tkMessageBox.showinfo("Help Message", "Tutorial mode is now on.")
 		return
+	def onPageVelPlots(self):
+		global pagevelplots
+		if pagevelplots:
+			pagevelplots=False
+			tkMessageBox.showinfo("Help Message", "All velocity profiles are now shown at once.")
+		else:
+			pagevelplots=True
+			tkMessageBox.showinfo("Help Message", "Velocity profiles are now shown %d at a time."%panelsperpage)
+		return
+	def onVelGrid(self):
+		global usevelgrid
+		if usevelgrid:
+			usevelgrid=False
+			tkMessageBox.showinfo("Help Message", "Velocity profiles now use the original wavelength grid.")
+		else:
+			usevelgrid=True
+			tkMessageBox.showinfo("Help Message", "Velocity profiles now use a constant-velocity grid.")
+		return
+	def onJournal(self):
+		global usejournal
+		if usejournal:
+			usejournal=False
+			tkMessageBox.showinfo("Help Message", "The whole logfile is now rewritten at every save.")
+		else:
+			usejournal=True
+			tkMessageBox.showinfo("Help Message", "Saves are now journaled (the logfile is compacted on quitting).")
+		return
+	def onAutoSave(self):
+		global autosave
+		if autosave:
+			autosave=False
+			tkMessageBox.showinfo("Help Message", "Autosave is now off (the log is saved when each window is closed).")
+		else:
+			autosave=True
+			tkMessageBox.showinfo("Help Message", "Autosave is now on (for the next spectrum).")
+		return
+	def onLogSummary(self):
+		global logsummary
+		if logsummary:
+			logsummary=False
+			tkMessageBox.showinfo("Help Message", "Log summary is now off.")
+		else:
+			logsummary=True
+			tkMessageBox.showinfo("Help Message", "Log summary is now on.")
+		return
 	#Browser dialog buttons for input/output files...
 	#... To get the Input spectrum file
 	def getSpecFile(self):
@@ -1160,6 +4283,11 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
                 mb.grid(column=0,row=0, sticky='EW')
                 picks=Tkinter.Menu(mb,tearoff=0)
                 picks.add_command(label="Tutorial mode on/off",command=self.onTutorial)
+                picks.add_command(label="Constant-velocity grid on/off",command=self.onVelGrid)
+                picks.add_command(label="Paged velocity profiles on/off",command=self.onPageVelPlots)
+                picks.add_command(label="Journaled log saves on/off",command=self.onJournal)
+                picks.add_command(label="Autosave on/off",command=self.onAutoSave)
+                picks.add_command(label="Log summary on/off",command=self.onLogSummary)
                 picks.add_command(label="Exit",command=self.onExit)
                 mb.config(menu=picks)
 
@@ -1229,18 +4357,32 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		self.log=None
 	#Function to Plot the input spectrum
 	def PlotSpec(self):
-		#Load spectrum and plot it to SpecPlot window
-		iwvlngth, ispectrum=specfits(self.fits)
-		self.ax.plot(iwvlngth,ispectrum,'k',drawstyle='steps')
-		self.SpecPlot.draw()
-		#The default scaling removes the +/- 2.5 percentile outliers.
-		#This number was set arbitrarily for practice spectrum, and might not be appropriate
-		ymin=np.percentile(ispectrum,2.5)
-		ymax=np.percentile(ispectrum,97.5)
+		#Load spectrum (as a min/max pyramid) and plot it to SpecPlot window
+		#Only ~2 points per screen pixel are drawn (see SPECPYRAMID). The plot is
+		#re-decimated whenever the x-limits change (see ONXLIMCHANGED)
+		self.pyramid=GetSpecPyramid(self.fits)
+		iwvlngth=self.pyramid.wvlngth
+		self.specline,=self.ax.plot([],[],'k',drawstyle='steps')
+		self.ax.set_xlim(iwvlngth[0],iwvlngth[-1])
+		self.OnXlimChanged(self.ax)
+		self.ax.callbacks.connect('xlim_changed',self.OnXlimChanged)
+		#The default scaling removes the +/- 2.5 percentile outliers (precomputed in the pyramid).
+		ymin,ymax=self.pyramid.ylimits
 		#Set the y axis limits based on removing outliers
 		self.ax.set_ylim(ymin,ymax)
+		self.SpecPlot.draw()
 		if debug: print "PlotSpec flux limits: ", ymin, ymax
 		return
+	#Re-decimate the spectrum for the new x-limits of the Full Spectrum plot
+	def OnXlimChanged(self,ax):
+		xmin,xmax=ax.get_xlim()
+		npts=2*int(ax.get_window_extent().width)
+		x,y,raw=self.pyramid.decimate(xmin,xmax,npts)
+		self.specline.set_data(x,y)
+		#Original pixels are drawn as steps, the min/max envelope as a line
+		if raw: self.specline.set_drawstyle('steps')
+		else: self.specline.set_drawstyle('default')
+		return
 	#Function to load the Tkinter window for plotting the full spectrum
 	def PlotFits(self):
 		#Generate the figure for plotting
@@ -1256,6 +4398,12 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		NavSpecPlot=NavigationToolbar2TkAgg(self.SpecPlot, self.SProot)
 		#Generate an matplotlib axis for plotting the spectrum
 		self.ax=plt.subplot(1,1,1)
+		#LOGARTISTS contains the markers (vertical line, label, style) of each
+		#log entry (keyed by Z,ION,LINE) on the plot (see UPDATEPLOT)
+		self.logartists={}
+		#TROUGHMARKS are the markers (unexplained, explained by the log) of the
+		#absorption troughs (see ONT)
+		self.troughmarks=None
 		#Plot the spectrum
 		self.PlotSpec()
 		return
@@ -1264,43 +4412,93 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 	#The function related to updating the full specturm plot with the log information
 	#This includes coloured vertical lines for each identified feature and the label
 	#the redshift and absorption feature at that line
+	#Only the markers of log entries that have changed are added/restyled/removed
+	#(LF.LOGARTISTS keeps the markers already drawn), and the canvas is only redrawn
+	#if something changed. The changed entries come from the LOG itself (LOG.TAKE), so
+	#only those are looked at.
 	def UpdatePlot(self):
-		#Clear the MPL axis and reset the canvas
-		self.ax.clear()
-		self.SpecPlot.draw()
-		self.fig.set_canvas(self.SpecPlot)
-		#Replot the spectrum from input file
-		self.PlotSpec()
-		if debug: print "Updating Plot", self.log
-		#Get the y-limits of the plot for making veritcal lines
-		ymin,ymax=self.ax.get_ylim()
-		#Go through each system and plot each absorption feature in the log.
+		if debug: print "Updating Plot", len(self.log)
+		#CHANGED is the list of log entries to (re)check. On the first call, this is
+		#every entry (and LOG starts recording changes for the plot)
+		if 'plot' not in self.log.changes:
+			self.log.watch('plot')
+			changed=self.log.keys()+self.logartists.keys()
+		else:
+			changed=self.log.take('plot')
+		#WANTED is the marker (wavelength, colour) needed for each changed entry in the log.
 		#Use the colour identified in LOG[Z,ION,LINE,'colour']
-		#Label with Z, ION, LINE
-		for z in self.log['zs']:
-			if debug: print "UpdatePlot redshift", z
-			for ion in self.log['ions']:
-				if debug: print "\tUpdatePlot ion", ion
-				for line in self.log['lines'][ion]:
-					if debug: print "\t\tUpdatePlot line", line
-					if debug: print "\t\t In linelist:", (ion,line) in self.llist
-					if debug: print "\t\t In log:", (z,ion,line) in self.log
-					if (ion,line) in self.llist and (z,ion,line) in self.log:
-						if debug: print "\t\t\tUpdatePlot", z, ion, line
-						wl,f=self.llist[ion,line]
-						wl=wl*(1.0+float(z))
-						#By default use black if no colour in LOG
-						col='k'
-						if (z,ion,line,'colour') in self.log:
-							col=self.log[z,ion,line,'colour']
-						self.ax.plot([wl,wl],[ymin,ymax],':'+col)
-						fval='%.5f'%f#Oscillator strength string if necessary
-						label='z=%s\n%s %s'%(z,ion,line)
-						self.ax.text(wl,ymax,label,color=col,va='top',ha='left',rotation='vertical')
-					#else: print "Warning: Line %s %s not in linelist."%(ion,line)
-		#Redraw the canvas to update the plotting window
+		wanted={}
+		for key in changed:
+			z,ion,line=key
+			if (ion,line) in self.llist and key in self.log:
+				wl,f=self.llist[ion,line]
+				wl=wl*(1.0+float(z))
+				wanted[key]=wl,self.log[z,ion,line,'colour']
+			#else: print "Warning: Line %s %s not in linelist."%(ion,line)
+		#DIRTY is the set of log entries whose markers have changed
+		dirty=set()
+		#Remove the markers of changed entries no longer in the log
+		for key in changed:
+			if key not in wanted and key in self.logartists:
+				vline,label,style=self.logartists.pop(key)
+				vline.remove()
+				label.remove()
+				dirty.add(key)
+		#Add/restyle the markers of new/changed entries
+		for key in wanted:
+			wl,col=wanted[key]
+			if key in self.logartists:
+				vline,label,style=self.logartists[key]
+				if style==wanted[key]: continue
+				vline.set_xdata([wl,wl])
+				vline.set_color(col)
+				label.set_x(wl)
+				label.set_color(col)
+			else:
+				if debug: print "\t\t\tUpdatePlot", key
+				z,ion,line=key
+				#The vertical line and label span the axes in y, so they do
+				#not depend on the flux limits of the plot
+				vline=self.ax.axvline(wl,linestyle=':',color=col)
+				label='z=%s\n%s %s'%(z,ion,line)
+				label=self.ax.text(wl,1.0,label,color=col,va='top',ha='left',rotation='vertical',\
+					transform=self.ax.get_xaxis_transform())
+			self.logartists[key]=vline,label,wanted[key]
+			dirty.add(key)
+		#The troughs explained by the log may have changed
+		if len(dirty)>0 and self.troughmarks is not None: self.UpdateTroughs()
+		#Redraw the canvas to update the plotting window (only if needed)
+		if len(dirty)>0:
+			self.SpecPlot.draw()
+			if debug: print "UpdatePlot Draw Figure", dirty
+		return
+	#Show/hide markers of the absorption troughs found in the spectrum (see FINDABSORBERS)
+	#Troughs explained by lines all ready in the log are greyed out.
+	def onT(self):
+		if self.troughmarks is None:
+			self.troughs=GetAbsorbers(self.fits)
+			print "Found %d absorption troughs"%len(self.troughs['centroid'])
+			#The markers are at the top of the plot (in axes coordinates), so do not
+			#depend on the flux limits
+			trans=self.ax.get_xaxis_transform()
+			#(the unexplained troughs are drawn on top)
+			old,=self.ax.plot([],[],'v',color='0.7',markersize=6,transform=trans,scalex=False,scaley=False)
+			new,=self.ax.plot([],[],'v',color='r',markersize=6,transform=trans,scalex=False,scaley=False)
+			self.troughmarks=new,old
+			self.UpdateTroughs()
+		else:
+			for mark in self.troughmarks: mark.remove()
+			self.troughmarks=None
 		self.SpecPlot.draw()
-		if debug: print "UpdatePlot Draw Figure" 
+		return
+	#Update which trough markers are greyed out (with the current log)
+	def UpdateTroughs(self):
+		explained=ExplainedTroughs(self.troughs,self.logindex)
+		centroid=self.troughs['centroid']
+		new,old=self.troughmarks
+		new.set_data(centroid[~explained],0.97*np.ones((~explained).sum()))
+		old.set_data(centroid[explained],0.97*np.ones(explained.sum()))
+		if debug: print "UpdateTroughs: %d of %d troughs explained"%(explained.sum(),len(centroid))
 		return
 	# Get user input about updating the LOG file in LOGMENU using the command line
 	def OnChangeLog(self):
@@ -1321,43 +4519,10 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		if debug: print "Running OnRemoveSystem"
 		#Obtain the redshift of the desired removed system selected via the drop menu 
 		rmz=self.z.get()
-		#go through each ION/LINE combination, and see if it has an entry for the system at redshfit RMZ 
-		for rmion in self.log['ions']:
-			for rmline in self.log['lines'][rmion]:
-				#If combination is in the LOG, remove it
-				if (rmz,rmion,rmline) in self.log:
-					self.log.pop((rmz,rmion,rmline),0)
-					self.log.pop((rmz,rmion,rmline,'flag'),0)
-					self.log.pop((rmz,rmion,rmline,'colour'),0)
-					self.log.pop((rmz,rmion,rmline,'vel'),0)
-		#Figure out which index in the list of redshifts the RMZ absorber corresponds to,
-		#and remove from the redshift list
-		inds=np.where(rmz==self.log['zs'])[0]
-		for ind in inds:
-			self.log['zs'].pop(ind)
-		#Check to see if there are any ions/lines that are no longer present in the LOG.
-		#if so, they need to be removed from the list of possible lines and ions.
-		for rmion in self.log['ions']:
-			removeion=True#Boolean to see if whether or not the ion needs to be removed
-			for rmline in self.log['lines'][rmion]:
-				removeline=True#boolean to see if the line of the ion needs to be removed
-				for rmz in self.log['zs']:
-					#if the ion/line combination is in LOG all ready after removing redshift, we need to keep it.
-					if (rmz,rmion,rmline) in self.log:
-						#Set the boolean values to false so ION/line combo is not removed
-						removeline=False
-						removeion=False
-				#Get rid of line from list if deemed apprpriate to remove
-				if removeline:
-					inds=np.where(rmline==self.log['lines'][rmion])[0]
-					for ind in inds:
-						self.log['lines'][rmion].pop(ind)
-			#If the list of possible lines is empty and we have said we should remove the ion,
-			#remove the ion appropriately
-			if len(self.log['lines'][rmion])<1 and removeion:
-				inds=np.where(rmion==self.log['ions'])[0]
-				for ind in inds:
-					self.log['ions'].pop(ind)
+		#Remove every entry of the system at redshift RMZ (LOG drops RMZ, and any
+		#ions/lines no longer in the LOG, from its lists)
+		for rmkey in self.log.removesystem(rmz):
+			self.logindex.remove(*rmkey)
 		#Update the drop menus appropriately to encompass any changes
 		self.UpdateLineMenu()
 		self.UpdateIonMenu()
@@ -1372,18 +4537,20 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		rmion=self.ion.get()
 		rmline=self.line.get()
 		#Double check the corresponding key is in the dictionary, if so remove it
-		if (rmz,rmion, rmline) in self.log:
-			self.log.pop((rmz,rmion,rmline),0)
-			self.log.pop((rmz,rmion,rmline,'flag'),0)
-			self.log.pop((rmz,rmion,rmline,'colour'),0)
-			self.log.pop((rmz,rmion,rmline,'vel'),0)
+		if self.log.remove(rmz,rmion,rmline):
+			self.logindex.remove(rmz,rmion,rmline)
 		#Update the drop-down menus
 		self.UpdateIonMenu()
 		self.UpdateLineMenu()
 		return
+	#Rewrite the logfile with the full log now (and clear the journal)
+	def OnCompactLog(self):
+		if debug: print "Running OnCompactLog"
+		self.SaveLog(compact=True)
+		return
 	#Save the log file and exit the LogMenu editing widget
 	def OnExitEdit(self):
-		WriteLog(self.log,self.logfile,self.llistfile,self.fits)
+		self.SaveLog()
 		#Close the widgets
 		self.EditPopup.destroy()
 		self.EditMaster.destroy()
@@ -1391,13 +4558,10 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 	#Update the drop-down menu displayin the ions in the LogMenu list
 	def UpdateIonMenu(self, *args):
 		zions=[]
-		#Comb LOG dictionary for every ion in LOG, and add it to a list of possible ions
-		for ion in self.log['ions']:
-			for line in self.log['lines'][ion]:
-				if ion not in zions:
-					if (self.z.get(),ion,line) in self.log:
-						zions.append(ion)
-		if debug: print "UpdateIonMenu set self.ion",zions[0]
+		#Every ion with an entry in LOG at the selected redshift is a possible ion
+		for z,ion,line in self.log.keys(z=self.z.get()):
+			if ion not in zions: zions.append(ion)
+		if debug: print "UpdateIonMenu set self.ion",zions
 		#Set the default value to <ion>
 		self.ion.set("<ion>")
 		#update the IonMenu by removing all previous entries and adding the new
@@ -1409,11 +4573,9 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 	#Update drop-down menu displaying the lines for the ION selected in the Ion drop-down menu in LogMenu
 	def UpdateLineMenu(self, *args):
 		zlines=[]
-		#Comb LOG dictionary for every line for the given ion in the LOG and add to list of possible lines
-		if self.ion.get() in self.log['lines']:
-			for line in self.log['lines'][self.ion.get()]:
-				if (self.z.get(),self.ion.get(),line) in self.log:
-					zlines.append(line)
+		#Every line of the given ion with an entry in LOG at the selected redshift is a possible line
+		for z,ion,line in self.log.keys(z=self.z.get(),ion=self.ion.get()):
+			zlines.append(line)
 		if debug: print "UpdateLineMenu linelist",zlines
 		#Set the default value to <line>
 		self.line.set('<line>')
@@ -1427,10 +4589,8 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 
 	#Update drop-down menu displaying the redshifts in the drop-down menu in LogMenu
 	def UpdateRedshiftMenu(self, *args):
-		zs=[]
-		#Comb LOG dictionary for all redshifts
-		for z in self.log['zs']:
-			zs.append(z)
+		#All redshifts in LOG (sorted, starting with the lowest)
+		zs=sorted(self.log['zs'])
 		if debug: print "UpdateRedshiftMenu list"
 		#Set the default value to first redshift
 		self.z.set('<z>')
@@ -1461,9 +4621,9 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		#For the selected redshift, update the dropdown ion meny accordingly
 		self.z.trace('w',self.UpdateIonMenu)
 		#Sort redshifts numerically (starting with the lowest)
-		self.log['zs'].sort()
+		zs=sorted(self.log['zs'])
 		self.z.set('<z>') # default value
-		self.ZMenu = apply(Tkinter.OptionMenu, (self.EditPopup, self.z) +tuple(self.log['zs']))
+		self.ZMenu = apply(Tkinter.OptionMenu, (self.EditPopup, self.z) +tuple(zs))
 		self.ZMenu.grid(column=1,row=1,stick='EW')
 		#Example code for changing menus (see sample in UpdateLineMenu for other half); don't use.
 		""" 
@@ -1514,21 +4674,60 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		#	Remove System - OnRemoveSystem
 		Systembutton=Tkinter.Button(self.EditPopup,text="Remove System", command=self.OnRemoveSystem)
 		Systembutton.grid(column=0,row=6,columnspan=2,sticky='EW')
+		#	Compact Logfile - OnCompactLog
+		Compactbutton=Tkinter.Button(self.EditPopup,text="Compact Logfile", command=self.OnCompactLog)
+		Compactbutton.grid(column=0,row=7,columnspan=2,sticky='EW')
 		#	Quit - OnExitEdit
 		Quitbutton=Tkinter.Button(self.EditPopup,text="Quit", command=self.OnExitEdit)
-		Quitbutton.grid(column=0,row=7,columnspan=2,sticky='EW')
+		Quitbutton.grid(column=0,row=8,columnspan=2,sticky='EW')
 		#Wait for closing the window before proceeding.
 		self.EditMaster.wait_window()
 
 				
+	#Save the log. With USEJOURNAL, only the changes are appended to the journal,
+	#unless COMPACT is TRUE (the full logfile is then rewritten, see LOGJOURNAL).
+	#If the LOG is kept in a database, the changes are committed to it instead.
+	#With AUTOSAVE, the log is saved in the background (LF.AUTOSAVER), so this only
+	#waits for the save if COMPACT is TRUE.
+	def SaveLog(self,compact=False):
+		if self.log.backend is not None: self.log.commit()
+		elif compact:
+			if self.autosaver is not None: self.autosaver.flush()
+			self.journal.compact()
+		elif self.autosaver is not None: self.autosaver.poke()
+		else: self.WriteChanges()
+		return
+	#Save the changes to a text logfile (append to the journal, or rewrite the logfile)
+	#With VERBOSE=FALSE nothing is printed (as for the saves of LF.AUTOSAVER)
+	def WriteChanges(self,verbose=True):
+		if usejournal: self.journal.sync(verbose)
+		else: self.journal.compact(verbose)
+		return
+	#Stop autosaving (saving any waiting changes), and save the log, folding the journal
+	#into the logfile. The LOG is then closed (set to None), so this is only done once.
+	def CloseLog(self):
+		if self.log is None: return
+		if self.autosaver is not None:
+			self.autosaver.stop()
+			self.log.listeners.remove(self.autosaver.poke)
+		self.SaveLog(compact=True)
+		self.autosaver=None
+		self.log=None
+		return
 	#Function to quit main LineFinder routine.
 	def onQ(self):
-		#Save log file
-		WriteLog(self.log,self.logfile,self.llistfile,self.fits)
+		#Stop autosaving, and save log file (and fold the journal into it)
+		self.CloseLog()
+		#Close the velocity profile window, and report the memory used
+		if self.velviewer is not None:
+			print "Memory report:",self.velviewer.report()
+			self.velviewer.close()
+			self.velviewer=None
 		#Close event loop
 		self.SpecPlot.stop_event_loop()
-		#Destroy widget
+		#Destroy widget (and release the figure)
 		self.SProot.destroy()
+		plt.close(self.fig)
 		print "Quitting Line Finder"
 		return
 	#Function to run when you need velocity profiles for a given redshift.
@@ -1537,40 +4736,18 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		if usetutorial:tkMessageBox.showinfo("Help Window", "Using the velocity profiles, select which lines are associated with the system.")
 		#display velocity plots for given line
 		if debug: print "Running VELPLOTS", self.log, z, self.llist, self.fits
-		#Create a matplotlib figure
-		VPfig=plt.figure(figsize=(8,8))
-		#BIGAX is the full axes instance for the entire figure.
-		bigax = VPfig.add_subplot(111)    # The big subplot
-		#BIGAX is used to set up one label for the x and y axis....
-		#All the tick marks, etc, need to be turned off
-		bigax.spines['top'].set_color('none')
-		bigax.spines['bottom'].set_color('none')
-		bigax.spines['left'].set_color('none')
-		bigax.spines['right'].set_color('none')
-		#bigax.xaxis.tick_labels([])
-		#bigax.yaxis.tick_labels([])
-		bigax.tick_params(labelcolor='none', top='off', bottom='off', left='off', right='off')
-		#Label axes in BIGAX
-		bigax.set_xlabel(r'Relative Velocity (km s$^{-1}$)')
-		bigax.set_ylabel(r'Flux')
-		#Set up the spacing in between subplots
-		VPfig.subplots_adjust(wspace=0.3, hspace=0.5)
+		#The velocity profiles are shown in one window for the whole session (see VELSTACKVIEWER)
+		if self.velviewer is None: self.velviewer=VelStackViewer(self.root)
+		self.velviewer.show()
 		#Make a widget for selecting velocity profiles to include in LOG
 		VelPlotWin=Tkinter.Toplevel(self.root)
-		#Create a new widget for displaying velocity profiles with matplotlib canvas
-		VProot=Tkinter.Tk()
-		VProot.wm_title("Velocity Profiles")
-		VelFig=FigureCanvasTkAgg(VPfig,master=VProot)
-		VelFig.get_tk_widget().pack(side=Tkinter.TOP, fill=Tkinter.BOTH, expand=1)
-		#Add a matplotlib toolbar for zooming, panning, etc
-		NavVelFig=NavigationToolbar2TkAgg(VelFig, VProot)
-		VPfig.set_canvas(VelFig)
-		if debug: "onVelPlots VPfig figure:", VPfig
 		#Run the VELPLOTS function
-		self.log=VelPlots(self.log,z,self.llist,self.fits,VelPlotWin,VPfig,VelFig)
+		pagesize=None
+		if pagevelplots: pagesize=panelsperpage
+		self.log=VelPlots(self.log,z,self.llist,self.fits,VelPlotWin,self.velviewer.fig,self.velviewer.canvas,self.logindex,pagesize)
 		#Save notes to log
-		WriteLog(self.log,self.logfile,self.llistfile,self.fits)
-		VProot.destroy()
+		self.SaveLog()
+		self.velviewer.hide()
 		return
 	#Function for what to do when 'l' is pressed on keyboard
 	#Set up to assume that location of keystroke is a Ly-alpha line
@@ -1601,9 +4778,50 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 	#From cursor position.
 	def onA(self,event):
 		#Open tutorial message box saying what to do
-		if usetutorial:tkMessageBox.showinfo("Help Window", "Use the terminal window to select which line to use.")
+		if usetutorial:tkMessageBox.showinfo("Help Window", "Double click on an identification (best first) to view its velocity profiles.")
 		#Get wavelength position of cursor on Full Spectrum window
 		wvl=float(event.xdata)
+		#Rank every (ION,LINE) hypothesis for the feature (the table is made once per linelist)
+		if self.hyptable is None: self.hyptable=HypothesisTable(self.llist)
+		wvlngth,spectrum=specfits(self.fits)
+		zlogged=[float(z) for z in self.log['zs'] if IsFloat(z)]
+		hyps=self.hyptable.rank(wvl,wvlngth,spectrum,SpecError(self.fits),zlogged)[:50]
+		if debug: print "onA hypotheses",hyps[:10]
+		#Without any hypotheses, ask for the line in the terminal
+		if len(hyps)==0:
+			self.AskLine(wvl)
+			return
+		#Window with the ranked list of hypotheses
+		HypWin=Tkinter.Toplevel(self.root)
+		HypWin.wm_title("Identifications for %.2f A"%wvl)
+		HypList=Tkinter.Listbox(HypWin,width=60,height=min(len(hyps),20),font='Courier')
+		HypList.grid(column=0,row=0,columnspan=3,sticky='NSEW')
+		for score,z,ion,line,ndet,nrel,nmiss,logged in hyps:
+			entry="%-6s %-5s z=%.5f %d/%d lines"%(ion,line,z,ndet,nrel)
+			if nmiss>0: entry+=", %d missing"%nmiss
+			if logged: entry+=" (in log)"
+			HypList.insert(Tkinter.END,entry)
+		HypList.selection_set(0)
+		#View the velocity profiles of the selected hypothesis
+		def onView(event=None):
+			if len(HypList.curselection())==0: return
+			self.onVelPlots(hyps[int(HypList.curselection()[0])][1])
+		#Type in the line (in the terminal) instead
+		def onOther():
+			HypWin.destroy()
+			self.AskLine(wvl)
+		HypList.bind('<Double-Button-1>',onView)
+		Viewbutton=Tkinter.Button(HypWin,text="View",command=onView)
+		Viewbutton.grid(column=0,row=1,sticky='EW')
+		Otherbutton=Tkinter.Button(HypWin,text="Other Line",command=onOther)
+		Otherbutton.grid(column=1,row=1,sticky='EW')
+		Closebutton=Tkinter.Button(HypWin,text="Close",command=HypWin.destroy)
+		Closebutton.grid(column=2,row=1,sticky='EW')
+		#Wait for closing the window before proceeding.
+		HypWin.wait_window()
+		return
+	#Ask (in the terminal) which line is at wavelength WVL, and run onVelPlots
+	def AskLine(self,wvl):
 		ion=None#ION name placeholder
 		line=None#LINE ID name placeholder
 		badion=True#Boolean to see if the ion selected is in linelist(TRUE)
@@ -1647,16 +4865,49 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		#Close widget when done
 		LogMenuWin.destroy()
 		#Save information to log
-		WriteLog(self.log,self.logfile,self.llistfile,self.fits)
+		self.SaveLog()
+		return
+	#What to do if 'd' is pressed
+	#This will search the spectrum for doublets (see FINDDOUBLETS), list the
+	#candidate redshifts in the terminal, and run onVelPlots for the ones chosen
+	def onD(self):
+		#Open tutorial message box saying what to do
+		if usetutorial:tkMessageBox.showinfo("Help Window", "Use the terminal window to select which doublet candidate to view.")
+		#The search is only done once per spectrum
+		if self.doubletcands is None:
+			print "Searching for doublets..."
+			wvlngth,spectrum=specfits(self.fits)
+			self.doubletcands=FindDoublets(wvlngth,spectrum,self.llist)
+		if len(self.doubletcands)==0:
+			print "No doublet candidates found"
+			return
+		#List the candidates (best first), and mark those all ready in the LOG
+		zlogged=np.array([float(z) for z in self.log['zs'] if IsFloat(z)])
+		ncand=min(len(self.doubletcands),20)
+		for ii in range(ncand):
+			score,z,ion,line1,line2=self.doubletcands[ii]
+			logged=''
+			if len(zlogged)>0 and np.min(np.abs(zlogged-z))/(1.0+z)*clight<100.0: logged='(in log)'
+			print "%3d: z=%.5f %s %s/%s score=%.1f %s"%(ii,z,ion,line1,line2,score,logged)
+		#Ask the user which candidates to view, until none is given
+		while True:
+			choice=raw_input("Which candidate do you want to view (number, or return to stop): ")
+			if len(choice.strip())==0: break
+			if not choice.strip().isdigit() or int(choice)>=ncand:
+				print "Bad candidate, try again"
+				continue
+			self.onVelPlots(self.doubletcands[int(choice)][1])
 		return
 	#What to do if 'h' is pressed'
 	#This will display a list of keys to press in terminal
 	def onH(self):
 		print 'q - quit loop and save logfile'
-		print 'a - add system line (on cursor position and command line entry)'
+		print 'a - add system line (ranked identifications of the feature at the cursor)'
 		print 'l - select lya line (on cursor position & show potential absorption)'
 		print 'z - display potential absorption for input redshift (command line entry)'
 		print 'e - edit log, colours, notes (interface)'
+		print 't - show/hide absorption troughs (grey if explained by the log)'
+		print 'd - find doublets (CIV, SiIV, MgII, OVI, NV) and show a candidate (command line entry)'
 		print 'h - help'
 		return
 	#Function to figure out, based on a keyboard event, what function to run
@@ -1669,20 +4920,44 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 		elif event.key=='z': self.onZ()
 		elif event.key=='e': self.onE()
 		elif event.key=='h': self.onH()
-		#Update spectrum window if something has changed
-		if event.key not in ['q','h']: self.UpdatePlot()
+		elif event.key=='d': self.onD()
+		elif event.key=='t': self.onT()
+		#Update spectrum window if something might have changed
+		if event.key in ['a','l','z','e','d']: self.UpdatePlot()
 		return
 	#What to do when the Find Lines button is pressed on the main widget
 	def OnFindLines(self):
 		#Load log file (if it exists)
 		self.logfile=self.entryOut.get()
-		self.log=LoadLog(self.logfile)
 		#Load linelist
 		self.llistfile=self.entryLlist.get()
 		self.llist=LoadLineList(self.llistfile)
 		if debug: print "LLIST:",self.llist
-		#Open Figure
 		self.fits=self.specIn.get()
+		#A database logfile holds the log of the spectrum (see SQLITELOG)
+		if IsSQLiteLog(self.logfile):
+			print "Loading log of %s from database: %s"%(self.fits,self.logfile)
+			self.log=SQLiteLog(self.logfile).load(self.fits,self.llistfile)
+		else: self.log=LoadLog(self.logfile)
+		#Index the observed wavelengths of the lines in the log
+		self.logindex=LogLineIndex(self.log,self.llist)
+		#The doublet candidates of the spectrum (found on the first 'd' press, see OND)
+		self.doubletcands=None
+		#Table of the redshift hypotheses for 'a' (see HYPOTHESISTABLE)
+		self.hyptable=None
+		#The velocity profile window (see VELSTACKVIEWER), made when first needed
+		self.velviewer=None
+		#Open Figure
+		#Journal of the changes to a text logfile (see SAVELOG)
+		self.journal=None
+		self.autosaver=None
+		if self.log.backend is None:
+			self.journal=LogJournal(self.log,self.logfile,self.llistfile,self.fits)
+			#Save every change to the log in the background
+			if autosave:
+				#(Only printing when debugging, so the terminal prompts aren't interrupted)
+				self.autosaver=AutoSaver(lambda:self.WriteChanges(debug))
+				self.log.listeners.append(self.autosaver.poke)
 		self.PlotFits()
 		self.UpdatePlot()
 		if debug: print "FIGURE:",self.SpecPlot
@@ -1699,6 +4974,92 @@ class linefinder_tk(Tkinter.Tk):# Base for standard window
 
 #This iis the Main program. Pretty simple eh?
 if __name__=="__main__":
+	#Convert ASCII spectra to the binary format:
+	#	tb_linefinder.py --convert <SPECTRUM> [<SPECTRUM> ...]
+	if len(sys.argv)>2 and sys.argv[1]=='--convert':
+		for infile in sys.argv[2:]: ConvertSpec(infile)
+		sys.exit()
+	#Import text logfiles into a database of logs (see SQLITELOG):
+	#	tb_linefinder.py --import-log <DATABASE> <LOGFILE> [<LOGFILE> ...]
+	if len(sys.argv)>3 and sys.argv[1]=='--import-log':
+		db=SQLiteLog(sys.argv[2])
+		for logfile in sys.argv[3:]: db.importlog(logfile)
+		db.close()
+		sys.exit()
+	#Export the log of a spectrum from a database as a text logfile:
+	#	tb_linefinder.py --export-log <DATABASE> <SPECTRUM> <LOGFILE>
+	if len(sys.argv)>4 and sys.argv[1]=='--export-log':
+		db=SQLiteLog(sys.argv[2])
+		db.exportlog(sys.argv[3],sys.argv[4])
+		db.close()
+		sys.exit()
+	#Query a database of logs (see QUERYLOG for the options), e.g.:
+	#	tb_linefinder.py --query-log <DATABASE> zmin=1.5 zmax=2.5 ion=CIV flag=1
+	if len(sys.argv)>2 and sys.argv[1]=='--query-log':
+		names=['zmin','zmax','ion','line','flag','spectrum']
+		opts=dict(arg.split('=',1) for arg in sys.argv[3:] if '=' in arg)
+		bad=[arg for arg in sys.argv[3:] if '=' not in arg or arg.split('=',1)[0] not in names]
+		if len(bad)>0:
+			print "Unknown option(s): %s"%' '.join(bad)
+			print "Usage: tb_linefinder.py --query-log <DATABASE> [zmin=Z] [zmax=Z] [ion=ION] [line=LINE] [flag=FLAG] [spectrum=SPECTRUM]"
+			sys.exit()
+		for row in QueryLog(sys.argv[2],**opts): print ';\t'.join(row)+';'
+		sys.exit()
+	#Render the velocity profiles of every system without the GUI (see BATCHVELPLOTS):
+	#	tb_linefinder.py --batch <LINELIST> <OUTDIR> <SPECTRUM>:<SYSFILE> [...] [--format=pdf] [--nproc=N]
+	if len(sys.argv)>4 and sys.argv[1]=='--batch':
+		opts=dict(arg[2:].split('=',1) for arg in sys.argv[4:] if arg.startswith('--') and '=' in arg)
+		pairs=[]
+		for arg in sys.argv[4:]:
+			if arg.startswith('--'): continue
+			if ':' not in arg: print "Warning: Skipping %s (needs to be <SPECTRUM>:<SYSFILE>)"%arg
+			else: pairs.append(tuple(arg.rsplit(':',1)))
+		nproc=None
+		if 'nproc' in opts: nproc=int(opts['nproc'])
+		BatchVelPlots(sys.argv[2],sys.argv[3],pairs,fmt=opts.get('format','png'),nproc=nproc)
+		sys.exit()
+	#Print the catalog of absorption troughs of spectra (see FINDABSORBERS):
+	#	tb_linefinder.py --find-absorbers <SPECTRUM> [<SPECTRUM> ...]
+	if len(sys.argv)>2 and sys.argv[1]=='--find-absorbers':
+		for infile in sys.argv[2:]:
+			print "#!Spectrum: %s"%infile
+			WriteAbsorbers(GetAbsorbers(infile))
+		sys.exit()
+	#Measure the lines in a log (see MEASURELOG):
+	#	tb_linefinder.py --measure <SPECTRUM> <LINELIST> <LOGFILE> [<OUTFILE>]
+	if len(sys.argv)>4 and sys.argv[1]=='--measure':
+		wvlngth,spectrum=specfits(sys.argv[2])
+		meas=MeasureLog(LoadLog(sys.argv[4]),LoadLineList(sys.argv[3]),wvlngth,spectrum,SpecError(sys.argv[2]))
+		outfile=None
+		if len(sys.argv)>5: outfile=sys.argv[5]
+		WriteMeasurements(meas,outfile)
+		sys.exit()
+	#Measure the lines in many logs, with Monte Carlo errors (see MONTECARLOLOGS):
+	#	tb_linefinder.py --measure-mc <LINELIST> <OUTDIR> <SPECTRUM>:<LOGFILE> [...] [--nreal=1000] [--seed=0] [--nproc=N] [--maxmem=256]
+	if len(sys.argv)>4 and sys.argv[1]=='--measure-mc':
+		opts=dict(arg[2:].split('=',1) for arg in sys.argv[4:] if arg.startswith('--') and '=' in arg)
+		pairs=[]
+		for arg in sys.argv[4:]:
+			if arg.startswith('--'): continue
+			if ':' not in arg: print "Warning: Skipping %s (needs to be <SPECTRUM>:<LOGFILE>)"%arg
+			else: pairs.append(tuple(arg.rsplit(':',1)))
+		nproc=None
+		if 'nproc' in opts: nproc=int(opts['nproc'])
+		MonteCarloLogs(sys.argv[2],sys.argv[3],pairs,nreal=int(opts.get('nreal',1000)),seed=int(opts.get('seed',0)),\
+			nproc=nproc,maxmem=int(float(opts.get('maxmem',256))*2**20))
+		sys.exit()
+	#Benchmark the logfile reader:
+	#	tb_linefinder.py --bench-loadlog [<NROWS> ...]
+	if len(sys.argv)>1 and sys.argv[1]=='--bench-loadlog':
+		if len(sys.argv)>2: BenchLoadLog(sizes=[int(float(n)) for n in sys.argv[2:]])
+		else: BenchLoadLog()
+		sys.exit()
+	#Benchmark the ASCII spectrum reader:
+	#	tb_linefinder.py --bench-readspec [<NLINES> ...]
+	if len(sys.argv)>1 and sys.argv[1]=='--bench-readspec':
+		if len(sys.argv)>2: BenchReadSpec(sizes=[int(float(n)) for n in sys.argv[2:]])
+		else: BenchReadSpec()
+		sys.exit()
         app=linefinder_tk(None)
         app.title('LineFinder')#Name of application
         print "Starting TB's Line Finder GUI"